@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+main_logger = logging.getLogger('main')
+
+## Answers of query_attachments are cached per account, and given again to questions whose embedding is at least
+## ANSWER_CACHE_SIMILARITY similar to the one of a cached question, about the same attachments
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92"))
+## Least recently used answers of an account, and least recently used accounts, are evicted past these
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "64"))
+ANSWER_CACHE_MAX_ACCOUNTS = int(os.getenv("ANSWER_CACHE_MAX_ACCOUNTS", "1024"))
+
+
+@dataclass
+class AccountAnswers:
+    version: int
+    ## question -> (normalized question embedding, answer), the least recently used first
+    entries: "OrderedDict[str, tuple]" = field(default_factory=OrderedDict)
+
+
+class AnswerCache:
+    """ The answers to the questions about the attachments of each account, found again by the similarity of the
+        questions, so a rephrased question skips the retrieval and rerank calls of the query engine.
+
+        Each account's answers belong to a version of its attachment set. When attachments are added or removed
+        the version changes, and the answers of the old version are dropped. Memory is bounded by an LRU over
+        the accounts, and another over the answers of each account.
+    """
+
+    def __init__(self, similarity: float = ANSWER_CACHE_SIMILARITY, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 max_accounts: int = ANSWER_CACHE_MAX_ACCOUNTS):
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.max_accounts = max_accounts
+        self._accounts: "OrderedDict[str, AccountAnswers]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "puts": 0, "evictions": 0, "invalidations": 0}
+
+    def _account(self, account_id: str, version: int) -> AccountAnswers:
+        answers = self._accounts.get(account_id)
+        if answers is not None and answers.version != version:
+            ## The attachments changed since these answers were given
+            self.metrics["invalidations"] += 1
+            answers = None
+        if answers is None:
+            answers = self._accounts[account_id] = AccountAnswers(version)
+        self._accounts.move_to_end(account_id)
+        while len(self._accounts) > self.max_accounts:
+            _, evicted = self._accounts.popitem(last=False)
+            self.metrics["evictions"] += len(evicted.entries)
+        return answers
+
+    def get(self, account_id: str, version: int, question: str, embedding: Sequence[float]) -> Optional[str]:
+        """The answer to the most similar cached question of the account, None when none is similar enough."""
+        with self._lock:
+            answers = self._account(account_id, version)
+            entry = answers.entries.get(question)
+            if entry is None and answers.entries:
+                keys = list(answers.entries)
+                similarities = np.stack([vector for vector, _ in answers.entries.values()]) @ normalized(embedding)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity:
+                    question, entry = keys[best], answers.entries[keys[best]]
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            answers.entries.move_to_end(question)
+            self.metrics["hits"] += 1
+            return entry[1]
+
+    def put(self, account_id: str, version: int, question: str, embedding: Sequence[float], answer: str) -> None:
+        with self._lock:
+            answers = self._account(account_id, version)
+            answers.entries[question] = (normalized(embedding), answer)
+            answers.entries.move_to_end(question)
+            self.metrics["puts"] += 1
+            while len(answers.entries) > self.max_entries:
+                answers.entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+    def invalidate(self, account_id: str) -> None:
+        with self._lock:
+            if self._accounts.pop(account_id, None) is not None:
+                self.metrics["invalidations"] += 1
+
+    def __len__(self) -> int:
+        return sum(len(answers.entries) for answers in self._accounts.values())
+
+
+def normalized(embedding: Sequence[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@lru_cache(maxsize=None)
+def get_answer_cache() -> Optional[AnswerCache]:
+    """The process wide cache, None when it is turned off."""
+    if not ANSWER_CACHE:
+        return None
+    return AnswerCache()
@@ -2,14 +2,23 @@ import asyncio
 import nest_asyncio
 nest_asyncio.apply()
 
+import hashlib
 import os
+import threading
 import json
+import time
 import fs
 from dotenv import load_dotenv
 import pandas as pd
 import docx
-from .etl import TransformedChunk, transform_text_doc, get_embeddings
+from functools import lru_cache
+from .etl import (EMBEDDING_MODEL, TransformedChunk, transform_text_doc, get_embeddings, get_embeddings_batch,
+                  get_async_supabase)
+from .answer_cache import get_answer_cache
+from .source_catalog import get_source_catalog
+from .vector_engine import RAG_VECTOR_BACKEND, get_vector_engine
 from llama_index.core import Settings, VectorStoreIndex, StorageContext, load_index_from_storage
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.extractors import (
     SummaryExtractor,
@@ -19,34 +28,60 @@ from llama_index.core.extractors import (
 )
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.llms.gemini import Gemini
-from llama_index.embeddings.gemini import GeminiEmbedding
-from llama_parse import LlamaParse
 from typing import Annotated, Any, List, Optional, Dict, Tuple
 from llama_index.core.retrievers import QueryFusionRetriever, BaseRetriever
 from llama_index.core.postprocessor.llm_rerank import LLMRerank
 from llama_index.core.query_engine import RetrieverQueryEngine, PandasQueryEngine
 from langchain_core.tools import tool
 from io import StringIO
-from supabase import create_client
-from langchain_google_genai import ChatGoogleGenerativeAI
+from agents.models import get_chat_model
+from agents.persistence import SqliteStore
 from langgraph.prebuilt import InjectedStore, InjectedState
 from langgraph.store.base import BaseStore
-import yaml
 import logging
-import logging.config
 
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-with open("config/logging.yml", "r") as logging_config_file:
-    logging.config.dictConfig(yaml.load(logging_config_file, Loader=yaml.FullLoader))
-
 main_logger = logging.getLogger('main')
 
-llm = Gemini(model="models/gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
-transformation_llm = Gemini(model="models/gemini-2.0-flash", google_api_key=GEMINI_API_KEY)
-Settings.llm = llm
-Settings.embed_model = GeminiEmbedding(model="models/text-embedding-004", google_api_key=GEMINI_API_KEY)
+
+class CachedEmbedding(BaseEmbedding):
+    """ The llama-index embedding model of the attachments, embedding through `get_embeddings_batch` like the ETL,
+        so the chunks of a file uploaded again and the repeated questions are taken from the embedding cache.
+    """
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return asyncio.run(self._aget_query_embedding(query))
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return (await get_embeddings_batch([query], is_document=False))[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return asyncio.run(self._aget_text_embeddings(texts))
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await get_embeddings_batch(texts, is_document=True)
+
+
+@lru_cache(maxsize=None)
+def get_llm() -> Gemini:
+    """The llama-index LLM, also set as the llama-index default along with the embedding model, on first use."""
+    llm = Gemini(model="models/gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
+    Settings.llm = llm
+    Settings.embed_model = CachedEmbedding(model_name=EMBEDDING_MODEL)
+    return llm
+
+
+@lru_cache(maxsize=None)
+def get_transformation_llm() -> Gemini:
+    return Gemini(model="models/gemini-2.0-flash", google_api_key=GEMINI_API_KEY)
 
 
 class AttachmentProcessor:
@@ -62,6 +97,7 @@ class AttachmentProcessor:
         self.rag_pipeline = None
 
     def process(self) -> None:
+        get_llm()
         main_logger.info(f"Processing attachment: {self.file_name}")
         if self.file_name.endswith('.png') or\
             self.file_name.endswith('.jpeg') or\
@@ -92,15 +128,17 @@ class AttachmentProcessor:
                 main_logger.info(f"Docstore does not contain index for {self.file_name}")
 
         file_path = f'media/uploaded-files/raw-files/{self.file_name}'
+        ## The parser pulls in the LlamaCloud client, only import it when a PDF is parsed
+        from llama_parse import LlamaParse
         parser = LlamaParse(result_type="markdown")
         documents = parser.load_data(file_path)
         self.rag_pipeline = IngestionPipeline(
             documents=documents,
             transformations=[
                 SentenceSplitter(chunk_size=1024),
-                TitleExtractor(nodes=5, llm=transformation_llm),
-                SummaryExtractor(summaries=["self"], llm=transformation_llm),
-                KeywordExtractor(keywords=10, llm=transformation_llm),
+                TitleExtractor(nodes=5, llm=get_transformation_llm()),
+                SummaryExtractor(summaries=["self"], llm=get_transformation_llm()),
+                KeywordExtractor(keywords=10, llm=get_transformation_llm()),
                 # EntityExtractor(prediction_threshold=0.5),
             ]
         )
@@ -137,11 +175,15 @@ class AttachmentProcessors:
     multi_index_retriever: QueryFusionRetriever
     reranker: LLMRerank
     query_engine: RetrieverQueryEngine
+    checksums: Dict[str, Optional[str]]
+    manifest_version: int
 
     def __init__(self, attachment_processors: List[AttachmentProcessor] = None):
         self.multi_index_retriever = None
         self.query_engine = None
-        self.reranker = LLMRerank(top_n=5, llm=llm)
+        self.checksums = {}
+        self.manifest_version = 0
+        self.reranker = LLMRerank(top_n=5, llm=get_llm())
         self.attachment_processors = {}
         if attachment_processors:
             for processor in attachment_processors:
@@ -151,7 +193,7 @@ class AttachmentProcessors:
     def __build_query_engine(self):
         self.multi_index_retriever = QueryFusionRetriever(
             retrievers=[tup[1] for tup in self.attachment_processors.values()],
-            llm=llm,
+            llm=get_llm(),
             similarity_top_k=10,
             num_queries=4,
             mode="simple"
@@ -171,13 +213,6 @@ class AttachmentProcessors:
         self.__build_query_engine()
 
 
-helper_agent = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
-supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_KEY")
-)
-
-
 def storage_lookup(store: InjectedStore, namespace: tuple, key: str) -> Optional[Any]:
     # print(f"Namespace: {namespace}")
     items = store.search(namespace)
@@ -188,6 +223,108 @@ def storage_lookup(store: InjectedStore, namespace: tuple, key: str) -> Optional
     return None
 
 
+ATTACHMENTS_STORE_KEY = "attachment_processors"
+RAW_FILES_DIR = "media/uploaded-files/raw-files"
+
+## The attachment processors hold llama-index engines that can't be serialized, so the store only keeps a manifest
+## of each account: {"files": {file name: sha256 of its content}, "version": n}. The version goes up whenever a file
+## is added, replaced by other content or removed, and each worker rebuilds its processors when it sees a new one.
+## account_id -> attachment processors, of the manifest version they were built from
+loaded_attachment_processors: Dict[str, "AttachmentProcessors"] = {}
+## Serializes the manifest updates of the stores that have no transactional update, like the in-memory one
+manifest_lock = threading.Lock()
+
+
+def file_checksum(file_name: str) -> Optional[str]:
+    path = os.path.join(RAW_FILES_DIR, file_name)
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as raw_file:
+        for block in iter(lambda: raw_file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(value: Optional[dict]) -> dict:
+    """The manifest in the store, also from the file name lists stored before the checksums."""
+    if not value:
+        return {"files": {}, "version": 0}
+    if "files" not in value:
+        return {"files": {file_name: None for file_name in value.get("file_names", [])}, "version": 0}
+    return {"files": dict(value["files"]), "version": value.get("version", 0)}
+
+
+def update_manifest(store: BaseStore, account_id: str, key: str, updater) -> dict:
+    """Apply `updater` to the manifest of the account atomically, concurrent uploads don't lose each other's files."""
+    if isinstance(store, SqliteStore):
+        return store.update((account_id,), key, lambda value: updater(read_manifest(value)))
+    with manifest_lock:
+        item = store.get((account_id,), key)
+        manifest = updater(read_manifest(item.value if item else None))
+        store.put((account_id,), key, manifest)
+        return manifest
+
+
+def load_attachment_processors(store: BaseStore, account_id: str, key: str = ATTACHMENTS_STORE_KEY,
+                               built: Optional[Dict[str, AttachmentProcessor]] = None) -> Optional[AttachmentProcessors]:
+    """ The processors of the attachments of the account, rebuilt when the manifest changed since they were loaded.
+        The files whose content did not change keep their processor, the ones in `built` are taken as they are.
+    """
+    item = store.get((account_id,), key)
+    manifest = read_manifest(item.value if item else None)
+    if not manifest["files"]:
+        loaded_attachment_processors.pop(account_id, None)
+        return None
+    cached = loaded_attachment_processors.get(account_id)
+    if cached is not None and cached.manifest_version == manifest["version"] and not built:
+        return cached
+
+    main_logger.info(f"Rebuilding attachment processors of {account_id} from storage: {manifest}")
+    built = built or {}
+    processors = []
+    for file_name, checksum in manifest["files"].items():
+        processor = built.get(file_name)
+        if processor is None and cached is not None and checksum is not None \
+                and cached.checksums.get(file_name) == checksum and file_name in cached.attachment_processors:
+            processor = cached.attachment_processors[file_name][0]
+        if processor is None:
+            processor = AttachmentProcessor(file_name)
+            processor.process()
+        if processor.index is not None:
+            processors.append(processor)
+    attachment_processors = AttachmentProcessors(processors)
+    attachment_processors.checksums = manifest["files"]
+    attachment_processors.manifest_version = manifest["version"]
+    loaded_attachment_processors[account_id] = attachment_processors
+    return attachment_processors
+
+
+def register_attachment(store: BaseStore, account_id: str, attachment: AttachmentProcessor, key: str = ATTACHMENTS_STORE_KEY) -> None:
+    checksum = file_checksum(attachment.file_name)
+
+    def add(manifest: dict) -> dict:
+        files = manifest["files"]
+        if attachment.file_name not in files or files[attachment.file_name] != checksum or checksum is None:
+            files[attachment.file_name] = checksum
+            manifest["version"] += 1
+        return manifest
+
+    update_manifest(store, account_id, key, add)
+    load_attachment_processors(store, account_id, key, built={attachment.file_name: attachment})
+
+
+def unregister_attachment(store: BaseStore, account_id: str, file_name: str, key: str = ATTACHMENTS_STORE_KEY) -> None:
+    def remove(manifest: dict) -> dict:
+        if file_name in manifest["files"]:
+            del manifest["files"][file_name]
+            manifest["version"] += 1
+        return manifest
+
+    update_manifest(store, account_id, key, remove)
+    load_attachment_processors(store, account_id, key)
+
+
 @tool
 async def query_attachments(
     store: Annotated[BaseStore, InjectedStore],
@@ -195,9 +332,8 @@ async def query_attachments(
     prompt: Annotated[str, "User's prompt"]
 ) -> str:
     """ Query the attachments and return the response based on the user's prompt. """
-    attachment_processors = None
-    namespace = (account_id,)
-    attachment_processors = storage_lookup(store, namespace, "attachment_processors")
+    ## Rebuilding the processors parses and embeds the files that changed, off the event loop
+    attachment_processors = await asyncio.to_thread(load_attachment_processors, store, account_id)
     main_logger.info(f"Attachment processors from store: {attachment_processors}")
 
     if attachment_processors is None:
@@ -205,14 +341,49 @@ async def query_attachments(
     
     main_logger.info(f"Query engine: {attachment_processors.query_engine}")
 
+    ## A question close enough to one already answered about the same attachments gets the same answer. The
+    ## answers are kept per manifest version, which every worker reads from the store
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        query_embedding = await get_embeddings(prompt, is_document=False)
+        answer = answer_cache.get(account_id, attachment_processors.manifest_version, prompt, query_embedding)
+        if answer is not None:
+            main_logger.info(f"Answer of {account_id} from the answer cache: {answer}")
+            return answer
+
     response = await attachment_processors.query_engine.aquery(prompt)
     main_logger.info(f"response {type(response)}: {response.response}")
 
+    if answer_cache is not None and response.response and response.response != "Empty Response":
+        answer_cache.put(account_id, attachment_processors.manifest_version, prompt, query_embedding, response.response)
     return response.response
 
 
+## Seconds spent in each stage of query_database, summed over the queries. Choosing the sources and embedding
+## the query run at the same time, so their sum is more than the total
+query_database_metrics = {"queries": 0, "catalog": 0.0, "select_sources": 0.0, "embed": 0.0, "match": 0.0,
+                          "total": 0.0, "total_max": 0.0}
+
+
+def record_query_timings(timings: Dict[str, float]) -> None:
+    query_database_metrics["queries"] += 1
+    for stage, seconds in timings.items():
+        query_database_metrics[stage] += seconds
+    query_database_metrics["total_max"] = max(query_database_metrics["total_max"], timings["total"])
+    main_logger.info("query_database timings: " + ", ".join(f"{stage} {seconds * 1000:.0f}ms"
+                                                            for stage, seconds in timings.items()))
+
+
+async def timed(timings: Dict[str, float], stage: str, awaitable):
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = time.perf_counter() - started
+
+
 @tool
-def query_database(prompt: Annotated[str, "The user's prompt"]) -> str:
+async def query_database(prompt: Annotated[str, "The user's prompt"]) -> str:
     """ Determine the most relevant source_name(s), based on the user's prompt.
 
     Args:
@@ -222,58 +393,57 @@ def query_database(prompt: Annotated[str, "The user's prompt"]) -> str:
         A list of strings which could be the potential source_names for the user prompt.
     """
     user_prompt = prompt
+    timings = {}
+    started = time.perf_counter()
+
+    ## The sources and their chunk counts, from the cached catalog instead of a scan of every chunk
+    source_catalog = get_source_catalog()
+    sources = await timed(timings, "catalog", source_catalog.asources())
+    sources_prompt = source_catalog.routing_prompt(sources)
 
-    # try:
-    # get all the unique source_name's from the table
-    possible_source_names = supabase.table('agentic_rag')\
-        .select('source_name')\
-        .execute().data
-    unique_src_names = set()
-    for d in possible_source_names:
-        unique_src_names.add(d["source_name"])
-    
     engineered_prompt = (
         f'Help me determine the most relevant source_name from a prompt, i.e. the subject of the prompt.'
-        f'Choose from the following list of source_name\'s: `{list(unique_src_names)}`.'
+        f'Choose from the following source_name\'s, with the number of chunks of content each one has:\n{sources_prompt}\n'
         f'You can choose multiple source_name\'s if you think they are relevant.'
         f'If none of the source_name\'s are relevant, return `None`.'
         f'Return a list of the choices made, strictly use double quotes to wrap each source_name.'
         f'Here is the prompt: {user_prompt}'
     )
 
-    result = helper_agent.invoke(engineered_prompt)
+    main_logger.info(f"User query: {user_prompt}")
+    ## The query is embedded while the model chooses the sources, the embedding does not depend on them
+    result, query_embedding = await asyncio.gather(
+        timed(timings, "select_sources", get_chat_model().ainvoke(engineered_prompt)),
+        timed(timings, "embed", get_embeddings(user_prompt, is_document=False)),
+    )
     if 'None' in result.content:
+        record_query_timings({**timings, "total": time.perf_counter() - started})
         return ""
-    result = result.data.strip()
+    result = result.content.strip()
     source_names = json.loads(result[result.find("["):result.rfind("]")+1])
     main_logger.info(f"Most relevant source names {type(source_names)}: {source_names}")
-    
-    # ------------------------------------------------------------------------------------------------------------
-    urls = supabase.from_('agentic_rag')\
-        .select('url')\
-        .in_('source_name', source_names)\
-        .execute().data
-
-    unique_urls = set()
-    for d in urls:
-        unique_urls.add(d["url"])
-    unique_urls = list(unique_urls)
-
-    # try:
-    main_logger.info(f"User query: {user_prompt}")
-    query_embedding = get_embeddings(user_prompt, is_document=False)
-    main_logger.info(f"Source names: {source_names}")
-    main_logger.info(f"URLs: {unique_urls}")
-    # get the most relevant content from the table
-    relevant_content = supabase.rpc(
-        'match_agentic_rag',
-        {
-            'query_embedding': query_embedding,
-            'source_names': source_names,
-            'urls': unique_urls,
-            'match_count': 10
-        }
-    ).execute().data
+
+    match_started = time.perf_counter()
+    if RAG_VECTOR_BACKEND == "local":
+        ## Each source is its own partition, the search only looks at the chosen ones
+        relevant_content = await asyncio.to_thread(
+            get_vector_engine().search, query_embedding, source_names=source_names, match_count=10)
+    else:
+        unique_urls = source_catalog.urls(source_names, sources)
+        main_logger.info(f"URLs: {unique_urls}")
+        # get the most relevant content from the table
+        supabase = await get_async_supabase()
+        relevant_content = (await supabase.rpc(
+            'match_agentic_rag',
+            {
+                'query_embedding': query_embedding,
+                'source_names': source_names,
+                'urls': unique_urls,
+                'match_count': 10
+            }
+        ).execute()).data
+    timings["match"] = time.perf_counter() - match_started
+    record_query_timings({**timings, "total": time.perf_counter() - started})
 
     main_logger.info(f"Relevant content: {relevant_content}")
     if not relevant_content:
@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import os
+import time
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from agents.persistence import SqliteConnectionPool, get_connection_pool
+
+
+main_logger = logging.getLogger('main')
+
+## Embeddings are cached on disk, keyed on the model, the task type and a hash of the content
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "1") == "1"
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", "media/agent-state/embedding_cache.sqlite3")
+## Past this size the least recently used embeddings are evicted, down to EMBEDDING_CACHE_LOW_WATER of it
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+EMBEDDING_CACHE_LOW_WATER = 0.9
+## The last use of an entry is only written back once it is older than this, so hot entries cost no writes
+EMBEDDING_CACHE_TOUCH_SECONDS = float(os.getenv("EMBEDDING_CACHE_TOUCH_SECONDS", "60"))
+## Keys per SQL statement, under the SQLite limit of variables
+LOOKUP_BATCH_SIZE = 500
+
+
+def content_hash(content: str) -> bytes:
+    return hashlib.sha256(content.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """ Embedding vectors in SQLite, stored as float32 blobs and shared between the worker processes of a host.
+
+        Entries are keyed on (model, task type, sha256 of the content), so the same text is only embedded once
+        across re-crawls, re-uploads and repeated queries. The least recently used entries are evicted once the
+        vectors take more than `max_bytes`.
+    """
+
+    def __init__(self, pool: SqliteConnectionPool, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.metrics = {"hits": 0, "misses": 0, "puts": 0, "evictions": 0, "evicted_bytes": 0}
+        with self.pool.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    task_type TEXT NOT NULL,
+                    content_hash BLOB NOT NULL,
+                    vector BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, task_type, content_hash)
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return self.metrics["hits"] / lookups if lookups else 0.0
+
+    def get_many(self, model: str, task_type: str, contents: Sequence[str]) -> List[Optional[List[float]]]:
+        """The cached embedding of each content, None for the ones not cached."""
+        hashes = [content_hash(content) for content in contents]
+        found, stale = {}, []
+        now = time.time()
+        with self.pool.connection() as connection:
+            for i in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+                batch = list(set(hashes[i:i + LOOKUP_BATCH_SIZE]))
+                rows = connection.execute(
+                    f"SELECT content_hash, vector, last_used FROM embeddings WHERE model = ? AND task_type = ? "
+                    f"AND content_hash IN ({', '.join('?' * len(batch))})", (model, task_type, *batch)).fetchall()
+                for key, vector, last_used in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+                    if last_used < now - EMBEDDING_CACHE_TOUCH_SECONDS:
+                        stale.append(key)
+        if stale:
+            with self.pool.transaction() as connection:
+                for i in range(0, len(stale), LOOKUP_BATCH_SIZE):
+                    batch = stale[i:i + LOOKUP_BATCH_SIZE]
+                    connection.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE model = ? AND task_type = ? "
+                        f"AND content_hash IN ({', '.join('?' * len(batch))})", (now, model, task_type, *batch))
+        embeddings = [found.get(key) for key in hashes]
+        hits = sum(embedding is not None for embedding in embeddings)
+        self.metrics["hits"] += hits
+        self.metrics["misses"] += len(embeddings) - hits
+        return embeddings
+
+    def put_many(self, model: str, task_type: str, contents: Sequence[str], embeddings: Sequence[List[float]]) -> None:
+        now = time.time()
+        rows = []
+        for content, embedding in zip(contents, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32).tobytes()
+            rows.append((model, task_type, content_hash(content), vector, len(vector), now))
+        with self.pool.transaction() as connection:
+            connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.metrics["puts"] += len(rows)
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(connection, total - int(self.max_bytes * EMBEDDING_CACHE_LOW_WATER))
+
+    def _evict(self, connection, excess: int) -> None:
+        """Delete the least recently used entries, until `excess` bytes are freed."""
+        evicted, freed = [], 0
+        for rowid, size in connection.execute("SELECT rowid, size FROM embeddings ORDER BY last_used"):
+            if freed >= excess:
+                break
+            evicted.append(rowid)
+            freed += size
+        for i in range(0, len(evicted), LOOKUP_BATCH_SIZE):
+            batch = evicted[i:i + LOOKUP_BATCH_SIZE]
+            connection.execute(f"DELETE FROM embeddings WHERE rowid IN ({', '.join('?' * len(batch))})", batch)
+        self.metrics["evictions"] += len(evicted)
+        self.metrics["evicted_bytes"] += freed
+        main_logger.info(f"Evicted {len(evicted)} embeddings, {freed} bytes, from the embedding cache")
+
+    def clear(self) -> None:
+        with self.pool.transaction() as connection:
+            connection.execute("DELETE FROM embeddings")
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """The process wide cache, None when it is turned off."""
+    if not EMBEDDING_CACHE:
+        return None
+    return EmbeddingCache(get_connection_pool(EMBEDDING_CACHE_DB))
@@ -1,49 +1,68 @@
 import asyncio
-import concurrent.futures
 from dataclasses import dataclass, asdict
+from functools import lru_cache
 import json
 import os
+import weakref
 from typing import Any, Dict, List
 from dotenv import load_dotenv
-from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode
 import faiss
-from pydantic_ai import Agent, RunContext, ModelRetry
 from pydantic import BaseModel, Field
-from openai import AsyncOpenAI
-from pydantic_ai.models.gemini import GeminiModel
-import logfire
-import concurrent
 import logging
-import logging.config
-import yaml
-from supabase import create_client, Client
+from supabase import create_client, create_async_client, AsyncClient, Client
 import google.generativeai as genai
 import numpy as np
 from typing import Optional, TypedDict, Annotated, List, Union
 
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langgraph.types import interrupt, Command
-from langgraph.graph.message import add_messages
- 
+from agents.models import get_chat_model
+from .embedding_cache import get_embedding_cache
+from .source_catalog import get_source_catalog, register_chunks
+from .vector_engine import RAG_VECTOR_BACKEND, get_vector_engine
+from .vector_store import VectorStore
+
 
 
 load_dotenv()
 
 main_logger = logging.getLogger('main')
 
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=20, thread_name_prefix=__name__)
+## Chunks embedded per request, the embedding API takes at most 100 contents per batch
+ETL_EMBEDDING_BATCH_SIZE = int(os.getenv("ETL_EMBEDDING_BATCH_SIZE", "100"))
+## Embedding batches in flight at once
+ETL_EMBEDDING_CONCURRENCY = int(os.getenv("ETL_EMBEDDING_CONCURRENCY", "4"))
+## Title and summary calls in flight at once, and started per second, to stay under the model rate limits
+ETL_TITLE_CONCURRENCY = int(os.getenv("ETL_TITLE_CONCURRENCY", "8"))
+ETL_TITLE_RATE_PER_SECOND = float(os.getenv("ETL_TITLE_RATE_PER_SECOND", "10"))
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+
+@lru_cache(maxsize=None)
+def get_supabase() -> Client:
+    """Supabase client shared by the ETL and the RAG tools, created on first use."""
+    return create_client(
+        os.getenv("SUPABASE_URL"),
+        os.getenv("SUPABASE_SERVICE_KEY")
+    )
+
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_KEY")
-)
+## One async client per event loop, its connections belong to the loop that opened them. The task creating it
+## is kept, so the queries starting together wait for the same client
+_async_supabase_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Task]" = weakref.WeakKeyDictionary()
 
-helper_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
+
+async def get_async_supabase() -> AsyncClient:
+    """Async Supabase client of the running event loop, whose connections are reused by every query on it."""
+    loop = asyncio.get_running_loop()
+    client = _async_supabase_clients.get(loop)
+    if client is None or (client.done() and client.exception() is not None):
+        client = loop.create_task(create_async_client(
+            os.getenv("SUPABASE_URL"),
+            os.getenv("SUPABASE_SERVICE_KEY")
+        ))
+        _async_supabase_clients[loop] = client
+    return await client
 
 
 ## =============== Defining the dataclass ===============
@@ -59,7 +78,7 @@ class TransformedChunk:
     title: str = Field(description='Title of the text chunk')
     summary: str = Field(description='Summary of the text chunk')
     content: str = Field(description='Exact content of the text chunk')
-    embedding: List[float] = Field(description='Embedding vector of the text chunk')
+    embedding: np.ndarray = Field(description='Embedding vector of the text chunk, float32 at its native dimensions')
 
 
 ## =============== Defining the helper agent ===============
@@ -74,7 +93,11 @@ helper_agent_prompt = ChatPromptTemplate.from_messages([
     )),
     ("user", "{user_input}"),
 ])
-helper_agent = (helper_agent_prompt | helper_model)
+
+
+@lru_cache(maxsize=None)
+def get_helper_agent():
+    return (helper_agent_prompt | get_chat_model())
 
 
 ## =============== Constructing etl functions ===============
@@ -118,36 +141,95 @@ def chunk_text(text: str, chunk_size: int) -> List[str]:
     return chunks
 
 
+class RateLimiter:
+    """Spaces the starts of the calls so at most `rate` start per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def embed_contents(contents: List[str], task_type: str) -> List[List[float]]:
+    """One embedding request for all the contents."""
+    result = await genai.embed_content_async(model=EMBEDDING_MODEL, task_type=task_type, content=contents)
+    return result['embedding']
+
+
+async def get_embeddings_batch(text_chunks: List[str], is_document: bool = True) -> List[List[float]]:
+    """ Get the embedding vectors of the text chunks, in their order.
+        The ones in the embedding cache are taken from it, the others, each distinct text once, are requested in
+        batches of ETL_EMBEDDING_BATCH_SIZE chunks with at most ETL_EMBEDDING_CONCURRENCY of them in flight.
+    """
+    task_type = "RETRIEVAL_DOCUMENT" if is_document else "RETRIEVAL_QUERY"
+    cache = get_embedding_cache()
+    if cache is not None:
+        embeddings = await asyncio.to_thread(cache.get_many, EMBEDDING_MODEL, task_type, text_chunks)
+    else:
+        embeddings = [None] * len(text_chunks)
+    missing = list(dict.fromkeys(chunk for chunk, embedding in zip(text_chunks, embeddings) if embedding is None))
+
+    if missing:
+        semaphore = asyncio.Semaphore(ETL_EMBEDDING_CONCURRENCY)
+
+        async def embed_batch(batch: List[str]) -> List[List[float]]:
+            async with semaphore:
+                return await embed_contents(batch, task_type)
+
+        batches = [missing[i:i + ETL_EMBEDDING_BATCH_SIZE] for i in range(0, len(missing), ETL_EMBEDDING_BATCH_SIZE)]
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        embedded = [embedding for batch_embeddings in results for embedding in batch_embeddings]
+        if cache is not None:
+            await asyncio.to_thread(cache.put_many, EMBEDDING_MODEL, task_type, missing, embedded)
+        embedded_by_chunk = dict(zip(missing, embedded))
+        embeddings = [embedded_by_chunk[chunk] if embedding is None else embedding
+                      for chunk, embedding in zip(text_chunks, embeddings)]
+    return embeddings
+
+
 async def get_embeddings(text_chunk: str, is_document: bool = True) -> List[float]:
     """Get the embedding vector for the text chunk.
     """
-    task_type = "RETRIEVAL_QUERY"
-    if is_document:
-        task_type = "RETRIEVAL_DOCUMENT"
-
-    result = genai.embed_content(
-        model="models/text-embedding-004",
-        task_type=task_type,
-        content=text_chunk)
-    embedding = result['embedding']
-    if len(embedding) < 1536:
-        # pad with zeros at the end
-        embedding = np.pad(embedding, (0, 1536 - len(embedding)), 'constant').tolist()
-    return embedding
-
-    # try:
-    #     response = await openai_client.embeddings.create(
-    #         model="text-embedding-3-small",
-    #         input=text_chunk
-    #     )
-    #     print(response.data[0].embedding)
-    #     return response.data[0].embedding
-    # except Exception as e:
-    #     main_logger.error(f"Error getting embedding: {e}")
-    #     return [0] * 1536  # Return zero vector on error
-
-
-async def transform_text_doc(url: str | None, source_name: str, text: str, build_index: bool = False, index: faiss.IndexFlatIP = None) -> List[TransformedChunk]:
+    return (await get_embeddings_batch([text_chunk], is_document))[0]
+
+
+def parse_title_summary(content: str, source_name: str) -> Dict[str, str]:
+    """The title and summary from the JSON answer of the helper agent, the source name as title when it is not JSON."""
+    try:
+        parsed = json.loads(content[content.find("{"):content.rfind("}") + 1])
+        return {"title": str(parsed.get("title", source_name)), "summary": str(parsed.get("summary", ""))}
+    except (ValueError, AttributeError):
+        main_logger.warning(f"Title and summary of a chunk of {source_name} is not JSON: {content[:200]}")
+        return {"title": source_name, "summary": ""}
+
+
+async def get_titles_summaries(chunks: List[str], source_name: str) -> List[Dict[str, str]]:
+    """ The title and summary of each chunk, in their order, with at most ETL_TITLE_CONCURRENCY calls in flight
+        and ETL_TITLE_RATE_PER_SECOND started per second.
+    """
+    if "csv" in source_name:
+        return [{"title": source_name, "summary": "CSV Data"} for _ in chunks]
+    semaphore = asyncio.Semaphore(ETL_TITLE_CONCURRENCY)
+    rate_limiter = RateLimiter(ETL_TITLE_RATE_PER_SECOND)
+
+    async def extract(chunk: str) -> Dict[str, str]:
+        async with semaphore:
+            await rate_limiter.wait()
+            result = await get_helper_agent().ainvoke({"user_input": chunk})
+        return parse_title_summary(result.content, source_name)
+
+    return await asyncio.gather(*(extract(chunk) for chunk in chunks))
+
+
+async def transform_text_doc(url: str | None, source_name: str, text: str, build_index: bool = False, index: VectorStore = None) -> List[TransformedChunk]:
     """ Transform a text document into a list of TransformedChunk objects,
         by chunking the text, populating the metadata, and embedding of the chunk.
 
@@ -156,59 +238,67 @@ async def transform_text_doc(url: str | None, source_name: str, text: str, build
         source_name (str): Name of the source
         text (str): Text document in markdown format
         build_index (bool): Whether to build an index of the chunks
-        index (faiss.IndexFlatIP): FAISS index to add the chunks to
+        index (VectorStore): Vector store to add the chunks to
 
     Returns:
         List[TransformedChunk]: List of TransformedChunk objects
     """
     chunks = chunk_text(text=text, chunk_size=5000) # chunk size in num characters
     main_logger.info(f"Total chunks: {len(chunks)}")
-    transformed_chunks = []
-    for i, chunk in enumerate(chunks):
-        if not chunk:
-            main_logger.debug("Empty chunk")
-            continue
-        if "csv" in source_name:
-            transformed_chunk = {"title": source_name, "summary": "CSV Data"}
-        else:
-            helper_agent_inputs = {
-                "user_input": chunk,
-            }
-            transformed_chunk = helper_agent.invoke(helper_agent_inputs)
-            print(f"Transformed chunk: {transformed_chunk}")
-        
-        embedding = await get_embeddings(chunk)
-        transformed_chunk = TransformedChunk(
+    ## Chunk numbers count the empty chunks, as they are skipped
+    numbered_chunks = [(i, chunk) for i, chunk in enumerate(chunks) if chunk]
+    contents = [chunk for _, chunk in numbered_chunks]
+    ## The titles and the embeddings of all the chunks are fetched at the same time, and put back in chunk order
+    titles_summaries, embeddings = await asyncio.gather(get_titles_summaries(contents, source_name),
+                                                        get_embeddings_batch(contents))
+    embeddings = np.array(embeddings, dtype=np.float32)
+    transformed_chunks = [
+        TransformedChunk(
             source_name=source_name,
             url=url,
             chunk_number=i,
-            title=transformed_chunk['title'],
-            summary=transformed_chunk['summary'],
+            title=title_summary['title'],
+            summary=title_summary['summary'],
             content=chunk,
             embedding=embedding
         )
-        transformed_chunks.append(transformed_chunk)
-        if build_index:
-            chunk_embedding_np = np.array(transformed_chunk.embedding, dtype='float32').reshape(1, -1)
-            faiss.normalize_L2(chunk_embedding_np)
-            index.add(chunk_embedding_np)
+        for (i, chunk), title_summary, embedding in zip(numbered_chunks, titles_summaries, embeddings)
+    ]
+    if build_index and transformed_chunks:
+        index.add(embeddings)
 
     return transformed_chunks
 
 
 def load_text_doc(chunks: List[TransformedChunk]):
-    """Insert a processed chunk into Supabase."""
+    """ Insert a processed chunk into Supabase, and into the local vector engine when it is the backend,
+        then count the chunks of its url again in the source catalog.
+    """
     rows = [asdict(chunk) for chunk in chunks]
+    for row in rows:
+        row["embedding"] = row["embedding"].tolist()
     try:
-        result = supabase.table("agentic_rag").insert(rows).execute()
+        result = get_supabase().table("agentic_rag").insert(rows).execute()
         main_logger.info(f"Inserted chunk {len(rows)} for {rows[0].get('url', 'unknown url')}")
-        return result
     except Exception as e:
         main_logger.error(f"Error inserting chunk: {e}")
         return None
+    if RAG_VECTOR_BACKEND == "local":
+        ## Kept with the ids Supabase gave the rows
+        get_vector_engine().add([{**row, "id": inserted.get("id")} for row, inserted in zip(rows, result.data)])
+    try:
+        for source_name, url in dict.fromkeys((row["source_name"], row["url"]) for row in rows):
+            register_chunks(source_name, url)
+    except Exception as e:
+        main_logger.error(f"Error updating the source catalog: {e}")
+    get_source_catalog().invalidate()
+    return result
 
 
 async def etl_from_url(urls: dict):
+    ## The crawler pulls in a browser stack, only import it when crawling
+    from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode
+
     # Crawl the URLs
     browser_config = BrowserConfig(
         headless=True,
@@ -231,18 +321,18 @@ async def etl_from_url(urls: dict):
             main_logger.error(f"Failed: {url} - Error: {result.error_message}")
         
 
-async def match_query_embedding(prompt: str, index: faiss.IndexFlatIP, transformed_chunks: List[TransformedChunk]) -> str:
+async def match_query_embedding(prompt: str, index: VectorStore, transformed_chunks: List[TransformedChunk]) -> str:
     top_k =10
-    query_embedding = np.array(await get_embeddings(prompt, is_document=False), dtype=np.float32).reshape(1, -1)
-    faiss.normalize_L2(query_embedding)
-    _, I = index.search(query_embedding, top_k)
-    print(f"Top {top_k} matches: {I}")
-    matched_chunks = [transformed_chunks[i].content for i in I[0] if i >= 0]
+    matches = index.search(await get_embeddings(prompt, is_document=False), top_k)
+    print(f"Top {top_k} matches: {matches}")
+    matched_chunks = [transformed_chunks[i].content for i, _ in matches]
     return "\n\n".join(matched_chunks)
 
 
 
 if __name__ == "__main__":
+    from agents.logging_config import configure_logging
+    configure_logging()
     # use sitemap.xml to fetch all the url endpoints for a website
     asyncio.run(etl_from_url({"pydantic_ai_document":"https://ai.pydantic.dev/agents/"}))
 
@@ -5,10 +5,8 @@ nest_asyncio.apply()
 import sys
 import os
 import json
-from dotenv import load_dotenv
 import logging
-import logging.config
-import yaml
+from functools import lru_cache
 from typing import Optional, TypedDict, Annotated, List, Union, Any
 from langchain_core.agents import AgentAction
 from langchain.agents.output_parsers.tools import ToolAgentAction
@@ -16,23 +14,18 @@ from langchain_core.messages import ToolMessage
 from langgraph.graph.message import add_messages
 
 from langchain_core.runnables import RunnableConfig
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.store.memory import InMemoryStore
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import tool
 from langgraph.types import Command
-from .attachment_processor import AttachmentProcessors, AttachmentProcessor, query_attachments, query_database, dummy_file_setup, storage_lookup
+from .attachment_processor import AttachmentProcessor, query_attachments, query_database, register_attachment
+from agents.concurrency import make_config, thread_locks
+from agents.persistence import get_checkpointer, get_store
+from agents.history import with_history
+from agents.models import get_chat_model
+from agents.logging_config import configure_logging
 
 
-
-load_dotenv()
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-with open("config/logging.yml", "r") as logging_config_file:
-    logging.config.dictConfig(yaml.load(logging_config_file, Loader=yaml.FullLoader))
-
 main_logger = logging.getLogger('main')
 
 
@@ -55,12 +48,9 @@ class AgentState(TypedDict):
     final_response: str
     is_interrupted: bool
     interrupt_queue: list[dict]
+    history_summary: str
 
 
-config = {"configurable": {"thread_id": ""}}
-gemini_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
-model = gemini_model
-
 ## ================= Setting up the agent prompts =================
 
 rag_agent_prompt = ChatPromptTemplate.from_messages([
@@ -75,10 +65,14 @@ rag_agent_prompt = ChatPromptTemplate.from_messages([
 ## ================= Setting up the tools =================
 
 tools = [query_attachments, query_database]
-model = model.bind_tools(tools)
-rag_llm = (rag_agent_prompt | model)
 tools_by_name = {tool.name: tool for tool in tools}
 
+
+@lru_cache(maxsize=None)
+def get_rag_llm():
+    ## Not streamed, its text comes with the tool calls and the answer of the turn also holds the tool outputs
+    return (rag_agent_prompt | get_chat_model().bind_tools(tools))
+
 ## ================= Setting up the Nodes =================
 
 async def agent_node(state: AgentState, config: RunnableConfig):
@@ -90,7 +84,7 @@ async def agent_node(state: AgentState, config: RunnableConfig):
         return {"final_response": state["final_response"]}
     else:
         print(f"RAG Agent State: {state}")
-        response = await rag_llm.ainvoke(state, config)
+        response = await get_rag_llm().ainvoke(with_history(state), config)
         agent_actions = []
         for tool_call in response.tool_calls:
             tool_call["args"]["account_id"] = state["account_id"]
@@ -113,7 +107,7 @@ async def tool_node(state: AgentState):
     for action in list(state["intermediate_steps"]):
         tool_name = action.tool
         tool_args = action.tool_input.copy()
-        tool_args["store"] = store
+        tool_args["store"] = get_store()
         tool_response = await tools_by_name[tool_name].ainvoke(tool_args)
         outputs.append(
             ToolMessage(
@@ -142,8 +136,6 @@ def router(state: AgentState):
 ## ================= Setting up the graph =================
 
 entry_point = "agent_node"
-memory = MemorySaver()
-store = InMemoryStore()
 
 workflow = StateGraph(AgentState)
 workflow.add_node(entry_point, agent_node)
@@ -160,19 +152,22 @@ workflow.add_conditional_edges(
 for tool_obj in tools:
     workflow.add_edge(tool_obj.name, entry_point)
 
-rag_agent = workflow.compile(name="rag_agent", store=store, checkpointer=memory)
-
-## ================= Visualizing the graph =================
 
-with open("agents/RAG_agent/rag_graph_visualization.jpg", "wb") as f:
-    f.write(rag_agent.get_graph().draw_mermaid_png())
+@lru_cache(maxsize=None)
+def get_rag_agent():
+    """The compiled RAG graph, compiled on first use."""
+    return workflow.compile(name="rag_agent", store=get_store(), checkpointer=get_checkpointer())
 
 ## ================= Running the agent =================
 
 async def process_input(user_input: str, account_id: str, is_interrupted: bool = False) -> tuple[str, bool]:
-    global inputs
+    async with thread_locks.hold(account_id):
+        return await _process_input(user_input, account_id, is_interrupted)
 
-    config["configurable"]["thread_id"] = account_id
+
+async def _process_input(user_input: str, account_id: str, is_interrupted: bool) -> tuple[str, bool]:
+    config = make_config(account_id)
+    response = None
 
     inputs = {
         "user_input": user_input,
@@ -186,7 +181,7 @@ async def process_input(user_input: str, account_id: str, is_interrupted: bool =
     if is_interrupted:
         inputs = Command(resume=user_input)
 
-    events = rag_agent.astream(
+    events = get_rag_agent().astream(
         inputs,
         config
     )
@@ -212,36 +207,14 @@ async def process_input(user_input: str, account_id: str, is_interrupted: bool =
 
 
 def file_upload_handler(file_name: str, account_id: str, key: str):
-    namespace = (account_id,)
-    attachment_processors = storage_lookup(store, namespace, key)
-    if attachment_processors is None:
-        attachment_processors = AttachmentProcessors()
-        store.put(namespace, key, attachment_processors)
-        main_logger.info(f"Attachment processors stored in store namespace: {namespace} key: {key}")
-
     attachment = AttachmentProcessor(file_name)
     attachment.process()
-    attachment_processors.add_attachment(attachment)
+    register_attachment(get_store(), account_id, attachment, key)
+    main_logger.info(f"Attachment {file_name} registered in store namespace: {(account_id,)} key: {key}")
 
 
 if __name__ == "__main__":
-    from attachment_processor import dummy_file_setup, add_new_attachment
-
-    attachment_processors = AttachmentProcessors()
-
-    account_id = "account_id_1"
-    namespace = (account_id,)
-    attachment_processors_store_key = "attachment_processors"
-    store.put(namespace, attachment_processors_store_key, attachment_processors)
-
-    account_id = "account_id_2"
-    namespace = (account_id,)
-    attachment_processors_store_key = "attachment_processors"
-    store.put(namespace, attachment_processors_store_key, attachment_processors)
-
-    file_obj = dummy_file_setup()
-    add_new_attachment(store=store, namespace=namespace, key=attachment_processors_store_key, file_obj=file_obj)
-    
+    configure_logging()
     # ================================================================
     async def run_loop():
         is_interrupted = False
@@ -0,0 +1,69 @@
+-- Stores the embeddings of agentic_rag at their native 768 dimensions.
+-- The 768 dimension text-embedding-004 vectors used to be zero padded to 1536, the padding is stripped,
+-- which leaves every cosine similarity as it was.
+
+begin;
+
+-- Refuse to truncate any vector that is not just padding past its 768th dimension
+do $$
+begin
+  if exists (
+    select 1 from agentic_rag
+    where embedding is not null and vector_dims(embedding) > 768
+      and vector_norm(subvector(embedding, 769, vector_dims(embedding) - 768)) > 0
+  ) then
+    raise exception 'agentic_rag has embeddings with values past dimension 768, they are not padded 768 dimension vectors';
+  end if;
+end;
+$$;
+
+drop index if exists agentic_rag_embedding_idx;
+drop function if exists match_agentic_rag(vector, varchar[], varchar[], int);
+
+alter table agentic_rag
+  alter column embedding type vector(768)
+  using case when vector_dims(embedding) > 768 then subvector(embedding, 1, 768) else embedding end::vector(768);
+
+create index on agentic_rag using ivfflat (embedding vector_cosine_ops);
+
+create or replace function match_agentic_rag (
+  query_embedding vector(768),
+  source_names varchar(50)[] default NULL,
+  urls varchar(200)[] default NULL,
+  match_count int default 10
+) returns table (
+  id bigint,
+  source_name varchar,
+  url varchar,
+  chunk_number integer,
+  title varchar,
+  summary varchar,
+  content text,
+  similarity float
+)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+  return query
+  select
+    id,
+    source_name,
+    url,
+    chunk_number,
+    title,
+    summary,
+    content,
+    1 - (agentic_rag.embedding <=> query_embedding) as similarity
+  from agentic_rag
+  where
+    source_names is null or cardinality(source_names) = 0 or source_name = any(source_names)
+    or
+    urls is null or cardinality(urls) = 0 or url = any(urls)
+  -- <=> is the cosine distance, the most similar chunks first
+  order by agentic_rag.embedding <=> query_embedding
+  limit match_count;
+end;
+$$;
+
+commit;
@@ -0,0 +1,28 @@
+-- Adds agentic_rag_sources, the distinct sources and urls of agentic_rag with their chunk counts.
+-- query_database reads it, cached, instead of scanning every chunk for the sources and their urls;
+-- load_text_doc counts the chunks of a url again after loading it.
+
+begin;
+
+create table if not exists agentic_rag_sources (
+    source_name varchar not null,
+    url varchar not null,
+    chunk_count integer not null default 0,
+    updated_at timestamp with time zone default timezone('utc'::text, now()) not null,
+    primary key (source_name, url)
+);
+
+insert into agentic_rag_sources (source_name, url, chunk_count)
+select source_name, url, count(*) from agentic_rag group by source_name, url
+on conflict (source_name, url) do update set chunk_count = excluded.chunk_count, updated_at = now();
+
+alter table agentic_rag_sources enable row level security;
+
+drop policy if exists "Allow public read access" on agentic_rag_sources;
+create policy "Allow public read access"
+  on agentic_rag_sources
+  for select
+  to public
+  using (true);
+
+commit;
@@ -11,7 +11,7 @@ create table agentic_rag (
     summary varchar not null,
     content text not null,  -- Added content column
     -- metadata jsonb not null default '{}'::jsonb,  -- Added metadata column
-    embedding vector(1536),  -- OpenAI embeddings are 1536 dimensions
+    embedding vector(768),  -- text-embedding-004 embeddings are 768 dimensions
     created_at timestamp with time zone default timezone('utc'::text, now()) not null,
     
     -- Add a unique constraint to prevent duplicate chunks for the same source_name
@@ -26,7 +26,7 @@ create index on agentic_rag using ivfflat (embedding vector_cosine_ops);
 
 -- Create a function to search for documentation chunks
 create or replace function match_agentic_rag (
-  query_embedding vector(1536),
+  query_embedding vector(768),
   source_names varchar(50)[] default NULL,
   urls varchar(200)[] default NULL,
   match_count int default 10
@@ -63,11 +63,22 @@ begin
     source_names is null or cardinality(source_names) = 0 or source_name = any(source_names)
     or
     urls is null or cardinality(urls) = 0 or url = any(urls)
-  order by agentic_rag.embedding <=> query_embedding desc
+  -- <=> is the cosine distance, the most similar chunks first
+  order by agentic_rag.embedding <=> query_embedding
   limit match_count;
 end;
 $$;
 
+-- The distinct sources and urls of agentic_rag, with their chunk counts, kept up to date by load_text_doc
+-- so the questions are routed without scanning every chunk
+create table agentic_rag_sources (
+    source_name varchar not null,
+    url varchar not null,
+    chunk_count integer not null default 0,
+    updated_at timestamp with time zone default timezone('utc'::text, now()) not null,
+    primary key (source_name, url)
+);
+
 -- Everything above will work for any PostgreSQL database. The below commands are for Supabase security
 
 -- Enable RLS on the table
@@ -78,4 +89,12 @@ create policy "Allow public read access"
   on agentic_rag
   for select
   to public
-  using (true);
\ No newline at end of file
+  using (true);
+
+alter table agentic_rag_sources enable row level security;
+
+create policy "Allow public read access"
+  on agentic_rag_sources
+  for select
+  to public
+  using (true);
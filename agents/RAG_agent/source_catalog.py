@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+
+
+main_logger = logging.getLogger('main')
+
+## Seconds the catalog is cached in process, the loads of this process invalidate it right away
+SOURCE_CATALOG_TTL = float(os.getenv("SOURCE_CATALOG_TTL", "300"))
+
+
+@dataclass
+class SourceEntry:
+    urls: Dict[str, int] = field(default_factory=dict)    # url -> chunks
+
+    @property
+    def chunk_count(self) -> int:
+        return sum(self.urls.values())
+
+
+class SourceCatalog:
+    """ The sources of the knowledge base, with their urls and chunk counts, for routing the questions.
+
+        Read from the `agentic_rag_sources` table that `load_text_doc` keeps up to date, or from the local vector
+        engine when it is the backend, instead of scanning every chunk. Cached for `ttl` seconds; the loads made
+        by this process invalidate it, the ones of other workers show up once it expires.
+    """
+
+    def __init__(self, ttl: float = SOURCE_CATALOG_TTL):
+        self.ttl = ttl
+        self._sources: Optional[Dict[str, SourceEntry]] = None
+        self._loaded_at = 0.0
+        self._version = 0
+        self._lock = threading.Lock()
+        self.metrics = {"hits": 0, "loads": 0, "invalidations": 0}
+
+    def _fetch_rows(self) -> List[dict]:
+        from .etl import get_supabase
+        from .vector_engine import RAG_VECTOR_BACKEND, get_vector_engine
+
+        if RAG_VECTOR_BACKEND == "local":
+            return get_vector_engine().catalog()
+        return get_supabase().table("agentic_rag_sources").select("source_name, url, chunk_count").execute().data
+
+    def sources(self) -> Dict[str, SourceEntry]:
+        sources = self._sources
+        if sources is not None and time.monotonic() - self._loaded_at < self.ttl:
+            self.metrics["hits"] += 1
+            return sources
+        with self._lock:
+            ## Loaded by another thread while this one waited
+            if self._sources is not None and time.monotonic() - self._loaded_at < self.ttl:
+                self.metrics["hits"] += 1
+                return self._sources
+            version = self._version
+            sources = {}
+            for row in self._fetch_rows():
+                sources.setdefault(row["source_name"], SourceEntry()).urls[row["url"]] = row["chunk_count"]
+            self.metrics["loads"] += 1
+            ## Not kept when it was invalidated while loading, it may miss the change
+            if version == self._version:
+                self._sources, self._loaded_at = sources, time.monotonic()
+            return sources
+
+    async def asources(self) -> Dict[str, SourceEntry]:
+        """The sources, read in a worker thread when they are not cached, so the event loop is not blocked."""
+        sources = self._sources
+        if sources is not None and time.monotonic() - self._loaded_at < self.ttl:
+            self.metrics["hits"] += 1
+            return sources
+        return await asyncio.to_thread(self.sources)
+
+    def urls(self, source_names: Sequence[str], sources: Optional[Dict[str, SourceEntry]] = None) -> List[str]:
+        sources = sources if sources is not None else self.sources()
+        return [url for source_name in source_names if source_name in sources for url in sources[source_name].urls]
+
+    def routing_prompt(self, sources: Optional[Dict[str, SourceEntry]] = None) -> str:
+        """The sources and their chunk counts, one per line, for the prompt choosing the sources of a question."""
+        sources = sources if sources is not None else self.sources()
+        return "\n".join(f'- "{source_name}": {entry.chunk_count} chunks from {len(entry.urls)} pages'
+                         for source_name, entry in sorted(sources.items()))
+
+    def invalidate(self) -> None:
+        self._version += 1
+        self._sources = None
+        self.metrics["invalidations"] += 1
+
+
+def register_chunks(source_name: str, url: str) -> None:
+    """Record the chunks of a url, counted again after they were loaded, in the catalog of the sources."""
+    from .etl import get_supabase
+
+    supabase = get_supabase()
+    chunk_count = (supabase.table("agentic_rag").select("id", count="exact", head=True)
+                    .eq("source_name", source_name).eq("url", url).execute().count)
+    supabase.table("agentic_rag_sources").upsert(
+        {"source_name": source_name, "url": url, "chunk_count": chunk_count},
+        on_conflict="source_name,url").execute()
+    get_source_catalog().invalidate()
+
+
+@lru_cache(maxsize=None)
+def get_source_catalog() -> SourceCatalog:
+    return SourceCatalog()
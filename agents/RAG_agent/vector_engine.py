@@ -0,0 +1,337 @@
+import hashlib
+import heapq
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from agents.persistence import SqliteConnectionPool
+from .vector_store import (ANN_INDEX_TYPES, EMBEDDING_DIMENSIONS, RAG_VECTOR_DTYPE, VectorStore, new_ann_index,
+                           strip_padding)
+
+
+main_logger = logging.getLogger('main')
+
+## Where query_database matches the chunks: "supabase" (the match_agentic_rag RPC) or "local" (this engine)
+RAG_VECTOR_BACKEND = os.getenv("RAG_VECTOR_BACKEND", "supabase")
+RAG_INDEX_DIR = os.getenv("RAG_INDEX_DIR", "media/rag-index")
+## Sources with at least this many chunks get an approximate index, RAG_ANN_INDEX (hnsw or ivf),
+## the smaller ones are searched exhaustively
+RAG_ANN_INDEX = os.getenv("RAG_ANN_INDEX", "hnsw")
+RAG_ANN_MIN_VECTORS = int(os.getenv("RAG_ANN_MIN_VECTORS", "10000"))
+## New chunks go to a small exhaustive delta index of their source, merged into its main index once the delta holds
+## RAG_DELTA_MERGE_RATIO of the chunks of the main one, and at least RAG_DELTA_MIN_VECTORS, so an add does not
+## rewrite the whole index of the source
+RAG_DELTA_MERGE_RATIO = float(os.getenv("RAG_DELTA_MERGE_RATIO", "0.1"))
+RAG_DELTA_MIN_VECTORS = int(os.getenv("RAG_DELTA_MIN_VECTORS", "1000"))
+## How often the searches look for the indexes written by other processes, such as the ETL, in seconds
+RAG_INDEX_REFRESH_SECONDS = float(os.getenv("RAG_INDEX_REFRESH_SECONDS", "1"))
+## How long a writer waits for the writer of another process, which may be building an approximate index
+RAG_INDEX_WRITE_TIMEOUT_SECONDS = float(os.getenv("RAG_INDEX_WRITE_TIMEOUT_SECONDS", "600"))
+## Keys per SQL statement, under the SQLite limit of variables
+SQL_BATCH_SIZE = 500
+
+CHUNK_FIELDS = ("id", "url", "chunk_number", "title", "summary", "content")
+
+
+class Partition:
+    """ The index of a source, as of a version of its row in `partitions`: the main index, and the delta taking the
+        newest chunks, whose positions follow the ones of the main index.
+    """
+
+    def __init__(self, main: VectorStore, delta: Optional[VectorStore], version: int):
+        self.main = main
+        self.delta = delta
+        self.version = version
+
+    def __len__(self) -> int:
+        return len(self.main) + (len(self.delta) if self.delta is not None else 0)
+
+    @property
+    def is_exhaustive(self) -> bool:
+        return self.main.is_exhaustive
+
+    def search(self, query: Sequence[Sequence[float]], top_k: int,
+               ids: Optional[Sequence[int]] = None) -> List[Tuple[int, float]]:
+        """The positions of the `top_k` nearest chunks with their similarity, among the positions `ids` when given."""
+        offset = len(self.main)
+        main_ids = delta_ids = None
+        if ids is not None:
+            main_ids = [position for position in ids if position < offset]
+            delta_ids = [position - offset for position in ids if position >= offset]
+        matches = []
+        if ids is None or main_ids:
+            matches.extend(self.main.search_many(query, top_k, ids=main_ids)[0])
+        if self.delta is not None and (ids is None or delta_ids):
+            matches.extend((offset + position, score)
+                           for position, score in self.delta.search_many(query, top_k, ids=delta_ids)[0])
+        return heapq.nlargest(top_k, matches, key=lambda match: match[1])
+
+
+class LocalVectorEngine:
+    """ The chunks of the knowledge base, searched in process instead of through the Supabase RPC.
+
+        One FAISS index per source_name, so a query only searches the sources it is about, each exhaustive or,
+        past RAG_ANN_MIN_VECTORS chunks, HNSW or IVF. The indexes are files memory mapped, so they are paged in
+        as they are searched. The chunks themselves are in SQLite next to them, by source and position in the
+        index, which also serves the url filters.
+
+        Writers of every process, the servers and the ETL, take turns in a `BEGIN IMMEDIATE` transaction of that
+        database: each one starts from the files of the source its row in `partitions` names, gets the positions
+        after them, writes new files and points the row to them. Files are never changed once written, so the
+        searches, which map the files of the rows again once their version changed, never see a half written index.
+    """
+
+    def __init__(self, directory: str = RAG_INDEX_DIR, dimensions: int = EMBEDDING_DIMENSIONS,
+                 dtype: str = RAG_VECTOR_DTYPE, ann_index: str = RAG_ANN_INDEX,
+                 ann_min_vectors: int = RAG_ANN_MIN_VECTORS, delta_merge_ratio: float = RAG_DELTA_MERGE_RATIO,
+                 delta_min_vectors: int = RAG_DELTA_MIN_VECTORS, refresh_seconds: float = RAG_INDEX_REFRESH_SECONDS):
+        if ann_index not in ANN_INDEX_TYPES:
+            raise ValueError(f"Unknown ANN index {ann_index}, expected one of {ANN_INDEX_TYPES}")
+        self.directory = directory
+        self.dimensions = dimensions
+        self.dtype = dtype
+        self.ann_index = ann_index
+        self.ann_min_vectors = ann_min_vectors
+        self.delta_merge_ratio = delta_merge_ratio
+        self.delta_min_vectors = delta_min_vectors
+        self.refresh_seconds = refresh_seconds
+        os.makedirs(directory, exist_ok=True)
+        self.pool = SqliteConnectionPool(os.path.join(directory, "chunks.sqlite3"), size=4,
+                                         busy_timeout_ms=int(RAG_INDEX_WRITE_TIMEOUT_SECONDS * 1000))
+        with self.pool.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    source_name TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    id INTEGER,
+                    url TEXT,
+                    chunk_number INTEGER,
+                    title TEXT,
+                    summary TEXT,
+                    content TEXT,
+                    PRIMARY KEY (source_name, position)
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS chunks_url ON chunks (source_name, url)")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS partitions (
+                    source_name TEXT PRIMARY KEY,
+                    file TEXT NOT NULL,
+                    delta_file TEXT,
+                    version INTEGER NOT NULL DEFAULT 0
+                )""")
+            ## Indexes written before the deltas and the versions, their single file is their main index
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(partitions)")}
+            if "version" not in columns:
+                connection.execute("ALTER TABLE partitions ADD COLUMN delta_file TEXT")
+                connection.execute("ALTER TABLE partitions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._partitions: Dict[str, Partition] = {}
+        ## Serializes the writers of the process, the transaction serializes them with the other processes
+        self._write_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshed_at = float("-inf")
+        self.load()
+
+    def _file(self, source_name: str, version: int, delta: bool = False) -> str:
+        name = hashlib.sha256(source_name.encode()).hexdigest()[:32]
+        return f"{name}-{version}.delta.faiss" if delta else f"{name}-{version}.faiss"
+
+    def _open(self, file: str, delta_file: Optional[str], version: int) -> Partition:
+        main = VectorStore.load(os.path.join(self.directory, file), self.dtype)
+        delta = VectorStore.load(os.path.join(self.directory, delta_file), "float32") if delta_file else None
+        return Partition(main, delta, version)
+
+    def load(self) -> None:
+        """Memory map the index of every source."""
+        self.refresh(force=True)
+        main_logger.info(f"Vector engine mapped {len(self._partitions)} sources, {len(self)} chunks, from {self.directory}")
+
+    def refresh(self, force: bool = False) -> None:
+        """ Map the indexes written since the last refresh, by this process or another one. At most once per
+            `refresh_seconds` unless forced, and the callers that find another refresh running keep the partitions
+            they have.
+        """
+        now = time.monotonic()
+        if not force and now - self._refreshed_at < self.refresh_seconds:
+            return
+        if not self._refresh_lock.acquire(blocking=force):
+            return
+        try:
+            self._refreshed_at = now
+            with self.pool.connection() as connection:
+                rows = connection.execute("SELECT source_name, file, delta_file, version FROM partitions").fetchall()
+            partitions = {}
+            for source_name, file, delta_file, version in rows:
+                current = self._partitions.get(source_name)
+                if current is not None and current.version == version:
+                    partitions[source_name] = current
+                    continue
+                try:
+                    partitions[source_name] = self._open(file, delta_file, version)
+                except RuntimeError as e:
+                    ## Its files were replaced by a writer since the row was read, the next refresh maps the new ones
+                    main_logger.warning(f"Vector engine could not map the index of {source_name}: {e}")
+                    self._refreshed_at = float("-inf")
+                    if current is not None:
+                        partitions[source_name] = current
+            self._partitions = partitions
+        finally:
+            self._refresh_lock.release()
+
+    def __len__(self) -> int:
+        self.refresh()
+        return sum(len(partition) for partition in self._partitions.values())
+
+    def source_names(self) -> List[str]:
+        self.refresh()
+        return sorted(self._partitions)
+
+    def catalog(self) -> List[dict]:
+        """The chunks per source and url, as rows of agentic_rag_sources."""
+        with self.pool.connection() as connection:
+            rows = connection.execute(
+                "SELECT source_name, url, COUNT(*) FROM chunks GROUP BY source_name, url").fetchall()
+        return [{"source_name": source_name, "url": url, "chunk_count": chunk_count}
+                for source_name, url, chunk_count in rows]
+
+    def add(self, rows: Sequence[dict]) -> None:
+        """Add chunks, rows of agentic_rag with their embedding, to the indexes of their sources."""
+        by_source: Dict[str, List[dict]] = {}
+        for row in rows:
+            by_source.setdefault(row["source_name"], []).append(row)
+        with self._write_lock:
+            for source_name, source_rows in by_source.items():
+                self._add_to_source(source_name, source_rows)
+
+    def _add_to_source(self, source_name: str, rows: List[dict]) -> None:
+        embeddings = np.array([strip_padding(row["embedding"], self.dimensions) for row in rows], dtype=np.float32)
+        replaced = []
+        with self.pool.transaction() as connection:
+            ## Holds the write lock of the database until the commit, so the positions follow the chunks of the
+            ## files the row names, whichever process wrote them
+            row = connection.execute("SELECT file, delta_file, version FROM partitions WHERE source_name = ?",
+                                     (source_name,)).fetchone()
+            if row is None:
+                file, delta_file, version, start = None, None, 1, 0
+                main = self._merged(source_name, None, embeddings)
+            else:
+                file, delta_file, version = row[0], row[1], row[2] + 1
+                current = self._partitions.get(source_name)
+                if current is None or current.version != row[2]:
+                    current = self._open(file, delta_file, row[2])
+                start = len(current)
+                delta_vectors = np.vstack([current.delta.vectors(), embeddings]) if current.delta is not None else embeddings
+                if len(delta_vectors) < max(self.delta_min_vectors, self.delta_merge_ratio * len(current.main)):
+                    main = None
+                    delta = VectorStore(self.dimensions, "float32")
+                    delta.add(delta_vectors)
+                    replaced.append(delta_file)
+                    delta_file = self._file(source_name, version, delta=True)
+                    delta.save(os.path.join(self.directory, delta_file))
+                else:
+                    main = self._merged(source_name, current.main, delta_vectors)
+                    replaced.extend([file, delta_file])
+                    delta_file = None
+            if main is not None:
+                file = self._file(source_name, version)
+                main.save(os.path.join(self.directory, file))
+            connection.executemany(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(source_name, start + i, *(row.get(field) for field in CHUNK_FIELDS)) for i, row in enumerate(rows)])
+            connection.execute("INSERT OR REPLACE INTO partitions (source_name, file, delta_file, version) VALUES (?, ?, ?, ?)",
+                               (source_name, file, delta_file, version))
+        ## The processes that mapped the replaced files keep their mapping, the others map the new files
+        self._remove(replaced)
+        try:
+            self._partitions = {**self._partitions, source_name: self._open(file, delta_file, version)}
+        except RuntimeError as e:
+            ## A writer of another process replaced them since the commit, the next refresh maps its files
+            main_logger.warning(f"Vector engine could not map the index of {source_name}: {e}")
+            self._refreshed_at = float("-inf")
+
+    def _merged(self, source_name: str, main: Optional[VectorStore], vectors: np.ndarray) -> VectorStore:
+        """A new main index of the source, with the vectors of `main` and then `vectors`."""
+        count = (len(main) if main is not None else 0) + len(vectors)
+        if (main is None or main.is_exhaustive) and count >= self.ann_min_vectors:
+            ## Big enough for an approximate index, built from the vectors so far and the new ones
+            main_logger.info(f"Building a {self.ann_index} index of {count} chunks for {source_name}")
+            if main is not None:
+                vectors = np.vstack([main.vectors(), vectors])
+            merged = VectorStore(self.dimensions, self.dtype,
+                                 index=new_ann_index(self.ann_index, len(vectors), self.dimensions, self.dtype))
+        else:
+            merged = main.copy() if main is not None else VectorStore(self.dimensions, self.dtype)
+        merged.add(vectors)
+        return merged
+
+    def _remove(self, files: Sequence[Optional[str]]) -> None:
+        for file in files:
+            if file:
+                try:
+                    os.remove(os.path.join(self.directory, file))
+                except FileNotFoundError:
+                    pass
+
+    def _positions(self, source_name: str, urls: Sequence[str]) -> List[int]:
+        positions = []
+        with self.pool.connection() as connection:
+            for i in range(0, len(urls), SQL_BATCH_SIZE):
+                batch = list(urls[i:i + SQL_BATCH_SIZE])
+                positions.extend(position for position, in connection.execute(
+                    f"SELECT position FROM chunks WHERE source_name = ? AND url IN ({', '.join('?' * len(batch))})",
+                    (source_name, *batch)))
+        return positions
+
+    def search(self, query_embedding: Sequence[float], source_names: Optional[Sequence[str]] = None,
+               urls: Optional[Sequence[str]] = None, match_count: int = 10) -> List[dict]:
+        """ The `match_count` chunks most similar to the query, as rows of match_agentic_rag, among the chunks of
+            `source_names` and of `urls` when given.
+        """
+        self.refresh()
+        partitions = self._partitions
+        if source_names:
+            partitions = {name: partitions[name] for name in source_names if name in partitions}
+        query = [strip_padding(query_embedding, self.dimensions)]
+        matches = []
+        for source_name, partition in partitions.items():
+            ids = None
+            if urls:
+                ids = self._positions(source_name, urls)
+                if not ids:
+                    continue
+            matches.extend((score, source_name, position)
+                           for position, score in partition.search(query, match_count, ids=ids))
+        best = heapq.nlargest(match_count, matches)
+        return self._rows(best)
+
+    def _rows(self, matches: List[tuple]) -> List[dict]:
+        rows = []
+        with self.pool.connection() as connection:
+            for score, source_name, position in matches:
+                row = connection.execute(f"SELECT {', '.join(CHUNK_FIELDS)} FROM chunks WHERE source_name = ? AND position = ?",
+                                         (source_name, position)).fetchone()
+                if row is not None:
+                    rows.append({"source_name": source_name, **dict(zip(CHUNK_FIELDS, row)), "similarity": score})
+        return rows
+
+    def clear(self) -> None:
+        with self._write_lock:
+            with self.pool.transaction() as connection:
+                files = [file for row in connection.execute("SELECT file, delta_file FROM partitions") for file in row]
+                connection.execute("DELETE FROM chunks")
+                connection.execute("DELETE FROM partitions")
+            self._remove(files)
+            self._partitions = {}
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+@lru_cache(maxsize=None)
+def get_vector_engine() -> LocalVectorEngine:
+    """The engine of the process, its indexes mapped on first use."""
+    return LocalVectorEngine()
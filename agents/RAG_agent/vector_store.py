@@ -0,0 +1,184 @@
+import logging
+import math
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+
+main_logger = logging.getLogger('main')
+
+## Dimensions of the text-embedding-004 vectors, stored as they come from the model
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "768"))
+## How the in-process indexes store the vectors: float32, float16 (half the size) or int8 (a quarter)
+RAG_VECTOR_DTYPE = os.getenv("RAG_VECTOR_DTYPE", "float16")
+VECTOR_DTYPES = ("float32", "float16", "int8")
+## The int8 range of each dimension is trained on the first vectors added, widened by this share of it,
+## so the vectors added later are not clipped
+INT8_RANGE_MARGIN = 0.2
+## Smallest int8 range of a dimension, in standard deviations of a random unit vector, for when the first
+## vectors are too few to tell the range
+INT8_MIN_RANGE_DEVIATIONS = 4
+## Approximate indexes, for the sources too big to search exhaustively
+ANN_INDEX_TYPES = ("hnsw", "ivf")
+RAG_HNSW_M = int(os.getenv("RAG_HNSW_M", "32"))
+RAG_HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", "80"))
+RAG_HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", "128"))
+## Lists of an IVF index per square root of its vectors, and lists searched per query
+RAG_IVF_LISTS_PER_SQRT = float(os.getenv("RAG_IVF_LISTS_PER_SQRT", "1"))
+## Training vectors FAISS wants per IVF list
+IVF_TRAINING_PER_LIST = 39
+RAG_IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "16"))
+
+
+def as_vectors(embeddings: Sequence[Sequence[float]] | np.ndarray) -> np.ndarray:
+    """The embeddings as a contiguous float32 matrix, normalized so inner products are cosine similarities."""
+    vectors = np.array(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def strip_padding(embedding: Sequence[float], dimensions: int = EMBEDDING_DIMENSIONS) -> List[float]:
+    """The native vector of an embedding zero padded to a wider column, which is left as is if it has no padding."""
+    if len(embedding) > dimensions and not any(embedding[dimensions:]):
+        return list(embedding[:dimensions])
+    return list(embedding)
+
+
+def quantizer_type(dtype: str) -> Optional[int]:
+    """The FAISS scalar quantizer storing the vectors as `dtype`, None for plain float32 vectors."""
+    if dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unknown vector dtype {dtype}, expected one of {VECTOR_DTYPES}")
+    return {"float16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}.get(dtype)
+
+
+def widen_int8_range(sq: faiss.ScalarQuantizer) -> None:
+    sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+    sq.rangestat_arg = INT8_RANGE_MARGIN
+
+
+def new_index(dimensions: int = EMBEDDING_DIMENSIONS, dtype: str = RAG_VECTOR_DTYPE) -> faiss.Index:
+    """An empty inner product index storing the vectors as `dtype`."""
+    qtype = quantizer_type(dtype)
+    if qtype is None:
+        return faiss.IndexFlatIP(dimensions)
+    index = faiss.IndexScalarQuantizer(dimensions, qtype, faiss.METRIC_INNER_PRODUCT)
+    if dtype == "int8":
+        widen_int8_range(index.sq)
+    return index
+
+
+def new_ann_index(kind: str, vectors_count: int, dimensions: int = EMBEDDING_DIMENSIONS,
+                  dtype: str = RAG_VECTOR_DTYPE) -> faiss.Index:
+    """An empty approximate inner product index, HNSW or IVF, sized for about `vectors_count` vectors."""
+    qtype = quantizer_type(dtype)
+    if kind == "hnsw":
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(dimensions, RAG_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWSQ(dimensions, qtype, RAG_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            if dtype == "int8":
+                widen_int8_range(faiss.downcast_index(index.storage).sq)
+        index.hnsw.efConstruction = RAG_HNSW_EF_CONSTRUCTION
+        return index
+    if kind == "ivf":
+        lists = max(1, min(int(RAG_IVF_LISTS_PER_SQRT * math.sqrt(vectors_count)), vectors_count // IVF_TRAINING_PER_LIST))
+        quantizer = faiss.IndexFlatIP(dimensions)
+        if qtype is None:
+            index = faiss.IndexIVFFlat(quantizer, dimensions, lists, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dimensions, lists, qtype, faiss.METRIC_INNER_PRODUCT)
+            if dtype == "int8":
+                widen_int8_range(index.sq)
+        return index
+    raise ValueError(f"Unknown ANN index {kind}, expected one of {ANN_INDEX_TYPES}")
+
+
+class VectorStore:
+    """ Normalized embedding vectors at their native dimensions, searched by cosine similarity.
+        The vectors are kept as float32, float16 or int8 codes, exhaustively searched, or in an HNSW or IVF index.
+        An int8 or IVF store is trained on its first vectors.
+    """
+
+    def __init__(self, dimensions: int = EMBEDDING_DIMENSIONS, dtype: str = RAG_VECTOR_DTYPE,
+                 index: Optional[faiss.Index] = None, path: Optional[str] = None):
+        self.dimensions = dimensions
+        self.dtype = dtype
+        self.index = index if index is not None else new_index(dimensions, dtype)
+        ## The file of a memory mapped index, which is read only, and read again to be changed
+        self.path = path
+
+    @property
+    def mmapped(self) -> bool:
+        return self.path is not None
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes taken by the stored vectors."""
+        return self.index.sa_code_size() * self.index.ntotal
+
+    @property
+    def is_exhaustive(self) -> bool:
+        return not isinstance(self.index, (faiss.IndexHNSW, faiss.IndexIVF))
+
+    def add(self, embeddings: Sequence[Sequence[float]] | np.ndarray) -> None:
+        if len(embeddings) == 0:
+            return
+        if self.mmapped:
+            raise ValueError("A memory mapped vector store is read only")
+        vectors = as_vectors(embeddings)
+        if not self.index.is_trained:
+            if self.is_exhaustive:
+                ## Symmetric ranges, at least the one a few random vectors would span
+                floor = np.full((1, self.dimensions), INT8_MIN_RANGE_DEVIATIONS / np.sqrt(self.dimensions), dtype=np.float32)
+                self.index.train(np.vstack([vectors, -vectors, floor, -floor]))
+            else:
+                self.index.train(vectors)
+        self.index.add(vectors)
+
+    def vectors(self) -> np.ndarray:
+        """The stored vectors, decoded, of an exhaustive store."""
+        return self.index.reconstruct_n(0, self.index.ntotal)
+
+    def search(self, embedding: Sequence[float], top_k: int) -> List[Tuple[int, float]]:
+        """The positions of the `top_k` nearest vectors, with their similarity, the nearest first."""
+        return self.search_many([embedding], top_k)[0]
+
+    def search_many(self, embeddings: Sequence[Sequence[float]] | np.ndarray, top_k: int,
+                    ids: Optional[Sequence[int]] = None) -> List[List[Tuple[int, float]]]:
+        """The nearest vectors of each embedding, among the positions `ids` only when given."""
+        selector = faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64)) if ids is not None else None
+        if isinstance(self.index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(RAG_HNSW_EF_SEARCH, top_k))
+        elif isinstance(self.index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=RAG_IVF_NPROBE)
+        else:
+            params = faiss.SearchParameters(sel=selector) if selector is not None else None
+        scores, found = self.index.search(as_vectors(embeddings), top_k, params=params)
+        return [[(int(i), float(score)) for i, score in zip(row_ids, row_scores) if i >= 0]
+                for row_ids, row_scores in zip(found, scores)]
+
+    def copy(self) -> "VectorStore":
+        """An in-memory copy that can be changed while this one is searched."""
+        ## A clone of a memory mapped index would still point into the mapping
+        index = faiss.read_index(self.path) if self.mmapped else faiss.clone_index(self.index)
+        return VectorStore(self.dimensions, self.dtype, index=index)
+
+    def save(self, path: str) -> None:
+        """Write the index to `path`, replacing the previous file atomically."""
+        temp_path = f"{path}.tmp"
+        faiss.write_index(self.index, temp_path)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str, dtype: str = RAG_VECTOR_DTYPE, mmap: bool = True) -> "VectorStore":
+        """The index at `path`, memory mapped and read only by default, so it is paged in as it is searched."""
+        if not mmap:
+            index = faiss.read_index(path)
+            return cls(index.d, dtype, index=index)
+        index = faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        return cls(index.d, dtype, index=index, path=path)
@@ -0,0 +1,42 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+
+from langchain_core.runnables import RunnableConfig
+
+
+def make_config(thread_id: str) -> RunnableConfig:
+    """Build a fresh per-invocation config, so concurrent turns never share the same dict."""
+    return {"configurable": {"thread_id": thread_id}}
+
+
+class ThreadLocks:
+    """ One asyncio lock per thread_id.
+
+        Turns of the same account are run one after the other, in arrival order,
+        while turns of different accounts run fully in parallel.
+        A lock is dropped as soon as no turn is holding or waiting on it.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiters: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str) -> AsyncIterator[None]:
+        lock = self._locks.setdefault(thread_id, asyncio.Lock())
+        self._waiters[thread_id] = self._waiters.get(thread_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[thread_id] -= 1
+            if self._waiters[thread_id] == 0:
+                self._waiters.pop(thread_id, None)
+                self._locks.pop(thread_id, None)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+thread_locks = ThreadLocks()
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import List
+
+from langchain_core.messages import BaseMessage, HumanMessage, RemoveMessage, SystemMessage
+from langchain_core.runnables import Runnable
+from langgraph.store.base import BaseStore
+
+
+main_logger = logging.getLogger('main')
+
+HISTORY_KEEP_MESSAGES = int(os.getenv("HISTORY_KEEP_MESSAGES", "12"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+HISTORY_SUMMARY_NAMESPACE = ("history_summaries",)
+
+
+def approximate_tokens(messages: List[BaseMessage]) -> int:
+    """Rough token count of the messages, ~4 characters per token, good enough for budgeting."""
+    return sum(len(str(message.content)) for message in messages) // 4
+
+
+def with_history(state: dict) -> dict:
+    """ Prompt inputs for a graph state: the running summary of the folded turns, if any,
+        followed by the turns that are still kept verbatim.
+    """
+    summary = state.get("history_summary")
+    if not summary:
+        return state
+    summary_message = SystemMessage(content=f"Summary of the earlier conversation: {summary}")
+    return {**state, "messages": [summary_message] + list(state.get("messages", []))}
+
+
+@dataclass
+class CompactedHistory:
+    messages: List[BaseMessage]       # messages kept verbatim
+    removals: List[RemoveMessage]     # state updates dropping the messages folded into the summary
+    summary: str
+    tokens_saved: int
+
+
+class HistoryCompactor:
+    """ Keeps the last turns of a conversation verbatim and folds the older ones into a running summary.
+
+        Compaction never blocks a turn: once the history goes over the token budget, the summary is
+        extended by a background task and persisted in the store, and the next turn drops the folded
+        messages from the state and uses the summary instead.
+    """
+
+    def __init__(self,
+                 store: BaseStore,
+                 summarizer: Runnable,
+                 keep_messages: int = HISTORY_KEEP_MESSAGES,
+                 token_budget: int = HISTORY_TOKEN_BUDGET):
+        self.store = store
+        self.summarizer = summarizer
+        self.keep_messages = keep_messages
+        self.token_budget = token_budget
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self.metrics = {"turns": 0, "summaries": 0, "failed_summaries": 0, "tokens_saved": 0}
+
+    async def _load(self, thread_id: str) -> dict:
+        item = await self.store.aget(HISTORY_SUMMARY_NAMESPACE, thread_id)
+        return item.value if item else {"summary": "", "folded_ids": [], "folded_tokens": 0}
+
+    async def compact(self, thread_id: str, messages: List[BaseMessage]) -> CompactedHistory:
+        record = await self._load(thread_id)
+        folded_ids = set(record["folded_ids"])
+        kept = [message for message in messages if message.id not in folded_ids]
+        removals = [RemoveMessage(id=message.id) for message in messages if message.id in folded_ids]
+
+        tokens_saved = max(record["folded_tokens"] - approximate_tokens([HumanMessage(content=record["summary"])]), 0)
+        self.metrics["turns"] += 1
+        self.metrics["tokens_saved"] += tokens_saved
+        main_logger.info(f"History of {thread_id}: {len(kept)} messages kept, {len(folded_ids)} summarized, "
+                         f"~{tokens_saved} prompt tokens saved this turn")
+
+        if approximate_tokens(kept) > self.token_budget and thread_id not in self._in_flight:
+            to_fold = self._messages_to_fold(kept)
+            if to_fold:
+                still_pending = [removal.id for removal in removals]
+                task = asyncio.create_task(self._fold(thread_id, record, to_fold, still_pending))
+                ## The event loop only keeps weak references to its tasks, this one is held until it is done
+                self._in_flight[thread_id] = task
+                task.add_done_callback(lambda done: self._fold_done(thread_id, done))
+
+        return CompactedHistory(messages=kept, removals=removals, summary=record["summary"], tokens_saved=tokens_saved)
+
+    def _messages_to_fold(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """Everything but the last `keep_messages`, cut at a human message so tool calls stay with their results."""
+        boundary = max(len(messages) - self.keep_messages, 0)
+        while boundary < len(messages) and not isinstance(messages[boundary], HumanMessage):
+            boundary += 1
+        return messages[:boundary] if boundary < len(messages) else []
+
+    async def _fold(self, thread_id: str, record: dict, to_fold: List[BaseMessage], still_pending: List[str]) -> None:
+        transcript = "\n".join(f"{message.type}: {message.content}" for message in to_fold if message.content)
+        try:
+            response = await self.summarizer.ainvoke({"summary": record["summary"] or "None", "transcript": transcript})
+        except Exception as e:
+            self.metrics["failed_summaries"] += 1
+            main_logger.error(f"Failed to summarize the history of {thread_id}: {e}")
+            return
+        ## Only the ids that may still be in the state need to be remembered, older ones were removed already
+        new_record = {
+            "summary": response.content,
+            "folded_ids": still_pending + [message.id for message in to_fold],
+            "folded_tokens": record["folded_tokens"] + approximate_tokens(to_fold),
+        }
+        await self.store.aput(HISTORY_SUMMARY_NAMESPACE, thread_id, new_record)
+        self.metrics["summaries"] += 1
+        main_logger.info(f"Folded {len(to_fold)} messages of {thread_id} into the running summary")
+
+    def _fold_done(self, thread_id: str, task: asyncio.Task) -> None:
+        """Forget the finished fold of a thread, and log the failures `_fold` did not handle, e.g. of the store."""
+        self._in_flight.pop(thread_id, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            self.metrics["failed_summaries"] += 1
+            main_logger.error(f"Failed to fold the history of {thread_id}: {error!r}")
+
+    async def drain(self) -> None:
+        """Wait for the in-flight summaries, e.g. before shutting down."""
+        await asyncio.gather(*self._in_flight.values(), return_exceptions=True)
+
+
+def summary_state_update(compacted: CompactedHistory) -> dict:
+    update = {"history_summary": compacted.summary}
+    if compacted.removals:
+        update["messages"] = compacted.removals
+    return update
@@ -0,0 +1,230 @@
+import fcntl
+import json
+import os
+import re
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Protocol
+
+import numpy as np
+
+
+main_logger = logging.getLogger('main')
+
+ROUTER_DECISION_LOG = os.getenv("ROUTER_DECISION_LOG", "log/router_decisions.jsonl")
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.75"))
+## Past this size the decision log is compacted to its newest decisions, down to ROUTER_DECISION_LOG_LOW_WATER of it
+ROUTER_DECISION_LOG_MAX_BYTES = int(os.getenv("ROUTER_DECISION_LOG_MAX_BYTES", str(4 * 1024 * 1024)))
+ROUTER_DECISION_LOG_LOW_WATER = 0.5
+## Logged turns are cut to this many characters, after their email addresses and long numbers are masked
+ROUTER_DECISION_LOG_MAX_TEXT = int(os.getenv("ROUTER_DECISION_LOG_MAX_TEXT", "200"))
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)+")
+## Phone, card and account numbers, with their usual separators
+NUMBER_PATTERN = re.compile(r"\+?\d[\d\s().-]{4,}\d")
+
+
+def redact(text: str, max_length: int = ROUTER_DECISION_LOG_MAX_TEXT) -> str:
+    """The text of a turn as it can be logged: emails and long numbers masked, at most `max_length` characters."""
+    text = NUMBER_PATTERN.sub("<number>", EMAIL_PATTERN.sub("<email>", text))
+    return text[:max_length]
+
+
+## ================= Router interface =================
+
+@dataclass
+class RouteDecision:
+    next_agent: Optional[str]
+    confidence: float
+
+
+class Router(Protocol):
+    """Anything that can pick the next agent for a user turn, before the supervisor LLM is consulted."""
+
+    def classify(self, text: str) -> RouteDecision:
+        ...
+
+    def record(self, text: str, next_agent: str) -> None:
+        ...
+
+
+## ================= Local keyword + embedding classifier =================
+
+DEFAULT_KEYWORDS = {
+    "receptionist_agent": [
+        "book", "booking", "meeting", "schedule", "reschedule", "appointment", "slot", "slots", "available",
+        "availability", "client", "clients", "email", "inquiry", "inquiries", "job", "jobs", "calendar",
+        "visit", "call", "phone", "create", "delete", "update",
+    ],
+    "rag_agent": [
+        "pdf", "document", "documents", "attachment", "attachments", "file", "files", "uploaded", "upload",
+        "resume", "summarize", "summary", "says", "contain", "contains", "knowledge", "database", "docs",
+        "documentation", "explain", "according",
+    ],
+}
+## Question words open the turns of every agent, they are no evidence for any of them
+QUESTION_WORDS = {"what", "which", "who", "whom", "when", "where", "why", "how"}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def hashed_embedding(text: str, dim: int = 512) -> np.ndarray:
+    """ Embed a text locally with feature hashing over word unigrams, bigrams and character trigrams.
+        The vector is L2 normalized, so a dot product is a cosine similarity.
+    """
+    tokens = tokenize(text)
+    features = tokens + [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+    for token in tokens:
+        padded = f"#{token}#"
+        features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in features:
+        digest = hashlib.md5(feature.encode()).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dim
+        sign = 1.0 if digest[4] & 1 else -1.0
+        vector[bucket] += sign
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class IntentRouter:
+    """ Routes a user turn to a sub-agent locally, using keyword hits and the cosine similarity
+        to per-agent centroids of hashed embeddings.
+
+        The centroids are trained from the sub-agent prompts and from the decisions the supervisor LLM
+        made in the past, which are appended to a JSONL decision log.
+    """
+
+    def __init__(self,
+                 training_texts: Dict[str, Iterable[str]],
+                 keywords: Dict[str, Iterable[str]] = None,
+                 decision_log_path: Optional[str] = ROUTER_DECISION_LOG,
+                 decision_log_max_bytes: int = ROUTER_DECISION_LOG_MAX_BYTES,
+                 dim: int = 512,
+                 keyword_weight: float = 0.5,
+                 temperature: float = 8.0):
+        self.labels = list(training_texts.keys())
+        self.keywords = {label: set(words) - QUESTION_WORDS for label, words in (keywords or DEFAULT_KEYWORDS).items()}
+        self.decision_log_path = decision_log_path
+        self.decision_log_max_bytes = decision_log_max_bytes
+        self.dim = dim
+        self.keyword_weight = keyword_weight
+        self.temperature = temperature
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._sums = {label: np.zeros(dim, dtype=np.float32) for label in self.labels}
+        self._counts = {label: 0 for label in self.labels}
+
+        for label, texts in training_texts.items():
+            for text in texts:
+                self._add_example(text, label)
+        self._load_decision_log()
+
+    def _add_example(self, text: str, label: str) -> None:
+        if label not in self._sums or not text.strip():
+            return
+        self._sums[label] += hashed_embedding(text, self.dim)
+        self._counts[label] += 1
+
+    def _load_decision_log(self) -> None:
+        if not self.decision_log_path or not os.path.exists(self.decision_log_path):
+            return
+        loaded = 0
+        with open(self.decision_log_path, "r") as decision_log:
+            for line in decision_log:
+                try:
+                    decision = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._add_example(decision.get("text", ""), decision.get("next_agent", ""))
+                loaded += 1
+        main_logger.info(f"Intent router trained on {loaded} logged decisions from {self.decision_log_path}")
+
+    def _keyword_scores(self, tokens: List[str]) -> np.ndarray:
+        hits = np.array([sum(token in self.keywords.get(label, ()) for token in tokens) for label in self.labels],
+                        dtype=np.float32)
+        total = hits.sum()
+        return hits / total if total > 0 else hits
+
+    def _embedding_scores(self, text: str) -> np.ndarray:
+        query = hashed_embedding(text, self.dim)
+        scores = []
+        for label in self.labels:
+            centroid = self._sums[label]
+            norm = np.linalg.norm(centroid)
+            scores.append(float(query @ centroid / norm) if norm > 0 else 0.0)
+        return np.array(scores, dtype=np.float32)
+
+    def classify(self, text: str) -> RouteDecision:
+        tokens = tokenize(text)
+        if not tokens:
+            return RouteDecision(next_agent=None, confidence=0.0)
+        with self._lock:
+            scores = self.keyword_weight * self._keyword_scores(tokens) \
+                + (1 - self.keyword_weight) * self._embedding_scores(text)
+        probabilities = np.exp(self.temperature * (scores - scores.max()))
+        probabilities /= probabilities.sum()
+        best = int(np.argmax(probabilities))
+        return RouteDecision(next_agent=self.labels[best], confidence=float(probabilities[best]))
+
+    def record(self, text: str, next_agent: str) -> None:
+        """ Learn from a decision made by the supervisor LLM, and persist it, redacted, for the next startup.
+            Writes to the log, call it off the event loop.
+        """
+        if next_agent not in self._sums:
+            return
+        with self._lock:
+            self._add_example(text, next_agent)
+        if not self.decision_log_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.decision_log_path) or ".", exist_ok=True)
+            with self._log_lock, self._locked_decision_log():
+                with open(self.decision_log_path, "a") as decision_log:
+                    decision_log.write(json.dumps({"text": redact(text), "next_agent": next_agent}) + "\n")
+                if os.path.getsize(self.decision_log_path) > self.decision_log_max_bytes:
+                    self._compact_decision_log()
+        except OSError as e:
+            main_logger.error(f"Failed to log routing decision: {e}")
+
+    @contextmanager
+    def _locked_decision_log(self):
+        """ Holds the lock of the log shared by the worker processes, so a compaction never drops the decisions
+            appended by another worker while it rewrites the log.
+        """
+        with open(f"{self.decision_log_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _compact_decision_log(self) -> None:
+        """Keep the newest decisions, the log is also what the next startup trains on."""
+        with open(self.decision_log_path, "rb") as decision_log:
+            lines = decision_log.readlines()
+        kept, size = [], 0
+        for line in reversed(lines):
+            size += len(line)
+            if size > self.decision_log_max_bytes * ROUTER_DECISION_LOG_LOW_WATER:
+                break
+            kept.append(line)
+        temp_path = f"{self.decision_log_path}.tmp"
+        with open(temp_path, "wb") as decision_log:
+            decision_log.writelines(reversed(kept))
+        os.replace(temp_path, self.decision_log_path)
+        main_logger.info(f"Compacted the router decision log to its {len(kept)} newest of {len(lines)} decisions")
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s*", text) if sentence.strip()]
@@ -0,0 +1,17 @@
+import logging
+import logging.config
+import os
+from functools import lru_cache
+
+import yaml
+
+
+@lru_cache(maxsize=None)
+def configure_logging(config_path: str = "config/logging.yml") -> None:
+    """Parse and apply the logging config, once per process."""
+    with open(config_path, "r") as logging_config_file:
+        logging_config = yaml.load(logging_config_file, Loader=yaml.FullLoader)
+    for handler in logging_config.get("handlers", {}).values():
+        if handler.get("filename"):
+            os.makedirs(os.path.dirname(handler["filename"]) or ".", exist_ok=True)
+    logging.config.dictConfig(logging_config)
@@ -0,0 +1,17 @@
+import os
+from functools import lru_cache
+
+from dotenv import load_dotenv
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+
+load_dotenv()
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+
+@lru_cache(maxsize=None)
+def get_chat_model(model: str = "gemini-2.0-flash-exp") -> ChatGoogleGenerativeAI:
+    """ Chat model client shared by all the agents, built on first use.
+        The client holds no per-call state, so the prompts and tool bindings are layered on top of it.
+    """
+    return ChatGoogleGenerativeAI(model=model, google_api_key=GEMINI_API_KEY)
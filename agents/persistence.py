@@ -0,0 +1,432 @@
+import asyncio
+import json
+import os
+import queue
+import random
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+)
+from langgraph.store.base import BaseStore, GetOp, Item, ListNamespacesOp, Op, PutOp, Result, SearchItem, SearchOp
+
+
+AGENT_STATE_DB = os.getenv("AGENT_STATE_DB", "media/agent-state/agent_state.sqlite3")
+AGENT_STATE_DB_POOL_SIZE = int(os.getenv("AGENT_STATE_DB_POOL_SIZE", "8"))
+## Checkpoints kept per thread and namespace, the older ones and their writes are deleted as new ones are saved
+AGENT_STATE_KEEP_CHECKPOINTS = int(os.getenv("AGENT_STATE_KEEP_CHECKPOINTS", "20"))
+
+
+## ================= Connection pool =================
+
+class SqliteConnectionPool:
+    """ A fixed size pool of SQLite connections in WAL mode.
+
+        WAL lets readers run concurrently with one writer, and the busy timeout makes writers of
+        other worker processes on the same host wait for the write lock instead of failing.
+    """
+
+    def __init__(self, path: str, size: int = AGENT_STATE_DB_POOL_SIZE, busy_timeout_ms: int = 10000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connections: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._connections.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                                     timeout=self.busy_timeout_ms / 1000)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        return connection
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connections.get()
+        try:
+            yield connection
+        finally:
+            self._connections.put(connection)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction, `BEGIN IMMEDIATE` takes the write lock upfront so it can't deadlock on an upgrade."""
+        with self.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def close(self) -> None:
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+@lru_cache(maxsize=None)
+def get_connection_pool(path: str = AGENT_STATE_DB) -> SqliteConnectionPool:
+    """Process wide pool, shared by the checkpointers and stores of all the graphs."""
+    return SqliteConnectionPool(path)
+
+
+## ================= Checkpointer =================
+
+class SqliteCheckpointSaver(BaseCheckpointSaver):
+    """ Durable LangGraph checkpointer on top of a pooled SQLite database,
+        safe to share between the graphs of a process and between worker processes on one host.
+        Only the last `keep` checkpoints of a thread and namespace are kept, with their writes.
+    """
+
+    def __init__(self, pool: SqliteConnectionPool, keep: int = AGENT_STATE_KEEP_CHECKPOINTS):
+        super().__init__()
+        self.pool = pool
+        self.keep = keep
+        with self.pool.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL DEFAULT '',
+                    checkpoint_id TEXT NOT NULL,
+                    parent_checkpoint_id TEXT,
+                    type TEXT,
+                    checkpoint BLOB,
+                    metadata_type TEXT,
+                    metadata BLOB,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS writes (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL DEFAULT '',
+                    checkpoint_id TEXT NOT NULL,
+                    task_id TEXT NOT NULL,
+                    task_path TEXT NOT NULL DEFAULT '',
+                    idx INTEGER NOT NULL,
+                    channel TEXT NOT NULL,
+                    type TEXT,
+                    value BLOB,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+                )""")
+
+    @staticmethod
+    def _config_keys(config: RunnableConfig) -> Tuple[str, str]:
+        configurable = config["configurable"]
+        return str(configurable["thread_id"]), configurable.get("checkpoint_ns", "")
+
+    def _load_tuple(self, connection: sqlite3.Connection, row: tuple) -> CheckpointTuple:
+        thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        writes = connection.execute(
+            "SELECT task_id, channel, type, value FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((value_type, value)))
+                            for task_id, channel, value_type, value in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id, checkpoint_ns = self._config_keys(config)
+        checkpoint_id = get_checkpoint_id(config)
+        with self.pool.connection() as connection:
+            if checkpoint_id:
+                row = connection.execute(
+                    "SELECT * FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = connection.execute(
+                    "SELECT * FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                    "ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+            return self._load_tuple(connection, row) if row else None
+
+    def list(self,
+             config: Optional[RunnableConfig],
+             *,
+             filter: Optional[dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None,
+             limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        query = "SELECT * FROM checkpoints"
+        conditions, params = [], []
+        if config is not None:
+            thread_id, checkpoint_ns = self._config_keys(config)
+            conditions += ["thread_id = ?", "checkpoint_ns = ?"]
+            params += [thread_id, checkpoint_ns]
+            if get_checkpoint_id(config):
+                conditions.append("checkpoint_id = ?")
+                params.append(get_checkpoint_id(config))
+        if before is not None and get_checkpoint_id(before):
+            conditions.append("checkpoint_id < ?")
+            params.append(get_checkpoint_id(before))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY checkpoint_id DESC"
+
+        ## Load everything before yielding, so a slow consumer never holds a pooled connection
+        checkpoint_tuples = []
+        with self.pool.connection() as connection:
+            for row in connection.execute(query, params).fetchall():
+                checkpoint_tuple = self._load_tuple(connection, row)
+                if filter and not all(checkpoint_tuple.metadata.get(k) == v for k, v in filter.items()):
+                    continue
+                checkpoint_tuples.append(checkpoint_tuple)
+                if limit is not None and len(checkpoint_tuples) >= limit:
+                    break
+        yield from checkpoint_tuples
+
+    def put(self,
+            config: RunnableConfig,
+            checkpoint: Checkpoint,
+            metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id, checkpoint_ns = self._config_keys(config)
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(metadata)
+        with self.pool.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], get_checkpoint_id(config),
+                 type_, serialized_checkpoint, metadata_type, serialized_metadata),
+            )
+            self._prune(connection, thread_id, checkpoint_ns)
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def _prune(self, connection: sqlite3.Connection, thread_id: str, checkpoint_ns: str) -> None:
+        """Delete the checkpoints older than the last `keep` ones of the thread and namespace, and their writes."""
+        row = connection.execute(
+            "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?",
+            (thread_id, checkpoint_ns, self.keep - 1),
+        ).fetchone()
+        if row is None:
+            return
+        for table in ("checkpoints", "writes"):
+            connection.execute(f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?",
+                               (thread_id, checkpoint_ns, row[0]))
+
+    def put_writes(self,
+                   config: RunnableConfig,
+                   writes: Sequence[Tuple[str, Any]],
+                   task_id: str,
+                   task_path: str = "") -> None:
+        thread_id, checkpoint_ns = self._config_keys(config)
+        checkpoint_id = get_checkpoint_id(config)
+        ## Special channels (errors, interrupts...) overwrite, regular writes are only stored once
+        verb = "INSERT OR REPLACE" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "INSERT OR IGNORE"
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, serialized_value = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, task_path,
+                         WRITES_IDX_MAP.get(channel, idx), channel, type_, serialized_value))
+        with self.pool.transaction() as connection:
+            connection.executemany(f"{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.pool.transaction() as connection:
+            connection.execute("DELETE FROM checkpoints WHERE thread_id = ?", (str(thread_id),))
+            connection.execute("DELETE FROM writes WHERE thread_id = ?", (str(thread_id),))
+
+    def get_next_version(self, current: Optional[str], channel: Any) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    ## SQLite calls are short and blocking, the async API runs them on the default executor
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self,
+                    config: Optional[RunnableConfig],
+                    *,
+                    filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None,
+                    limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        checkpoint_tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint_tuple in checkpoint_tuples:
+            yield checkpoint_tuple
+
+    async def aput(self,
+                   config: RunnableConfig,
+                   checkpoint: Checkpoint,
+                   metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self,
+                          config: RunnableConfig,
+                          writes: Sequence[Tuple[str, Any]],
+                          task_id: str,
+                          task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+## ================= Store =================
+
+class SqliteStore(BaseStore):
+    """ Durable LangGraph key-value store on top of a pooled SQLite database.
+        Values must be JSON serializable.
+    """
+
+    def __init__(self, pool: SqliteConnectionPool):
+        self.pool = pool
+        with self.pool.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS store (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )""")
+            ## Namespaces used to be joined on dots, which do not round-trip when a label has one
+            for namespace, in connection.execute("SELECT DISTINCT namespace FROM store WHERE namespace NOT LIKE '[%'").fetchall():
+                connection.execute("UPDATE store SET namespace = ? WHERE namespace = ?",
+                                   (self._namespace_key(tuple(namespace.split(".")) if namespace else ()), namespace))
+
+    @staticmethod
+    def _namespace_key(namespace: Tuple[str, ...]) -> str:
+        """The namespace as a JSON array, so any label round-trips and prefixes are prefixes of the text."""
+        return json.dumps(list(namespace))
+
+    @staticmethod
+    def _namespace(namespace_key: str) -> Tuple[str, ...]:
+        return tuple(json.loads(namespace_key))
+
+    @classmethod
+    def _row_to_item(cls, row: tuple, item_class=Item):
+        namespace, key, value, created_at, updated_at = row
+        return item_class(
+            namespace=cls._namespace(namespace),
+            key=key,
+            value=json.loads(value),
+            created_at=datetime.fromisoformat(created_at),
+            updated_at=datetime.fromisoformat(updated_at),
+        )
+
+    def _get(self, connection: sqlite3.Connection, op: GetOp) -> Optional[Item]:
+        row = connection.execute(
+            "SELECT * FROM store WHERE namespace = ? AND key = ?",
+            (self._namespace_key(op.namespace), op.key),
+        ).fetchone()
+        return self._row_to_item(row) if row else None
+
+    def _search(self, connection: sqlite3.Connection, op: SearchOp) -> List[SearchItem]:
+        if op.namespace_prefix:
+            prefix = self._namespace_key(op.namespace_prefix)
+            ## '["a", "b"]' is under the prefix '["a"]' as '["a", ...'
+            escaped_prefix = prefix[:-1].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            rows = connection.execute(
+                "SELECT * FROM store WHERE namespace = ? OR namespace LIKE ? ESCAPE '\\' ORDER BY updated_at DESC",
+                (prefix, escaped_prefix + ", %"),
+            ).fetchall()
+        else:
+            rows = connection.execute("SELECT * FROM store ORDER BY updated_at DESC").fetchall()
+        items = [self._row_to_item(row, SearchItem) for row in rows]
+        if op.filter:
+            items = [item for item in items if all(item.value.get(k) == v for k, v in op.filter.items())]
+        return items[op.offset:op.offset + op.limit]
+
+    def _put(self, connection: sqlite3.Connection, op: PutOp) -> None:
+        namespace = self._namespace_key(op.namespace)
+        if op.value is None:
+            connection.execute("DELETE FROM store WHERE namespace = ? AND key = ?", (namespace, op.key))
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        connection.execute(
+            "INSERT INTO store VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+            (namespace, op.key, json.dumps(op.value), now, now),
+        )
+
+    def _list_namespaces(self, connection: sqlite3.Connection, op: ListNamespacesOp) -> List[Tuple[str, ...]]:
+        namespaces = sorted({self._namespace(row[0]) for row in connection.execute("SELECT DISTINCT namespace FROM store")})
+        for condition in op.match_conditions or ():
+            path = tuple(condition.path)
+            namespaces = [
+                ns for ns in namespaces
+                if len(ns) >= len(path) and all(
+                    p in ("*", n) for p, n in zip(path, ns[:len(path)] if condition.match_type == "prefix" else ns[-len(path):])
+                )
+            ]
+        if op.max_depth is not None:
+            namespaces = sorted({ns[:op.max_depth] for ns in namespaces})
+        return namespaces[op.offset:op.offset + op.limit]
+
+    def update(self, namespace: Tuple[str, ...], key: str,
+               updater: Callable[[Optional[dict]], Optional[dict]]) -> Optional[dict]:
+        """ Replace the value of `key` by `updater(current value)` in one write transaction, so concurrent
+            updates from any worker process are serialized instead of overwriting each other. None deletes it.
+        """
+        with self.pool.transaction() as connection:
+            item = self._get(connection, GetOp(namespace, key))
+            value = updater(item.value if item else None)
+            self._put(connection, PutOp(namespace, key, value))
+        return value
+
+    def batch(self, ops: Iterable[Op]) -> List[Result]:
+        ops = list(ops)
+        results: List[Result] = []
+        writes = any(isinstance(op, PutOp) for op in ops)
+        with (self.pool.transaction() if writes else self.pool.connection()) as connection:
+            for op in ops:
+                if isinstance(op, GetOp):
+                    results.append(self._get(connection, op))
+                elif isinstance(op, SearchOp):
+                    results.append(self._search(connection, op))
+                elif isinstance(op, PutOp):
+                    self._put(connection, op)
+                    results.append(None)
+                elif isinstance(op, ListNamespacesOp):
+                    results.append(self._list_namespaces(connection, op))
+                else:
+                    raise ValueError(f"Unknown store operation: {op}")
+        return results
+
+    async def abatch(self, ops: Iterable[Op]) -> List[Result]:
+        return await asyncio.to_thread(self.batch, list(ops))
+
+
+@lru_cache(maxsize=None)
+def get_checkpointer() -> SqliteCheckpointSaver:
+    return SqliteCheckpointSaver(get_connection_pool())
+
+
+@lru_cache(maxsize=None)
+def get_store() -> SqliteStore:
+    return SqliteStore(get_connection_pool())
@@ -0,0 +1,195 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Awaitable, Callable, Optional
+
+from . import db
+
+
+main_logger = logging.getLogger('main')
+
+AVAILABILITY_CACHE_TTL = float(os.getenv("AVAILABILITY_CACHE_TTL", "60"))
+AVAILABILITY_CACHE_MAX_ENTRIES = int(os.getenv("AVAILABILITY_CACHE_MAX_ENTRIES", "1000"))
+## Follow the slots collection with a change stream to pick up the bookings made by other workers or tools.
+## Needs a replica set, without one the TTL bounds how stale an entry can get.
+AVAILABILITY_CACHE_WATCH = os.getenv("AVAILABILITY_CACHE_WATCH", "1") == "1"
+
+
+@dataclass
+class CachedAvailability:
+    free_times: list[str]       # sorted start times of the free slots
+    loaded_at: float = field(default_factory=time.monotonic)
+
+
+def page_of(times: list[str], from_time: Optional[str] = None, to_time: Optional[str] = None,
+            after: Optional[str] = None, limit: Optional[int] = None) -> list[str]:
+    """The same page `db.find_slot_times` would return, taken from a sorted list of start times."""
+    start = 0
+    if from_time:
+        start = max(start, bisect.bisect_left(times, from_time))
+    if after:
+        start = max(start, bisect.bisect_right(times, after))
+    end = bisect.bisect_left(times, to_time) if to_time else len(times)
+    return times[start:min(end, start + (limit or db.SLOTS_PAGE_SIZE))]
+
+
+class AvailabilityCache:
+    """ Free slot times per (account_id, booking_type), kept in process.
+
+        Bookings made through the receptionist update the cached entry in place (write-through), changes made
+        elsewhere are applied from the change stream of the slots collection, and every entry expires after
+        `ttl` seconds regardless. The least recently used entries are evicted past `max_entries`.
+    """
+
+    def __init__(self, ttl: float = AVAILABILITY_CACHE_TTL, max_entries: int = AVAILABILITY_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, CachedAvailability] = OrderedDict()
+        self._loading: dict[tuple, asyncio.Future] = {}
+        ## Loads of keys changed while they were running, their result may be stale, so it is neither cached
+        ## nor shared with the callers that come after the change
+        self._stale_loads: set[asyncio.Future] = set()
+        self._watcher: Optional[asyncio.Task] = None
+        ## Called with every change applied, for the other in-process views of the slots
+        self.listeners: list[Callable[[dict], None]] = []
+        self.metrics = {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0,
+                        "write_throughs": 0, "invalidations": 0}
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return self.metrics["hits"] / lookups if lookups else 0.0
+
+    def _changed(self, key: tuple) -> None:
+        if key in self._loading:
+            self._stale_loads.add(self._loading[key])
+
+    def _cached(self, key: tuple) -> Optional[CachedAvailability]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.loaded_at > self.ttl:
+            del self._entries[key]
+            self.metrics["expirations"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def free_times(self, account_id: str, booking_type: str,
+                         loader: Callable[[str, str], Awaitable[list[str]]] = None) -> list[str]:
+        """All the free start times of the account and booking type, loaded once for concurrent misses."""
+        self.ensure_watcher()
+        key = (account_id, booking_type)
+        entry = self._cached(key)
+        if entry is not None:
+            self.metrics["hits"] += 1
+            return entry.free_times
+        self.metrics["misses"] += 1
+
+        if key in self._loading and self._loading[key] not in self._stale_loads:
+            return await asyncio.shield(self._loading[key])
+        loader = loader or (lambda account_id, booking_type: db.all_slot_times(account_id, booking_type, is_booked=False))
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            free_times = sorted(await loader(account_id, booking_type))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            ## Only the callers waiting on the load should see the error
+            future.exception()
+            raise
+        finally:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+            is_stale = future in self._stale_loads
+            self._stale_loads.discard(future)
+        future.set_result(free_times)
+
+        if not is_stale:
+            self._entries[key] = CachedAvailability(free_times=free_times)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+        return free_times
+
+    async def page(self, account_id: str, booking_type: str, **filters) -> list[str]:
+        return page_of(await self.free_times(account_id, booking_type), **filters)
+
+    def mark_booked(self, account_id: str, booking_type: str, start_time: str) -> None:
+        key = (account_id, booking_type)
+        self._changed(key)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        ## Entries are replaced, not mutated, so a page handed out earlier never changes under its reader
+        i = bisect.bisect_left(entry.free_times, start_time)
+        if i < len(entry.free_times) and entry.free_times[i] == start_time:
+            entry.free_times = entry.free_times[:i] + entry.free_times[i + 1:]
+        self.metrics["write_throughs"] += 1
+
+    def mark_free(self, account_id: str, booking_type: str, start_time: str) -> None:
+        key = (account_id, booking_type)
+        self._changed(key)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        i = bisect.bisect_left(entry.free_times, start_time)
+        if i == len(entry.free_times) or entry.free_times[i] != start_time:
+            entry.free_times = entry.free_times[:i] + [start_time] + entry.free_times[i:]
+        self.metrics["write_throughs"] += 1
+
+    def invalidate(self, account_id: Optional[str] = None, booking_type: Optional[str] = None) -> None:
+        """Drop the entries of an account (and booking type), or every entry when no account is given."""
+        keys = [key for key in list(self._entries) + list(self._loading)
+                if account_id is None or (key[0] == account_id and booking_type in (None, key[1]))]
+        for key in keys:
+            self._changed(key)
+            self._entries.pop(key, None)
+        self.metrics["invalidations"] += 1
+
+    def apply_change(self, change: dict) -> None:
+        """Apply a change event of the slots collection."""
+        slot = change.get("fullDocument")
+        if change["operationType"] in ("insert", "update", "replace") and slot:
+            if slot["is_booked"]:
+                self.mark_booked(slot["account_id"], slot["booking_type"], slot["start_time"])
+            else:
+                self.mark_free(slot["account_id"], slot["booking_type"], slot["start_time"])
+        else:
+            ## A delete only carries the id of the slot, so the account is unknown
+            self.invalidate()
+        for listener in self.listeners:
+            listener(change)
+
+    def ensure_watcher(self) -> None:
+        if not AVAILABILITY_CACHE_WATCH or self._watcher is not None:
+            return
+        self._watcher = asyncio.get_running_loop().create_task(self._watch())
+
+    async def _watch(self) -> None:
+        try:
+            async with db.get_slots().watch(full_document="updateLookup") as stream:
+                main_logger.info("Following the slots collection to keep the availability cache fresh")
+                async for change in stream:
+                    self.apply_change(change)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            main_logger.warning(f"Availability cache is not following the slots collection, "
+                                f"entries are refreshed every {self.ttl}s instead: {e}")
+        ## The events missed while the stream was down are unknown
+        self.apply_change({"operationType": "invalidate"})
+
+
+@lru_cache(maxsize=None)
+def get_availability_cache() -> AvailabilityCache:
+    return AvailabilityCache()
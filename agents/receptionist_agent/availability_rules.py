@@ -0,0 +1,362 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from datetime import time as time_of_day
+from functools import lru_cache
+from typing import Iterator, Optional
+from zoneinfo import ZoneInfo
+
+from . import db
+from .availability_cache import get_availability_cache
+
+
+main_logger = logging.getLogger('main')
+
+## Timezone of the accounts that don't set one
+ACCOUNT_DEFAULT_TIMEZONE = os.getenv("ACCOUNT_DEFAULT_TIMEZONE", "America/New_York")
+## How long the rules and bookings of an account are kept in process, and how many accounts are
+AVAILABILITY_RULES_TTL = float(os.getenv("AVAILABILITY_RULES_TTL", "60"))
+AVAILABILITY_RULES_MAX_ENTRIES = int(os.getenv("AVAILABILITY_RULES_MAX_ENTRIES", "1000"))
+## How far ahead slots are offered, unless the rules of the account say otherwise
+AVAILABILITY_HORIZON_DAYS = int(os.getenv("AVAILABILITY_HORIZON_DAYS", "90"))
+## Duration of the bookings of the accounts without rules
+DEFAULT_BOOKING_DURATION = timedelta(hours=1)
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+## ================= Rules =================
+## Set on the account document, shared by both booking types unless a booking type overrides them:
+## "timezone": "Europe/London",
+## "availability": {
+##     "hours": {"mon": [["09:00", "17:00"]], ..., "sat": [["10:00", "13:00"]]},
+##     "exceptions": {"2030-12-25": [], "2030-12-24": [["09:00", "12:00"]]},
+##     "duration": 60, "buffer": 15, "horizon_days": 90,
+##     "inquiries": {"duration": 30, "buffer": 0}
+## }
+## Durations and buffers are in minutes, an exception replaces the hours of its date, an empty one closes it.
+
+@dataclass
+class BookingRules:
+    duration: timedelta
+    buffer: timedelta
+    hours: dict[int, list[tuple[time_of_day, time_of_day]]]     # weekday -> working windows
+    exceptions: dict[str, list[tuple[time_of_day, time_of_day]]]    # date -> windows replacing those of the weekday
+    horizon: timedelta
+
+
+def parse_windows(windows: list) -> list[tuple[time_of_day, time_of_day]]:
+    return sorted((time_of_day.fromisoformat(start), time_of_day.fromisoformat(end)) for start, end in windows)
+
+
+def account_timezone(account: Optional[dict]) -> ZoneInfo:
+    return ZoneInfo((account or {}).get("timezone") or ACCOUNT_DEFAULT_TIMEZONE)
+
+
+def rules_from_account(account: Optional[dict], booking_type: str) -> Optional[BookingRules]:
+    """The rules of a booking type of the account, None when the account books from materialized slots."""
+    availability = (account or {}).get("availability")
+    if not availability:
+        return None
+    settings = {key: value for key, value in availability.items() if key not in db.BOOKING_TYPES}
+    settings.update(availability.get(booking_type) or {})
+    return BookingRules(
+        duration=timedelta(minutes=settings.get("duration", 60)),
+        buffer=timedelta(minutes=settings.get("buffer", 0)),
+        hours={WEEKDAYS.index(weekday): parse_windows(windows) for weekday, windows in (settings.get("hours") or {}).items()},
+        exceptions={day: parse_windows(windows) for day, windows in (settings.get("exceptions") or {}).items()},
+        horizon=timedelta(days=settings.get("horizon_days", AVAILABILITY_HORIZON_DAYS)),
+    )
+
+
+class InvalidTime(ValueError):
+    """A time, e.g. from the model, that is neither a date (YYYY-MM-DD) nor a date and time (YYYY-MM-DD HH:MM)."""
+
+
+def parse_time(value: str) -> datetime:
+    """A date (YYYY-MM-DD, its midnight) or a date and time (YYYY-MM-DD HH:MM), in the timezone of the account."""
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError) as e:
+        raise InvalidTime(f"{value!r} is not a date (YYYY-MM-DD) or a date and time (YYYY-MM-DD HH:MM)") from e
+
+
+def exists_locally(moment: datetime, tz: ZoneInfo) -> bool:
+    """False for the wall times skipped when the clocks go forward."""
+    return moment.replace(tzinfo=tz).astimezone(timezone.utc).astimezone(tz).replace(tzinfo=None) == moment
+
+
+def day_slots(rules: BookingRules, day: date, tz: ZoneInfo) -> Iterator[datetime]:
+    """Start times of the slots of a day, every duration plus buffer from the start of each working window."""
+    windows = rules.exceptions.get(day.isoformat(), rules.hours.get(day.weekday(), []))
+    step = rules.duration + rules.buffer
+    for window_start, window_end in windows:
+        start, close = datetime.combine(day, window_start), datetime.combine(day, window_end)
+        while start + rules.duration <= close:
+            if exists_locally(start, tz):
+                yield start
+            start += step
+
+
+## ================= Interval index of the bookings =================
+
+class BookingIndex:
+    """ The bookings of an account and booking type as intervals sorted by start, so whether a slot overlaps one
+        is a binary search plus a look at the few bookings that start within the longest booking before it.
+    """
+
+    def __init__(self, intervals: list[tuple[datetime, datetime]] = ()):
+        intervals = sorted(intervals)
+        self.starts = [start for start, _ in intervals]
+        self.ends = [end for _, end in intervals]
+        self.longest = max((end - start for start, end in intervals), default=timedelta(0))
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def add(self, start: datetime, end: datetime) -> None:
+        i = bisect.bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            self.ends[i] = end
+        else:
+            self.starts.insert(i, start)
+            self.ends.insert(i, end)
+        self.longest = max(self.longest, end - start)
+
+    def remove(self, start: datetime) -> None:
+        i = bisect.bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            del self.starts[i]
+            del self.ends[i]
+
+    def overlaps(self, start: datetime, end: datetime) -> bool:
+        """Whether a booking overlaps [start, end)."""
+        i = bisect.bisect_left(self.starts, end) - 1
+        while i >= 0 and self.starts[i] + self.longest > start:
+            if self.ends[i] > start:
+                return True
+            i -= 1
+        return False
+
+
+def is_free(rules: BookingRules, bookings: BookingIndex, start: datetime, tz: ZoneInfo, calendar=None) -> bool:
+    """ Whether a slot starting at `start` keeps the buffer to the bookings on both sides,
+        and no event of the mirrored calendar overlaps it.
+    """
+    if bookings.overlaps(start - rules.buffer, start + rules.duration + rules.buffer):
+        return False
+    return calendar is None or not calendar.is_busy(start, start + rules.duration, tz)
+
+
+def free_slots(rules: BookingRules, bookings: BookingIndex, tz: ZoneInfo, now: datetime,
+               from_time: Optional[datetime] = None, to_time: Optional[datetime] = None,
+               after: Optional[datetime] = None, limit: int = db.SLOTS_PAGE_SIZE, calendar=None) -> list[str]:
+    """ The first `limit` free slots from `from_time` (inclusive) and after `after`, before `to_time`, computed from
+        the rules. Nothing before `now` or past the horizon of the rules is offered.
+    """
+    start = max(filter(None, (from_time, now)))
+    end = min(filter(None, (to_time, now + rules.horizon)))
+    slots = []
+    day = start.date()
+    while day <= end.date() and len(slots) < limit:
+        for slot in day_slots(rules, day, tz):
+            if slot < start or (after and slot <= after):
+                continue
+            if slot >= end or len(slots) == limit:
+                break
+            if is_free(rules, bookings, slot, tz, calendar):
+                slots.append(slot.strftime(db.SLOT_TIME_FORMAT))
+        day += timedelta(days=1)
+    return slots
+
+
+def nearest_free_slots(rules: BookingRules, bookings: BookingIndex, tz: ZoneInfo, now: datetime,
+                       desired: datetime, limit: int = db.SLOT_SUGGESTIONS,
+                       window: timedelta = timedelta(days=db.SLOT_SUGGESTIONS_WINDOW_DAYS), calendar=None) -> list[str]:
+    """The `limit` free slots nearest to the desired one within the window, before and after it, in order."""
+    later = free_slots(rules, bookings, tz, now, from_time=desired, to_time=desired + window, limit=limit + 1,
+                       calendar=calendar)
+    earlier = []
+    day = desired.date()
+    while day >= max(desired - window, now).date() and len(earlier) < limit:
+        earlier = [slot.strftime(db.SLOT_TIME_FORMAT) for slot in day_slots(rules, day, tz)
+                   if now <= slot < desired and is_free(rules, bookings, slot, tz, calendar)] + earlier
+        day -= timedelta(days=1)
+    desired_time = desired.strftime(db.SLOT_TIME_FORMAT)
+    return db.nearest_times(desired_time, earlier[-limit:], [slot for slot in later if slot != desired_time], limit)
+
+
+## ================= Rule based availability =================
+
+@dataclass
+class RuleAvailability:
+    timezone: ZoneInfo
+    rules: Optional[BookingRules]       # None when the account books from materialized slots
+    bookings: BookingIndex
+    loaded_at: float = field(default_factory=time.monotonic)
+
+    def now(self) -> datetime:
+        return datetime.now(self.timezone).replace(tzinfo=None)
+
+    @property
+    def duration(self) -> timedelta:
+        return self.rules.duration if self.rules else DEFAULT_BOOKING_DURATION
+
+
+class RuleBasedAvailability:
+    """ Free slots computed on the fly from the rules of the accounts, against an in-process index of their
+        bookings, so no slot has to be materialized.
+
+        The rules and bookings of an account and booking type are loaded once for concurrent misses, kept for
+        `ttl` seconds, updated in place by the bookings made here, and by the changes of the slots collection
+        followed by the availability cache. The least recently used entries are evicted past `max_entries`.
+    """
+
+    def __init__(self, ttl: float = AVAILABILITY_RULES_TTL, max_entries: int = AVAILABILITY_RULES_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, RuleAvailability] = OrderedDict()
+        self._loading: dict[tuple, asyncio.Future] = {}
+        ## Bumped on every change of a key, a load that ran across a change is neither cached nor shared
+        self._versions: dict[tuple, int] = {}
+        self._load_versions: dict[asyncio.Future, int] = {}
+        self._listening = False
+
+    def _listen(self) -> None:
+        if not self._listening:
+            get_availability_cache().listeners.append(self.apply_change)
+            self._listening = True
+
+    async def entry(self, account_id: str, booking_type: str) -> RuleAvailability:
+        self._listen()
+        key = (account_id, booking_type)
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.loaded_at <= self.ttl:
+            self._entries.move_to_end(key)
+            return entry
+
+        version = self._versions.get(key, 0)
+        loading = self._loading.get(key)
+        if loading is not None and self._load_versions.get(loading) == version:
+            return await asyncio.shield(loading)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        self._load_versions[future] = version
+        try:
+            entry = await self._load(account_id, booking_type)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+            raise
+        finally:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+            self._load_versions.pop(future, None)
+        future.set_result(entry)
+
+        if self._versions.get(key, 0) == version:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    async def _load(self, account_id: str, booking_type: str) -> RuleAvailability:
+        account = await db.get_accounts().find_one({"account_id": account_id},
+                                                   {"_id": 0, "timezone": 1, "availability": 1})
+        rules = rules_from_account(account, booking_type)
+        intervals = []
+        if rules is not None:
+            for booking in await db.booked_intervals(account_id, booking_type):
+                start = parse_time(booking["start_time"])
+                end = parse_time(booking["end_time"]) if booking.get("end_time") else start + rules.duration
+                intervals.append((start, end))
+        return RuleAvailability(timezone=account_timezone(account), rules=rules, bookings=BookingIndex(intervals))
+
+    def _changed(self, key: tuple) -> None:
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    async def page(self, account_id: str, booking_type: str, from_time: Optional[str] = None,
+                   to_time: Optional[str] = None, after: Optional[str] = None, limit: Optional[int] = None) -> list[str]:
+        """The same page `db.find_slot_times` would return, were the slots of the rules materialized."""
+        from .calendar_mirror import synced_calendar_mirror
+
+        calendar = await synced_calendar_mirror(required=False)
+        entry = await self.entry(account_id, booking_type)
+        return free_slots(entry.rules, entry.bookings, entry.timezone, entry.now(),
+                          from_time=parse_time(from_time) if from_time else None,
+                          to_time=parse_time(to_time) if to_time else None,
+                          after=parse_time(after) if after else None,
+                          limit=limit or db.SLOTS_PAGE_SIZE,
+                          calendar=calendar)
+
+    async def reserve(self, account_id: str, booking_type: str, start_time: str, client_email: str, title: str,
+                      location: str, suggestions: int = db.SLOT_SUGGESTIONS, calendar=None) -> dict:
+        """ Book the slot if the rules offer it and no booking or meeting of the synced `calendar` overlaps it, with
+            the same outcome as `db.reserve_or_suggest`. The free slots nearest to it are computed in process on conflict.
+        """
+        entry = await self.entry(account_id, booking_type)
+        rules, start = entry.rules, parse_time(start_time)
+        end = start + rules.duration
+        offered = start >= entry.now() and start in day_slots(rules, start.date(), entry.timezone)
+        if offered and is_free(rules, entry.bookings, start, entry.timezone, calendar):
+            slot = await db.insert_booking(account_id, booking_type, start_time, end.strftime(db.SLOT_TIME_FORMAT),
+                                           client_email, title, location)
+            if slot is not None:
+                self.mark_booked(account_id, booking_type, start, end)
+                return {"reserved": True, "slot": slot, "alternatives": []}
+            ## Booked by another worker since the bookings were loaded
+            self.invalidate(account_id, booking_type)
+            entry = await self.entry(account_id, booking_type)
+        slot = await db.find_slot(account_id, booking_type, start_time) if offered else None
+        alternatives = nearest_free_slots(rules, entry.bookings, entry.timezone, entry.now(), start, suggestions,
+                                          calendar=calendar)
+        return {"reserved": False, "slot": slot, "alternatives": alternatives}
+
+    def mark_booked(self, account_id: str, booking_type: str, start: datetime, end: Optional[datetime] = None) -> None:
+        key = (account_id, booking_type)
+        self._changed(key)
+        entry = self._entries.get(key)
+        if entry is not None and entry.rules is not None:
+            entry.bookings.add(start, end or start + entry.duration)
+
+    def mark_free(self, account_id: str, booking_type: str, start: datetime) -> None:
+        key = (account_id, booking_type)
+        self._changed(key)
+        entry = self._entries.get(key)
+        if entry is not None and entry.rules is not None:
+            entry.bookings.remove(start)
+
+    def invalidate(self, account_id: Optional[str] = None, booking_type: Optional[str] = None) -> None:
+        """Drop the entries of an account (and booking type), or every entry when no account is given."""
+        keys = [key for key in set(self._entries) | set(self._loading) | set(self._versions)
+                if account_id is None or (key[0] == account_id and booking_type in (None, key[1]))]
+        for key in keys:
+            self._changed(key)
+            self._entries.pop(key, None)
+
+    def apply_change(self, change: dict) -> None:
+        """Apply a change event of the slots collection."""
+        slot = change.get("fullDocument")
+        if change["operationType"] in ("insert", "update", "replace") and slot:
+            start = parse_time(slot["start_time"])
+            if slot["is_booked"]:
+                end = parse_time(slot["end_time"]) if slot.get("end_time") else None
+                self.mark_booked(slot["account_id"], slot["booking_type"], start, end)
+            else:
+                self.mark_free(slot["account_id"], slot["booking_type"], start)
+        else:
+            self.invalidate()
+
+
+@lru_cache(maxsize=None)
+def get_rule_availability() -> RuleBasedAvailability:
+    return RuleBasedAvailability()
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from .availability_rules import BookingIndex
+from .google_clients import GOOGLE_CALENDAR_ID, GOOGLE_TOKEN_FILE
+from .outbox import GOOGLE_API_FAKE
+
+
+main_logger = logging.getLogger('main')
+
+## Mirror the business calendar, so the slots taken by meetings added straight in Google Calendar are not offered
+CALENDAR_MIRROR = os.getenv("CALENDAR_MIRROR", "1") == "1"
+## Changes are fetched this often, and right away when Google pushes a notification of a change
+CALENDAR_MIRROR_POLL_SECONDS = float(os.getenv("CALENDAR_MIRROR_POLL_SECONDS", "30"))
+## Events that ended longer ago than this are not kept
+CALENDAR_MIRROR_PAST_DAYS = int(os.getenv("CALENDAR_MIRROR_PAST_DAYS", "1"))
+CALENDAR_MIRROR_MAX_BACKOFF_SECONDS = float(os.getenv("CALENDAR_MIRROR_MAX_BACKOFF_SECONDS", "300"))
+## Longest a booking waits on the first sync of the mirror, before it no slot is known to be busy
+CALENDAR_MIRROR_READY_TIMEOUT = float(os.getenv("CALENDAR_MIRROR_READY_TIMEOUT", "5"))
+## Private extended property of the events the receptionist books, naming their account. These bookings are in the
+## slots of their account already, and the calendar is shared by the accounts, so the mirror does not keep them
+BOOKING_ACCOUNT_PROPERTY = "receptionist_account_id"
+
+
+class SyncTokenExpired(Exception):
+    """The sync token is no longer valid (410 Gone), everything has to be fetched again."""
+
+
+class CalendarNotReady(Exception):
+    """The first sync of the mirror is not done, the meetings of the calendar are not known yet."""
+
+
+def parse_event_time(value: dict, calendar_timezone: ZoneInfo) -> datetime:
+    if "dateTime" in value:
+        moment = datetime.fromisoformat(value["dateTime"])
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=ZoneInfo(value.get("timeZone") or calendar_timezone.key))
+        return moment.astimezone(timezone.utc)
+    ## All day events run from the midnight of their first day to the midnight after their last one
+    return datetime.combine(date.fromisoformat(value["date"]), datetime.min.time(), calendar_timezone).astimezone(timezone.utc)
+
+
+def is_booking_event(event: dict) -> bool:
+    """Whether the event is a booking the receptionist delivered, rather than a meeting of the business."""
+    return BOOKING_ACCOUNT_PROPERTY in event.get("extendedProperties", {}).get("private", {})
+
+
+def event_interval(event: dict, calendar_timezone: ZoneInfo) -> Optional[tuple[datetime, datetime]]:
+    """ The UTC interval the event keeps the calendar busy, None for the cancelled events, the ones shown as free
+        and the bookings of the receptionist.
+    """
+    if event.get("status") == "cancelled" or event.get("transparency") == "transparent" or is_booking_event(event):
+        return None
+    if "start" not in event or "end" not in event:
+        return None
+    return parse_event_time(event["start"], calendar_timezone), parse_event_time(event["end"], calendar_timezone)
+
+
+## ================= Sources =================
+
+class GoogleCalendarSource:
+    """The events of a calendar, all of them or the ones changed since a sync token."""
+
+    def __init__(self, calendar_id: str = GOOGLE_CALENDAR_ID):
+        self.calendar_id = calendar_id
+
+    def changes(self, sync_token: Optional[str]) -> tuple[list[dict], str, Optional[str]]:
+        """Returns the events, the next sync token and the timezone of the calendar."""
+        from googleapiclient.errors import HttpError
+        from .google_clients import get_google_clients
+
+        events = get_google_clients().calendar().events()
+        params = {"calendarId": self.calendar_id, "singleEvents": True, "maxResults": 2500}
+        if sync_token:
+            params["syncToken"] = sync_token
+        else:
+            since = datetime.now(timezone.utc) - timedelta(days=CALENDAR_MIRROR_PAST_DAYS)
+            params["timeMin"] = since.isoformat()
+        items = []
+        while True:
+            try:
+                response = events.list(**params).execute()
+            except HttpError as e:
+                if e.resp.status == 410:
+                    raise SyncTokenExpired() from e
+                raise
+            items.extend(response.get("items", []))
+            if "nextPageToken" not in response:
+                return items, response["nextSyncToken"], response.get("timeZone")
+            params["pageToken"] = response["nextPageToken"]
+
+
+class FakeCalendarSource:
+    """ Stands in for the Calendar API: a change log of the events, sync tokens are positions in it, and the
+        tokens older than `expire_before` are answered as Google does once a token expired.
+    """
+
+    def __init__(self, calendar_timezone: str = "UTC"):
+        self.calendar_timezone = calendar_timezone
+        self._lock = threading.Lock()
+        self._events: dict[str, dict] = {}
+        self._log: list[str] = []
+        self.expire_before = 0
+        self.items_served = 0
+
+    def put_event(self, event: dict) -> None:
+        with self._lock:
+            self._events[event["id"]] = event
+            self._log.append(event["id"])
+
+    def cancel_event(self, event_id: str) -> None:
+        self.put_event({"id": event_id, "status": "cancelled"})
+
+    def expire_tokens(self) -> None:
+        with self._lock:
+            self.expire_before = len(self._log)
+
+    def changes(self, sync_token: Optional[str]) -> tuple[list[dict], str, Optional[str]]:
+        with self._lock:
+            if sync_token is None:
+                items = [event for event in self._events.values() if event.get("status") != "cancelled"]
+            elif int(sync_token) < self.expire_before:
+                raise SyncTokenExpired()
+            else:
+                changed = dict.fromkeys(self._log[int(sync_token):])
+                items = [self._events[event_id] for event_id in changed]
+            self.items_served += len(items)
+            return items, str(len(self._log)), self.calendar_timezone
+
+
+## ================= Mirror =================
+
+class CalendarMirror:
+    """ The busy intervals of the business calendar, kept in process by a polling thread.
+
+        The first sync fetches every upcoming event, the next ones only the events changed since the sync token
+        of the previous one, so the cost of keeping the mirror fresh follows the changes, not the calendar size.
+        Readers get an index of the busy intervals that is swapped, never changed, once a sync changed something.
+    """
+
+    def __init__(self, source, poll_seconds: float = CALENDAR_MIRROR_POLL_SECONDS):
+        self.source = source
+        self.poll_seconds = poll_seconds
+        self._events: dict[str, tuple[datetime, datetime]] = {}
+        self._sync_token: Optional[str] = None
+        self._calendar_timezone = ZoneInfo("UTC")
+        self._busy = BookingIndex()
+        self.synced_at: Optional[float] = None
+        self._synced = threading.Event()
+        self._lock = threading.Lock()
+        ## Separate from the lock of the syncs, so starting never waits on a sync
+        self._start_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.metrics = {"syncs": 0, "full_syncs": 0, "expired_tokens": 0, "changes": 0, "failures": 0}
+
+    @property
+    def ready(self) -> bool:
+        return self._synced.is_set()
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """Wait for the first sync without blocking the event loop, False if it is still not done after `timeout`."""
+        deadline = time.monotonic() + timeout
+        while not self.ready and time.monotonic() < deadline:
+            await asyncio.sleep(min(0.05, timeout))
+        return self.ready
+
+    def sync_once(self) -> int:
+        """Apply the changes since the last sync, everything the first time or once the token expired."""
+        with self._lock:
+            try:
+                items, sync_token, calendar_timezone = self.source.changes(self._sync_token)
+            except SyncTokenExpired:
+                main_logger.warning("Calendar sync token expired, mirroring the whole calendar again")
+                self.metrics["expired_tokens"] += 1
+                self._sync_token = None
+                items, sync_token, calendar_timezone = self.source.changes(None)
+            if calendar_timezone:
+                self._calendar_timezone = ZoneInfo(calendar_timezone)
+            if self._sync_token is None:
+                self._events.clear()
+                self.metrics["full_syncs"] += 1
+            for event in items:
+                interval = event_interval(event, self._calendar_timezone)
+                if interval is None:
+                    self._events.pop(event["id"], None)
+                else:
+                    self._events[event["id"]] = interval
+            self._sync_token = sync_token
+            if items or self.synced_at is None:
+                since = datetime.now(timezone.utc) - timedelta(days=CALENDAR_MIRROR_PAST_DAYS)
+                self._events = {event_id: (start, end) for event_id, (start, end) in self._events.items() if end > since}
+                self._busy = BookingIndex(list(self._events.values()))
+            self.synced_at = time.monotonic()
+            self._synced.set()
+            self.metrics["syncs"] += 1
+            self.metrics["changes"] += len(items)
+            return len(items)
+
+    def is_busy(self, start: datetime, end: datetime, tz: ZoneInfo) -> bool:
+        """Whether an event overlaps the wall times [start, end) of the timezone."""
+        return self._busy.overlaps(start.replace(tzinfo=tz).astimezone(timezone.utc),
+                                   end.replace(tzinfo=tz).astimezone(timezone.utc))
+
+    def free_times(self, times: list[str], tz: ZoneInfo, duration: timedelta, time_format: str) -> list[str]:
+        """The start times of slots of `duration` that no event overlaps."""
+        free = []
+        for start_time in times:
+            start = datetime.strptime(start_time, time_format)
+            if not self.is_busy(start, start + duration, tz):
+                free.append(start_time)
+        return free
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="calendar-mirror", daemon=True)
+                self._thread.start()
+
+    def notify(self) -> None:
+        """Sync now, e.g. on a push notification of Google."""
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                changes = self.sync_once()
+                failures = 0
+                if changes:
+                    main_logger.info(f"Calendar mirror applied {changes} changes, {len(self._events)} events mirrored")
+            except Exception as e:
+                failures += 1
+                self.metrics["failures"] += 1
+                main_logger.error(f"Calendar mirror sync failed: {e}")
+            delay = self.poll_seconds
+            if failures:
+                delay = min(CALENDAR_MIRROR_MAX_BACKOFF_SECONDS, self.poll_seconds * 2 ** failures) * random.uniform(0.5, 1)
+            self._wake.wait(delay)
+            self._wake.clear()
+
+
+@lru_cache(maxsize=None)
+def get_calendar_mirror() -> CalendarMirror:
+    return CalendarMirror(FakeCalendarSource() if GOOGLE_API_FAKE else GoogleCalendarSource())
+
+
+def active_calendar_mirror() -> Optional[CalendarMirror]:
+    """The mirror, started on first use, or None when it is disabled or there are no Google credentials to sync with."""
+    if not CALENDAR_MIRROR or not (GOOGLE_API_FAKE or os.path.exists(GOOGLE_TOKEN_FILE)):
+        return None
+    mirror = get_calendar_mirror()
+    mirror.start()
+    return mirror
+
+
+async def synced_calendar_mirror(required: bool = True, timeout: Optional[float] = None) -> Optional[CalendarMirror]:
+    """ The active mirror once its first sync is done, None when it is disabled. Until then the mirror is empty,
+        so a booking checked against it could take the slot of a meeting: the first sync is waited on for at most
+        `timeout` seconds (CALENDAR_MIRROR_READY_TIMEOUT by default), after which CalendarNotReady is raised, or None
+        returned when the mirror is not `required`.
+    """
+    timeout = CALENDAR_MIRROR_READY_TIMEOUT if timeout is None else timeout
+    mirror = active_calendar_mirror()
+    if mirror is None or await mirror.wait_ready(timeout):
+        return mirror
+    if required:
+        raise CalendarNotReady(f"The calendar mirror did not sync within {timeout}s")
+    main_logger.warning(f"The calendar mirror did not sync within {timeout}s, going on without it")
+    return None
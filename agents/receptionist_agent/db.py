@@ -0,0 +1,450 @@
+import csv
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Iterable, Optional
+
+import certifi
+from dotenv import load_dotenv
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+load_dotenv()
+
+main_logger = logging.getLogger('main')
+
+MONGODB_URI = os.getenv('MONGODB_URI')
+MONGODB_DATABASE = os.getenv('MONGODB_DATABASE', 'ai_receptionist')
+## Pool and timeouts of the shared client, every chat on the worker draws its connections from this pool
+MONGODB_MAX_POOL_SIZE = int(os.getenv('MONGODB_MAX_POOL_SIZE', '50'))
+MONGODB_MIN_POOL_SIZE = int(os.getenv('MONGODB_MIN_POOL_SIZE', '5'))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', '60000'))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', '2000'))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv('MONGODB_CONNECT_TIMEOUT_MS', '5000'))
+## Upper bound of a whole operation, retries included
+MONGODB_OPERATION_TIMEOUT_MS = int(os.getenv('MONGODB_OPERATION_TIMEOUT_MS', '10000'))
+## Accounts loaded into the in-process stand-in, used when MONGODB_URI is `mongomock://`
+MONGODB_SEED_FILE = os.getenv('MONGODB_SEED_FILE', 'agents/receptionist_agent/database.json')
+
+## Page size of the availability queries
+SLOTS_PAGE_SIZE = int(os.getenv('SLOTS_PAGE_SIZE', '20'))
+## Free slots suggested when the desired one is taken, and how far around it they are looked for
+SLOT_SUGGESTIONS = int(os.getenv('SLOT_SUGGESTIONS', '5'))
+SLOT_SUGGESTIONS_WINDOW_DAYS = int(os.getenv('SLOT_SUGGESTIONS_WINDOW_DAYS', '14'))
+## Clients upserted per bulk write by the imports
+CLIENTS_IMPORT_BATCH_SIZE = int(os.getenv('CLIENTS_IMPORT_BATCH_SIZE', '1000'))
+
+MOCK_URI_SCHEME = "mongomock://"
+SLOT_TIME_FORMAT = '%Y-%m-%d %H:%M'
+BOOKING_TYPES = ("jobs", "inquiries")
+SLOT_KEY = ("account_id", "booking_type", "start_time")
+DUPLICATE_KEY_ERROR = 11000
+SLOTS_INDEXES = [
+    ## Serves the availability queries and the reservation of a free slot
+    ([("account_id", ASCENDING), ("booking_type", ASCENDING), ("start_time", ASCENDING), ("is_booked", ASCENDING)],
+     {"name": "account_type_start_booked"}),
+    ## One slot per start time, also makes the migration idempotent
+    ([(key, ASCENDING) for key in SLOT_KEY], {"name": "unique_slot", "unique": True}),
+]
+CLIENT_KEY = ("account_id", "email")
+CLIENT_FIELDS = ("name", "email", "phone")
+CLIENTS_INDEXES = [
+    ## Lookups by email, one client per email and account, also makes the imports and the migration idempotent
+    ([(key, ASCENDING) for key in CLIENT_KEY], {"name": "unique_client_email", "unique": True}),
+    ## Lookups by phone number
+    ([("account_id", ASCENDING), ("phone", ASCENDING)], {"name": "account_phone"}),
+]
+
+
+def connect_to_db(uri: str):
+    """ Async client for the deployment, or an in-process stand-in seeded from MONGODB_SEED_FILE
+        when the uri is `mongomock://`, to run the agents offline.
+    """
+    if uri.startswith(MOCK_URI_SCHEME):
+        ## Optional dependency, only needed offline and in the tests
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError as e:
+            raise ImportError(f"{MOCK_URI_SCHEME} needs mongomock-motor, from requirements-dev.txt") from e
+        client = AsyncMongoMockClient()
+        seed_mock_db(client)
+        main_logger.info("Using the in-process MongoDB stand-in")
+        return client
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+    ## Motor connects lazily, on the first operation, and never blocks the event loop while doing so
+    return AsyncIOMotorClient(uri,
+                              tlsCAFile=certifi.where(),
+                              maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                              minPoolSize=MONGODB_MIN_POOL_SIZE,
+                              maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+                              waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+                              serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                              connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+                              timeoutMS=MONGODB_OPERATION_TIMEOUT_MS)
+
+
+def seed_mock_db(client) -> None:
+    if not MONGODB_SEED_FILE or not os.path.exists(MONGODB_SEED_FILE):
+        return
+    with open(MONGODB_SEED_FILE, 'r') as seed_file:
+        accounts = json.load(seed_file)
+    ## The stand-in is synchronous underneath, so it can be seeded before any event loop runs
+    database = client[MONGODB_DATABASE].delegate
+    for collection_name, indexes in (('slots', SLOTS_INDEXES), ('clients', CLIENTS_INDEXES)):
+        for keys, options in indexes:
+            database[collection_name].create_index(keys, **options)
+    for account_id, account in accounts.items():
+        account = {"account_id": account_id, **account}
+        for collection_name, documents in (('slots', slots_from_account(account)), ('clients', clients_from_account(account))):
+            if documents:
+                database[collection_name].insert_many(documents)
+        database['accounts'].insert_one({key: value for key, value in account.items()
+                                         if key not in BOOKING_TYPES and key != "clients"})
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    """The client shared by the whole process, connected on first use."""
+    if not MONGODB_URI:
+        raise RuntimeError("MONGODB_URI is not set")
+    return connect_to_db(MONGODB_URI)
+
+
+def get_accounts():
+    """The accounts collection."""
+    return get_client()[MONGODB_DATABASE]['accounts']
+
+
+def get_slots():
+    """The slots collection, one document per bookable slot."""
+    return get_client()[MONGODB_DATABASE]['slots']
+
+
+def get_clients():
+    """The clients collection, one document per client of an account."""
+    return get_client()[MONGODB_DATABASE]['clients']
+
+
+async def ensure_indexes() -> None:
+    for collection, indexes in ((get_slots(), SLOTS_INDEXES), (get_clients(), CLIENTS_INDEXES)):
+        for keys, options in indexes:
+            await collection.create_index(keys, **options)
+
+
+async def upsert_many(collection, upserts: list[tuple[dict, dict]]) -> tuple[int, int]:
+    """ Run the (filter, update) upserts in a single unordered bulk write.
+        Returns the number of documents inserted and modified.
+    """
+    if MONGODB_URI.startswith(MOCK_URI_SCHEME):
+        ## The stand-in's bulk_write does not take the write models of current pymongo versions
+        inserted, modified = 0, 0
+        for query, update in upserts:
+            result = await collection.update_one(query, update, upsert=True)
+            inserted += result.upserted_id is not None
+            modified += result.modified_count
+        return inserted, modified
+    result = await collection.bulk_write([UpdateOne(query, update, upsert=True) for query, update in upserts],
+                                         ordered=False)
+    return result.upserted_count, result.modified_count
+
+
+## ================= Clients =================
+## One document per client: account_id, name, email and phone, unique on (account_id, email).
+
+CLIENT_PROJECTION = {"_id": 0, "account_id": 0}
+
+
+async def find_client(account_id: str, email: Optional[str] = None, phone: Optional[str] = None) -> Optional[dict]:
+    """The first client of the account matching the email or the phone number."""
+    or_conditions = []
+    if email:
+        or_conditions.append({"email": email})
+    if phone:
+        or_conditions.append({"phone": phone})
+    if not or_conditions:
+        return None
+    return await get_clients().find_one({"account_id": account_id, "$or": or_conditions}, CLIENT_PROJECTION)
+
+
+async def add_client(account_id: str, name: Optional[str], email: str, phone: Optional[str]) -> bool:
+    """Add the client, False if the account already has a client with the email."""
+    try:
+        await get_clients().insert_one({"account_id": account_id, "name": name, "email": email, "phone": phone})
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def update_client(account_id: str, email: str, fields: dict) -> Optional[bool]:
+    """ Set the given fields (name, phone, email) of the client with the email, False if there is no such client,
+        None if the new email is the one of another client of the account.
+    """
+    try:
+        result = await get_clients().update_one({"account_id": account_id, "email": email}, {"$set": fields})
+    except DuplicateKeyError:
+        return None
+    return result.matched_count > 0
+
+
+async def delete_client(account_id: str, email: str) -> bool:
+    result = await get_clients().delete_one({"account_id": account_id, "email": email})
+    return result.deleted_count > 0
+
+
+## ================= Bulk import of clients =================
+
+def clients_from_csv(lines: Iterable[str]) -> Iterable[tuple[int, dict]]:
+    """ The (line number, client) rows of a CSV with a header row naming the `name`, `email` and `phone` columns,
+        in any order and case. Other columns are ignored, a row without an email is yielded with an empty one.
+    """
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None or "email" not in (name.strip().lower() for name in reader.fieldnames):
+        raise ValueError("The CSV needs a header row with at least an `email` column")
+    for row in reader:
+        row = {(key or "").strip().lower(): (value or "").strip() for key, value in row.items() if isinstance(value, str)}
+        yield reader.line_num, {field: row.get(field) or None for field in CLIENT_FIELDS}
+
+
+def client_upsert(client: dict) -> dict:
+    """The update of an import row: the fields it has are set, the ones it lacks are left as they are."""
+    update = {}
+    fields = {field: client[field] for field in ("name", "phone") if client.get(field) is not None}
+    if fields:
+        update["$set"] = fields
+    missing = {field: None for field in ("name", "phone") if field not in fields}
+    if missing:
+        update["$setOnInsert"] = missing
+    return update
+
+
+async def import_clients(account_id: str, rows: Iterable[tuple[int, dict]],
+                         batch_size: int = CLIENTS_IMPORT_BATCH_SIZE) -> dict:
+    """ Upsert the clients of the (line number, client) rows into the account, keyed on their email, one unordered
+        bulk write per batch. The rows are consumed as they come, so an import of any size runs in constant memory.
+        Returns the counts of rows read, clients inserted and updated, and the rejected rows by line number.
+    """
+    await ensure_indexes()
+    report = {"rows": 0, "inserted": 0, "updated": 0, "rejected": {}}
+    batch: dict[str, dict] = {}
+
+    async def flush():
+        ## Keyed on the email, so a client listed twice in a batch is written once, with its last row
+        upserts = [({"account_id": account_id, "email": email}, client_upsert(client)) for email, client in batch.items()]
+        batch.clear()
+        try:
+            inserted, modified = await upsert_many(get_clients(), upserts)
+        except BulkWriteError as e:
+            ## Two concurrent upserts of a new client both try to insert it, the loser matches it once retried
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+            inserted, modified = await upsert_many(get_clients(), [upserts[error["index"]] for error in e.details["writeErrors"]])
+            inserted += e.details["nUpserted"]
+            modified += e.details["nModified"]
+        report["inserted"] += inserted
+        report["updated"] += modified
+
+    for line_num, client in rows:
+        report["rows"] += 1
+        if not client.get("email") or "@" not in client["email"]:
+            report["rejected"][line_num] = "missing or invalid email"
+            continue
+        batch[client["email"]] = client
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+    main_logger.info(f"Imported the clients of account {account_id}: {report['rows']} rows, {report['inserted']} inserted, "
+                     f"{report['updated']} updated, {len(report['rejected'])} rejected")
+    return report
+
+
+## ================= Slots =================
+## One document per slot: account_id, booking_type (`jobs` or `inquiries`), start_time as `YYYY-MM-DD HH:MM`,
+## which sorts chronologically, is_booked, and client_email, title and location once booked.
+## The accounts with availability rules only have documents for their bookings, which also have an end_time.
+
+async def find_slot_times(account_id: str, booking_type: str, is_booked: bool,
+                          from_time: Optional[str] = None, to_time: Optional[str] = None,
+                          after: Optional[str] = None, limit: Optional[int] = None) -> list[str]:
+    """ Start times of the free (or booked) slots of a booking type, in order, one page at a time.
+        `from_time` is inclusive and `to_time` exclusive, either can be a date or a date and time.
+        `after` is the last start time of the previous page.
+    """
+    start_time_range = {}
+    if from_time:
+        start_time_range["$gte"] = from_time
+    if to_time:
+        start_time_range["$lt"] = to_time
+    if after:
+        start_time_range["$gt"] = after
+    limit = limit or SLOTS_PAGE_SIZE
+    query = {"account_id": account_id, "booking_type": booking_type, "is_booked": is_booked}
+    if start_time_range:
+        query["start_time"] = start_time_range
+    cursor = get_slots().find(query, {"_id": 0, "start_time": 1}).sort("start_time", 1).limit(limit)
+    return [slot["start_time"] for slot in await cursor.to_list(length=limit)]
+
+
+async def all_slot_times(account_id: str, booking_type: str, is_booked: bool) -> list[str]:
+    """Start times of all the free (or booked) slots of a booking type, in order."""
+    cursor = get_slots().find({"account_id": account_id, "booking_type": booking_type, "is_booked": is_booked},
+                              {"_id": 0, "start_time": 1}).sort("start_time", 1)
+    return [slot["start_time"] async for slot in cursor]
+
+
+async def find_slot(account_id: str, booking_type: str, start_time: str) -> Optional[dict]:
+    return await get_slots().find_one(
+        {"account_id": account_id, "booking_type": booking_type, "start_time": start_time},
+        {"_id": 0}
+    )
+
+
+async def reserve_slot(account_id: str, booking_type: str, start_time: str,
+                       client_email: str, title: str, location: str) -> bool:
+    """Book the slot if it is still free, in a single update, False if it is taken or does not exist."""
+    result = await get_slots().update_one(
+        {"account_id": account_id, "booking_type": booking_type, "start_time": start_time, "is_booked": False},
+        {"$set": {"is_booked": True, "client_email": client_email, "title": title, "location": location}}
+    )
+    return result.modified_count == 1
+
+
+async def booked_intervals(account_id: str, booking_type: str) -> list[dict]:
+    """Start and end times of the bookings of a booking type, the end is only stored for the bookings made from rules."""
+    cursor = get_slots().find({"account_id": account_id, "booking_type": booking_type, "is_booked": True},
+                              {"_id": 0, "start_time": 1, "end_time": 1})
+    return [slot async for slot in cursor]
+
+
+async def insert_booking(account_id: str, booking_type: str, start_time: str, end_time: str,
+                         client_email: str, title: str, location: str) -> Optional[dict]:
+    """ Book a slot that was not materialized, or a free one that was, None if the start time is already booked.
+        The unique slot index makes this atomic.
+    """
+    try:
+        slot = await get_slots().find_one_and_update(
+            {"account_id": account_id, "booking_type": booking_type, "start_time": start_time, "is_booked": False},
+            {"$set": {"is_booked": True, "end_time": end_time, "client_email": client_email, "title": title,
+                      "location": location}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return None
+    slot.pop("_id", None)
+    return slot
+
+
+def nearest_times(start_time: str, earlier: list[str], later: list[str], limit: int) -> list[str]:
+    """The `limit` start times closest to `start_time`, from the earlier ones (latest first) and the later ones, in order."""
+    desired = datetime.strptime(start_time, SLOT_TIME_FORMAT)
+    distance = lambda time: abs(datetime.strptime(time, SLOT_TIME_FORMAT) - desired)
+    return sorted(sorted(earlier + later, key=distance)[:limit])
+
+
+async def reserve_or_suggest(account_id: str, booking_type: str, start_time: str, client_email: str, title: str,
+                             location: str, suggestions: int = SLOT_SUGGESTIONS, now: Optional[datetime] = None) -> dict:
+    """ Book the slot if it is still free, in a single atomic update. When it is taken, or does not exist, one range
+        read of the slots index fetches the slot and the free slots after it, and a second the free slots before it,
+        only when the slot is not already booked by the same client. Only the slots from `now`, the wall time of the
+        account (read from its timezone when not given), are suggested.
+        Returns `reserved`, the `slot` (None if there is no such slot) and the `alternatives` start times.
+    """
+    if await reserve_slot(account_id, booking_type, start_time, client_email, title, location):
+        slot = {"account_id": account_id, "booking_type": booking_type, "start_time": start_time, "is_booked": True,
+                "client_email": client_email, "title": title, "location": location}
+        return {"reserved": True, "slot": slot, "alternatives": []}
+
+    if now is None:
+        from .availability_rules import account_timezone
+        account = await get_accounts().find_one({"account_id": account_id}, {"_id": 0, "timezone": 1})
+        now = datetime.now(account_timezone(account)).replace(tzinfo=None)
+    key = {"account_id": account_id, "booking_type": booking_type}
+    window = timedelta(days=SLOT_SUGGESTIONS_WINDOW_DAYS)
+    desired = datetime.strptime(start_time, SLOT_TIME_FORMAT)
+    ## Slots that already started are not suggested
+    earliest = max(desired - window, now).strftime(SLOT_TIME_FORMAT)
+    ## The slot sorts first, ahead of the free slots after it
+    cursor = get_slots().find({**key, "start_time": {"$gte": start_time,
+                                                     "$lte": (desired + window).strftime(SLOT_TIME_FORMAT)},
+                               "$or": [{"start_time": start_time}, {"is_booked": False, "start_time": {"$gte": earliest}}]},
+                              {"_id": 0}).sort("start_time", 1).limit(suggestions + 1)
+    found = [slot async for slot in cursor]
+    slot = found[0] if found and found[0]["start_time"] == start_time else None
+    if slot is not None and slot.get("client_email") == client_email:
+        return {"reserved": False, "slot": slot, "alternatives": []}
+    later = [found_slot["start_time"] for found_slot in found if found_slot is not slot][:suggestions]
+    cursor = get_slots().find({**key, "is_booked": False,
+                               "start_time": {"$gte": earliest, "$lt": start_time}},
+                              {"_id": 0, "start_time": 1}).sort("start_time", -1).limit(suggestions)
+    earlier = [found_slot["start_time"] async for found_slot in cursor]
+    return {"reserved": False, "slot": slot, "alternatives": nearest_times(start_time, earlier, later, suggestions)}
+
+
+## ================= Migration of the embedded slots and clients =================
+
+def slots_from_account(account: dict) -> list[dict]:
+    """The slots embedded in an account document, as documents of the slots collection."""
+    return [{**slot, "account_id": account["account_id"], "booking_type": booking_type}
+            for booking_type in BOOKING_TYPES
+            for slot in account.get(booking_type) or []]
+
+
+async def migrate_embedded_slots(batch_size: int = 500, keep_embedded: bool = False) -> tuple[int, int]:
+    """ Move the `jobs`/`inquiries` arrays of the account documents to the slots collection.
+        Slots are unique on (account_id, booking_type, start_time), so the migration can be re-run safely.
+        Returns the number of accounts and slots migrated.
+    """
+    await ensure_indexes()
+    migrated_accounts, migrated_slots = 0, 0
+    embedded = {"$or": [{booking_type: {"$exists": True}} for booking_type in BOOKING_TYPES]}
+    async for account in get_accounts().find(embedded, {"_id": 0, "account_id": 1, **{booking_type: 1 for booking_type in BOOKING_TYPES}}):
+        slots = slots_from_account(account)
+        for i in range(0, len(slots), batch_size):
+            try:
+                await get_slots().insert_many(slots[i:i + batch_size], ordered=False)
+            except BulkWriteError as e:
+                ## Slots already moved by an earlier run hit the unique index, anything else is a real failure
+                if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                    raise
+        if not keep_embedded:
+            await get_accounts().update_one({"account_id": account["account_id"]},
+                                            {"$unset": {booking_type: "" for booking_type in BOOKING_TYPES}})
+        migrated_accounts += 1
+        migrated_slots += len(slots)
+        main_logger.info(f"Migrated {len(slots)} slots of account {account['account_id']}")
+    return migrated_accounts, migrated_slots
+
+
+def clients_from_account(account: dict) -> list[dict]:
+    """The clients embedded in an account document, as documents of the clients collection."""
+    return [{"account_id": account["account_id"], **{field: client.get(field) for field in CLIENT_FIELDS}}
+            for client in account.get("clients") or [] if client.get("email")]
+
+
+async def migrate_embedded_clients(batch_size: int = 500, keep_embedded: bool = False) -> tuple[int, int]:
+    """ Move the `clients` arrays of the account documents to the clients collection.
+        Clients are unique on (account_id, email), so the migration can be re-run safely, and a client already
+        in the collection is left as it is. Returns the number of accounts and clients migrated.
+    """
+    await ensure_indexes()
+    migrated_accounts, migrated_clients = 0, 0
+    async for account in get_accounts().find({"clients": {"$exists": True}}, {"_id": 0, "account_id": 1, "clients": 1}):
+        clients = clients_from_account(account)
+        for i in range(0, len(clients), batch_size):
+            try:
+                await get_clients().insert_many(clients[i:i + batch_size], ordered=False)
+            except BulkWriteError as e:
+                if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                    raise
+        if not keep_embedded:
+            await get_accounts().update_one({"account_id": account["account_id"]}, {"$unset": {"clients": ""}})
+        migrated_accounts += 1
+        migrated_clients += len(clients)
+        main_logger.info(f"Migrated {len(clients)} clients of account {account['account_id']}")
+    return migrated_accounts, migrated_clients
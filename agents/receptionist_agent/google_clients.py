@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional
+
+import google_auth_httplib2
+import httplib2
+from google.auth.transport.requests import Request as GoogleRequest
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+
+main_logger = logging.getLogger('main')
+
+SCOPES = ['https://www.googleapis.com/auth/calendar','https://www.googleapis.com/auth/gmail.compose']
+GOOGLE_TOKEN_FILE = os.getenv("GOOGLE_TOKEN_FILE", 'agents/receptionist_agent/token.json')
+GOOGLE_CLIENT_SECRETS_FILE = os.getenv("GOOGLE_CLIENT_SECRETS_FILE", 'agents/receptionist_agent/credentials.json')
+## Calendar the bookings are added to, and mirrored from
+GOOGLE_CALENDAR_ID = os.getenv("GOOGLE_CALENDAR_ID", "primary")
+## Refresh the access token this long before it expires, so no request ever waits on a refresh
+GOOGLE_TOKEN_REFRESH_MARGIN = float(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", "300"))
+
+
+class GoogleAuthorizationError(RuntimeError):
+    """There is no token that can be refreshed, someone has to authorize the app in a browser."""
+
+    def __init__(self, token_file: str, reason: str):
+        super().__init__(f"{reason}, authorize the Google APIs with `python manage.py authorize_google` "
+                         f"to write {token_file}")
+
+
+@lru_cache(maxsize=None)
+def discovery_document(service_name: str, version: str) -> dict:
+    """The discovery document of an API, parsed once per process."""
+    document = get_static_doc(service_name, version)
+    if document is None:
+        raise ValueError(f"No discovery document for {service_name} {version}")
+    return json.loads(document)
+
+
+class GoogleClientManager:
+    """ Credentials and API services shared by the whole process.
+
+        The credentials are loaded once and refreshed by a background thread ahead of their expiry, and the
+        token file is only rewritten when the token changed. Services are built once per thread, from the
+        discovery documents parsed once, because their http transport can not be shared between threads.
+
+        The browser flow is never started from the requests, the outbox workers or the refresher: they raise
+        GoogleAuthorizationError when there is no usable token, and `authorize` is left to the
+        authorize_google management command.
+    """
+
+    def __init__(self,
+                 token_file: str = GOOGLE_TOKEN_FILE,
+                 client_secrets_file: str = GOOGLE_CLIENT_SECRETS_FILE,
+                 scopes: list[str] = SCOPES,
+                 refresh_margin: float = GOOGLE_TOKEN_REFRESH_MARGIN):
+        self.token_file = token_file
+        self.client_secrets_file = client_secrets_file
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self._lock = threading.RLock()
+        self._credentials: Optional[Credentials] = None
+        ## Bumped whenever the credentials object is replaced, services built with the previous one are rebuilt
+        self._generation = 0
+        self._saved_token: Optional[str] = None
+        self._local = threading.local()
+        self._refresher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._last_refresh_failed = False
+        self.metrics = {"refreshes": 0, "failed_refreshes": 0, "token_writes": 0, "services_built": 0}
+
+    def credentials(self) -> Credentials:
+        with self._lock:
+            if self._credentials is None:
+                self._load()
+            if not self._credentials.valid or self._expires_soon():
+                self._refresh()
+            self._start_refresher()
+            return self._credentials
+
+    def _load(self) -> None:
+        if os.path.exists(self.token_file):
+            with open(self.token_file, 'r') as token:
+                self._saved_token = token.read()
+            self._set_credentials(Credentials.from_authorized_user_info(json.loads(self._saved_token), self.scopes))
+        else:
+            raise GoogleAuthorizationError(self.token_file, f"No Google token at {self.token_file}")
+
+    def _set_credentials(self, credentials: Credentials) -> None:
+        self._credentials = credentials
+        self._generation += 1
+
+    def authorize(self, port: int = 0, open_browser: bool = True) -> Credentials:
+        """Run the browser flow of the OAuth consent and save the token, waiting on the user without the lock."""
+        flow = InstalledAppFlow.from_client_secrets_file(self.client_secrets_file, self.scopes)
+        credentials = flow.run_local_server(port=port, open_browser=open_browser)
+        with self._lock:
+            self._set_credentials(credentials)
+            self._save()
+            self._last_refresh_failed = False
+        return credentials
+
+    def _expires_soon(self) -> bool:
+        expiry = self._credentials.expiry
+        if expiry is None:
+            return False
+        ## google-auth keeps the expiry as a naive UTC datetime
+        return expiry - timedelta(seconds=self.refresh_margin) <= datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def _refresh(self) -> None:
+        if not self._credentials.refresh_token:
+            raise GoogleAuthorizationError(self.token_file, "The Google token has no refresh token")
+        try:
+            self._credentials.refresh(GoogleRequest())
+            self.metrics["refreshes"] += 1
+            self._last_refresh_failed = False
+        except Exception as e:
+            self.metrics["failed_refreshes"] += 1
+            self._last_refresh_failed = True
+            main_logger.error(f"Failed to refresh the Google credentials: {e}")
+            if not self._credentials.valid:
+                raise GoogleAuthorizationError(self.token_file, f"The Google token could not be refreshed ({e})")
+        self._save()
+
+    def _save(self) -> None:
+        token = self._credentials.to_json()
+        if token == self._saved_token:
+            return
+        with open(self.token_file, 'w') as token_file:
+            token_file.write(token)
+        self._saved_token = token
+        self.metrics["token_writes"] += 1
+
+    def _start_refresher(self) -> None:
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="google-token-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.is_set():
+            with self._lock:
+                expiry = self._credentials.expiry
+            if expiry is None:
+                delay = 3600
+            else:
+                refresh_at = expiry - timedelta(seconds=self.refresh_margin)
+                delay = max((refresh_at - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds(), 1)
+            ## A failed refresh is retried a minute later
+            self._wake.wait(60 if self._last_refresh_failed else delay)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            with self._lock:
+                if self._expires_soon():
+                    main_logger.info("Refreshing the Google credentials ahead of their expiry")
+                    try:
+                        self._refresh()
+                    except GoogleAuthorizationError as e:
+                        ## Retried a minute later, the callers get the error until the app is authorized again
+                        self._last_refresh_failed = True
+                        main_logger.error(str(e))
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def service(self, service_name: str, version: str):
+        """The service built for the calling thread, built on first use."""
+        credentials = self.credentials()
+        services = getattr(self._local, "services", None)
+        if services is None or self._local.generation != self._generation:
+            services = self._local.services = {}
+            self._local.generation = self._generation
+        if (service_name, version) not in services:
+            http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+            services[(service_name, version)] = build_from_document(discovery_document(service_name, version), http=http)
+            self.metrics["services_built"] += 1
+        return services[(service_name, version)]
+
+    def gmail(self):
+        return self.service('gmail', 'v1')
+
+    def calendar(self):
+        return self.service('calendar', 'v3')
+
+
+@lru_cache(maxsize=None)
+def get_google_clients() -> GoogleClientManager:
+    return GoogleClientManager()
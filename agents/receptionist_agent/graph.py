@@ -2,10 +2,8 @@ import asyncio
 import operator
 import os
 import json
-from dotenv import load_dotenv
 import logging
-import logging.config
-import yaml
+from functools import lru_cache
 from typing import Optional, TypedDict, Annotated, List, Union
 from langchain_core.agents import AgentAction, AgentFinish
 from langchain.agents.output_parsers.tools import ToolAgentAction
@@ -13,20 +11,20 @@ from langchain.agents.output_parsers.tools import ToolAgentAction
 from langchain_core.messages import ToolMessage, BaseMessage, AIMessage, HumanMessage, SystemMessage
 from langgraph.graph.message import add_messages
 
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from .tools import crud_client_tool, book_job_tool, book_inquiry_tool, send_email_tool, check_slot_availability_tool
 from langgraph.types import interrupt, Command
+from agents.concurrency import make_config, thread_locks
+from agents.streaming import STREAMING_TAG
+from agents.persistence import get_checkpointer, get_store
+from agents.history import with_history
+from agents.models import get_chat_model
+from .response_templates import render_responses
+from agents.logging_config import configure_logging
 
 
-load_dotenv()
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-with open("config/logging.yml", "r") as logging_config_file:
-    logging.config.dictConfig(yaml.load(logging_config_file, Loader=yaml.FullLoader))
-
 main_logger = logging.getLogger('main')
 
 ## ================= Declaring the state =================
@@ -38,15 +36,12 @@ class AgentState(TypedDict):
     intermediate_steps: list[AgentAction]
     last_tool_call: AgentAction
     responses: list
+    tool_results: list[dict]
     final_response: str
     is_interrupted: bool
     interrupt_queue: list[dict]
-
-config = {"configurable": {"thread_id": ""}}
-gemini_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
-response_synthesizer_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
-helper_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
-model = gemini_model
+    history_summary: str
+    awaiting_human: bool
 
 ## ================= Setting up the agent prompts =================
 
@@ -89,15 +84,29 @@ response_synthesizer_prompt = ChatPromptTemplate.from_messages([
 ## ================= Setting up the tools =================
 
 tools = [crud_client_tool, book_job_tool, book_inquiry_tool, send_email_tool, check_slot_availability_tool]
-# model = model.bind_tools(tools)
-receptionist_llm = (receptionist_agent_prompt | model.bind_tools(tools))
-helper_llm = (helper_agent_prompt | helper_model.bind_tools(tools))
-response_synthesizer_llm = (response_synthesizer_prompt | response_synthesizer_model)
 tools_by_name = {tool.name: tool for tool in tools}
 
+
+@lru_cache(maxsize=None)
+def get_receptionist_llm():
+    ## Not streamed, its text comes with the tool calls and is not the answer of the turn
+    return (receptionist_agent_prompt | get_chat_model().bind_tools(tools))
+
+
+@lru_cache(maxsize=None)
+def get_helper_llm():
+    ## Forced to call one of the tools, so an answer in prose never costs another round
+    return (helper_agent_prompt | get_chat_model().bind_tools(tools, tool_choice="any"))
+
+
+@lru_cache(maxsize=None)
+def get_response_synthesizer_llm():
+    ## The answer of the turns that ran tools and were not rendered from the templates
+    return (response_synthesizer_prompt | get_chat_model()).with_config(tags=[STREAMING_TAG])
+
 ## ================= Setting up the nodes =================
 
-async def agent_node(state: AgentState):
+async def agent_node(state: AgentState, config: RunnableConfig):
     print("\n\n\nReceptionist Agent node called")
     print(f"Intermediate steps @ BEGINNING of supervisor agent node: {state['intermediate_steps']}")
     print(f"Last tool call @ BEGINNING of supervisor agent node: {state['last_tool_call']}")
@@ -106,6 +115,9 @@ async def agent_node(state: AgentState):
         return {"responses": state["responses"]}
     elif state["intermediate_steps"] == [] and state["last_tool_call"] is not None:
         ## Finished running all tools
+        rendered_response = render_responses(state.get("tool_results", []), state["responses"])
+        if rendered_response is not None:
+            return {"final_response": rendered_response}
         responses = '\n'.join(state['responses'])
         messages = '\n'.join([message.content for message in state['messages']])
         prompt = (f"Here are the responses from the tools you have called: {responses}"
@@ -116,7 +128,7 @@ async def agent_node(state: AgentState):
             # "messages": state["messages"],
             "responses": state["responses"]
         }
-        helper_response = await response_synthesizer_llm.ainvoke(helper_agent_inputs, config)
+        helper_response = await get_response_synthesizer_llm().ainvoke(helper_agent_inputs, config)
         print("\n\n\n=========== Helper INVOKED ==========")
         print(f"Receptionist final response: {helper_response}")
         print('======================================================\n\n\n')
@@ -124,108 +136,246 @@ async def agent_node(state: AgentState):
         return {"final_response": helper_response}
     else:
         print(f"\n\n\nReceptionist Agent State: {state}\n\n\n")
-        response = await receptionist_llm.ainvoke(state, config)
+        response = await get_receptionist_llm().ainvoke(with_history(state), config)
         print(f"RECEPTIONIST AGENT INVOCATION OUTPUT: {response}\n\n\n")
-        agent_actions = {}
+        agent_actions = []
         desired_action_order = ["crud_client_tool", "check_slot_availability_tool", "book_inquiry_tool", "book_job_tool", "send_email_tool"]
         for tool_call in response.tool_calls:
             tool_call["args"]["account_id"] = state["account_id"]
-            agent_actions[tool_call["name"]] = ToolAgentAction(
+            agent_actions.append(ToolAgentAction(
                 tool=tool_call["name"],
                 tool_input=tool_call["args"], 
                 tool_call_id=tool_call["id"],
                 log=f"Adding {tool_call['name']} to intermediate steps",
                 message_log=state["messages"]
-            )
+            ))
             
-        agent_actions = [agent_actions[tool_name] for tool_name in desired_action_order if tool_name in agent_actions]
+        agent_actions = sorted(
+            [action for action in agent_actions if action.tool in desired_action_order],
+            key=lambda action: desired_action_order.index(action.tool)
+        )
         print(f"Intermediate steps ADDED by supervisor agent node: {agent_actions}")
         messages = [response] if response.content else []
         return {
             "intermediate_steps": agent_actions,
             "final_response": response.content,
             "messages": messages,
+            "tool_results": [],
+            "awaiting_human": False,
         }
 
 
-def run_tool(state: AgentState):
+## A tool call waits for the calls of the tools it depends on, from the same turn, to finish first.
+## e.g. a booking needs its client to be created, an availability check asked before a booking must not see it
+## half made, and an email may be about that booking.
+TOOL_DEPENDENCIES = {
+    "book_inquiry_tool": {"crud_client_tool", "check_slot_availability_tool"},
+    "book_job_tool": {"crud_client_tool", "check_slot_availability_tool"},
+    "send_email_tool": {"crud_client_tool", "book_inquiry_tool", "book_job_tool"},
+}
+
+
+def build_tool_dag(actions: List[ToolAgentAction]) -> List[set]:
+    """ For each action, the indexes of the earlier actions it has to wait for.
+        Calls of the same tool about the same client also keep their order.
+    """
+    dependencies = []
+    for i, action in enumerate(actions):
+        depends_on = set()
+        for j, earlier_action in enumerate(actions[:i]):
+            if earlier_action.tool in TOOL_DEPENDENCIES.get(action.tool, ()):
+                depends_on.add(j)
+            elif earlier_action.tool == action.tool \
+                    and earlier_action.tool_input.get("client_email") == action.tool_input.get("client_email"):
+                depends_on.add(j)
+        dependencies.append(depends_on)
+    return dependencies
+
+
+async def tool_executor(state: AgentState, config: RunnableConfig):
+    """ Run all the pending tool calls in one node, each wave of independent calls concurrently.
+
+        A call that needs the human is not resolved here: it is left at the front of the intermediate steps,
+        along with the calls depending on it, and routed to `run_tool` which owns the `interrupt()` flow. Its output
+        goes to the interrupt queue, so `run_tool` asks the question it already has instead of running it again.
+    """
+    actions = list(state["intermediate_steps"])
+    dependencies = build_tool_dag(actions)
+    done, needs_human = set(), set()
+    outputs = []
+    responses = list(state["responses"])
+    tool_results = list(state.get("tool_results", []))
+    last_tool_call = state.get("last_tool_call", None)
+    interrupted_outputs = {}
+
+    while True:
+        ready = [i for i in range(len(actions)) if i not in done and i not in needs_human and dependencies[i] <= done]
+        if not ready:
+            break
+        print(f"\n\n\n============== Running tools concurrently: {[actions[i].tool for i in ready]} ===============")
+        results = await asyncio.gather(
+            *(tools_by_name[actions[i].tool].ainvoke(input=actions[i].tool_input) for i in ready),
+            return_exceptions=True
+        )
+        for i, out in zip(ready, results):
+            if isinstance(out, BaseException):
+                raise out
+            print(f"OUT {actions[i].tool}: {out}")
+            if out.get("is_interrupted", False):
+                needs_human.add(i)
+                interrupted_outputs[i] = out
+                continue
+            done.add(i)
+            last_tool_call = actions[i]
+            responses.append(out["response"])
+            tool_results.append({"tool": actions[i].tool, "tool_input": actions[i].tool_input, "output": out})
+            outputs.append(
+                ToolMessage(
+                    content=json.dumps(out),
+                    name=actions[i].tool,
+                    tool_call_id=actions[i].tool_call_id
+                )
+            )
+
+    remaining = [actions[i] for i in sorted(needs_human)] \
+        + [action for i, action in enumerate(actions) if i not in done and i not in needs_human]
+    return {
+        "messages": outputs,
+        "intermediate_steps": remaining,
+        "last_tool_call": last_tool_call,
+        "responses": responses,
+        "tool_results": tool_results,
+        "awaiting_human": bool(needs_human),
+        "interrupt_queue": [{"tool_call_id": actions[i].tool_call_id, "output": interrupted_outputs[i]}
+                            for i in sorted(needs_human)],
+    }
+
+
+## ================= Interrupt resolution =================
+
+## Helper model calls to turn a human response into a tool call, and questions asked to the human per tool call
+INTERRUPT_MAX_ATTEMPTS = int(os.getenv("INTERRUPT_MAX_ATTEMPTS", "3"))
+INTERRUPT_MAX_QUESTIONS = int(os.getenv("INTERRUPT_MAX_QUESTIONS", "3"))
+## Seconds a helper model call may take before it counts as a failed attempt
+INTERRUPT_HELPER_TIMEOUT = float(os.getenv("INTERRUPT_HELPER_TIMEOUT", "20"))
+
+## Phases of the resolution of a tool call
+RUN_TOOL, ASK_HUMAN, RESOLVE, RUN_RESOLVED, DONE, GIVE_UP = "run_tool", "ask_human", "resolve", "run_resolved", "done", "give_up"
+
+## Across the interrupts of the process, each one is also logged with its own latency and attempts
+interrupt_metrics = {"interrupts": 0, "resolved": 0, "unresolved": 0, "helper_calls": 0, "timeouts": 0,
+                     "no_tool_call": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+
+async def resolve_interrupt(tool_name: str, tool_args: dict, question: str, human_response: str,
+                            state: AgentState, config: RunnableConfig) -> tuple[Optional[dict], int]:
+    """ The tool call answering the human response, from the helper model, which has to call a tool.
+        Gives up after INTERRUPT_MAX_ATTEMPTS calls, each bounded by INTERRUPT_HELPER_TIMEOUT.
+        Returns the tool call, None if there is none, and the number of attempts.
+    """
+    prompt = f"The tool call was for {tool_name} with arguments {tool_args}. The query was: {question}. The human has responded to the query with the following: {human_response}"
+    helper_agent_inputs = with_history({
+        "user_input": prompt,
+        "messages": state["messages"],
+        "history_summary": state.get("history_summary", "")
+    })
+    print(f"Helper agent prompt: {prompt}")
+    for attempt in range(1, INTERRUPT_MAX_ATTEMPTS + 1):
+        interrupt_metrics["helper_calls"] += 1
+        try:
+            helper_out = await asyncio.wait_for(get_helper_llm().ainvoke(helper_agent_inputs, config),
+                                                timeout=INTERRUPT_HELPER_TIMEOUT)
+        except asyncio.TimeoutError:
+            interrupt_metrics["timeouts"] += 1
+            main_logger.warning(f"Helper call {attempt} for {tool_name} timed out after {INTERRUPT_HELPER_TIMEOUT}s")
+            continue
+        print(f"Helper out tool calls: {helper_out.tool_calls}")
+        tool_calls = [tool_call for tool_call in helper_out.tool_calls if tool_call["name"] in tools_by_name]
+        if tool_calls:
+            return tool_calls[0], attempt
+        interrupt_metrics["no_tool_call"] += 1
+    return None, INTERRUPT_MAX_ATTEMPTS
+
+
+def record_interrupt(tool_name: str, attempts: int, latency: float, resolved: bool) -> None:
+    interrupt_metrics["interrupts"] += 1
+    interrupt_metrics["resolved" if resolved else "unresolved"] += 1
+    interrupt_metrics["latency_total"] += latency
+    interrupt_metrics["latency_max"] = max(interrupt_metrics["latency_max"], latency)
+    main_logger.info(f"Interrupt of {tool_name} {'resolved' if resolved else 'left unresolved'} after {attempts} "
+                     f"helper calls in {latency * 1000:.0f}ms")
+
+
+async def run_tool(state: AgentState, config: RunnableConfig):
+    """ Runs the call needing the human as a bounded state machine:
+        RUN_TOOL runs the call, ASK_HUMAN interrupts the graph with its question, RESOLVE turns the answer into a
+        tool call, RUN_RESOLVED runs it, then the original call is retried when the resolved call was another tool.
+        It gives up after INTERRUPT_MAX_QUESTIONS questions, or when the helper model finds no tool call.
+        A call the tool executor already ran starts at ASK_HUMAN, with its output from the interrupt queue.
+    """
     if state.get("intermediate_steps", [])[0] == state.get("last_tool_call", None):
         # return state
         return {"response": state["response"]}
     elif isinstance(state["intermediate_steps"], list) and state["intermediate_steps"] != []:
         action = state["intermediate_steps"][0]
-        original_tool_name = action.tool
-        original_tool_args = action.tool_input
-        out = {"is_interrupted": True}
         outputs = []
-        new_out = {}
-        while out.get("is_interrupted", False) or new_out.get("is_interrupted", False):
-            print(f"\n\n\n============== Running tool {original_tool_name} ===============")
-            print(f"Tool args: {original_tool_args}")
-            print('======================================================\n\n\n')
-            out = tools_by_name[original_tool_name].invoke(input=original_tool_args)
-            print(f"OUT: {out}")
-            outputs.append(
-                ToolMessage(
-                    content=json.dumps(out),
-                    name=original_tool_name,
-                    tool_call_id=action.tool_call_id
-                )
-            )
-            if out.get("is_interrupted", False):
-                state["interrupt_queue"].append({
-                    "tool_name": original_tool_name,
-                    "tool_args": original_tool_args,
-                    "reason": out["response"]
-                })
+        tool_results = list(state.get("tool_results", []))
+        ## The call the pending question is about, the original one or a call resolved from the human
+        tool_name, tool_args, tool_call_id = action.tool, action.tool_input, action.tool_call_id
+        phase, questions = RUN_TOOL, 0
+        interrupt_queue = list(state.get("interrupt_queue") or [])
+        if interrupt_queue and interrupt_queue[0]["tool_call_id"] == tool_call_id:
+            out = interrupt_queue.pop(0)["output"]
+            outputs.append(ToolMessage(content=json.dumps(out), name=tool_name, tool_call_id=tool_call_id))
+            phase = ASK_HUMAN
+        while phase not in (DONE, GIVE_UP):
+            print(f"Tool call of {action.tool}: {phase}")
+            if phase in (RUN_TOOL, RUN_RESOLVED):
+                out = await tools_by_name[tool_name].ainvoke(input=tool_args)
+                print(f"OUT: {out}")
+                outputs.append(ToolMessage(content=json.dumps(out), name=tool_name, tool_call_id=tool_call_id))
+                if out.get("is_interrupted", False):
+                    phase = ASK_HUMAN if questions < INTERRUPT_MAX_QUESTIONS else GIVE_UP
+                    continue
+                state["responses"].append(out["response"])
+                tool_results.append({"tool": tool_name, "tool_input": tool_args, "output": out})
+                if tool_name == action.tool:
+                    phase = DONE
+                else:
+                    ## Something the original call needed, e.g. the client it books for, try it again
+                    tool_name, tool_args, tool_call_id = action.tool, action.tool_input, action.tool_call_id
+                    phase = RUN_TOOL
+            elif phase == ASK_HUMAN:
+                questions += 1
                 human_response = interrupt(out["response"])
                 print(f"Human response: {human_response}")
-                helper_out = None
-                while not helper_out or helper_out.tool_calls == [] or state["interrupt_queue"] != []:
-                    print(f"Interrupt queue: {state['interrupt_queue']}")
-                    tool_name = state["interrupt_queue"][0]["tool_name"]
-                    tool_args = state["interrupt_queue"][0]["tool_args"]
-                    interrupt_reason = state["interrupt_queue"][0]["reason"]
-                    prompt = f"The tool call was for {tool_name} with arguments {tool_args}. The query was: {interrupt_reason}. The human has responded to the query with the following: {human_response}"
-                    helper_agent_inputs = {
-                        "user_input": prompt,
-                        "messages": state["messages"]
-                    }
-                    print(f"Helper agent prompt: {prompt}")
-                    helper_out = helper_llm.invoke(helper_agent_inputs, config)
-                    print("\n\n\n=========== Helper INVOKED ==========")
-                    print(f"Helper out: {helper_out.content}")
-                    print(f"Helper out tool calls: {helper_out.tool_calls}")
-                    print('======================================================\n\n\n')
-                    if helper_out.tool_calls != []:
-                        state["interrupt_queue"].pop(0)
-                new_tool_name = helper_out.tool_calls[0]["name"]
-                new_tool_args = helper_out.tool_calls[0]["args"]
-                print("\n\n\n============== Running helper agent tool call ===============")
-                print(f"Tool args: {new_tool_args}")
-                print('======================================================\n\n\n')
-                new_out = tools_by_name[new_tool_name].invoke(input=new_tool_args)
-                state["responses"].append(new_out["response"])
-                print(f"NEW OUT: {new_out}")
-                outputs.append(
-                    ToolMessage(
-                        content=json.dumps(new_out),
-                        name=new_tool_name,
-                        tool_call_id=helper_out.tool_calls[0]["id"]
-                    )
-                )
-                if new_tool_name == original_tool_name and not new_out.get("is_interrupted", True):
-                    break
+                phase = RESOLVE
+            elif phase == RESOLVE:
+                started = asyncio.get_running_loop().time()
+                tool_call, attempts = await resolve_interrupt(tool_name, tool_args, out["response"], human_response,
+                                                              state, config)
+                record_interrupt(tool_name, attempts, asyncio.get_running_loop().time() - started, tool_call is not None)
+                if tool_call is None:
+                    phase = GIVE_UP
+                else:
+                    tool_name, tool_args, tool_call_id = tool_call["name"], {**tool_call["args"], "account_id": state["account_id"]}, tool_call["id"]
+                    phase = RUN_RESOLVED
+
+        if phase == GIVE_UP:
+            out = {"response": f"I could not complete {action.tool} with the details given: {out['response']}",
+                   "status": "unresolved", "is_interrupted": False}
+            state["responses"].append(out["response"])
+            tool_results.append({"tool": action.tool, "tool_input": action.tool_input, "output": out})
 
         state["intermediate_steps"].pop(0)
-        state["last_tool_call"] = action
-        state["responses"].append(out["response"])
-        # graph.update_state(config, state)
         return {
             "messages": outputs, 
             "intermediate_steps": state["intermediate_steps"],
             "last_tool_call": action,
-            "responses": state["responses"]
+            "responses": state["responses"],
+            "tool_results": tool_results,
+            "awaiting_human": False,
+            "interrupt_queue": interrupt_queue
         }
     else:
         # return state
@@ -234,7 +384,10 @@ def run_tool(state: AgentState):
 
 def router(state: AgentState):
     if state.get("intermediate_steps", []) != []:
-        return state["intermediate_steps"][0].tool
+        if state.get("awaiting_human", False):
+            ## Resolve the call that needs the human on its own
+            return state["intermediate_steps"][0].tool
+        return "tool_executor"
     return END
 
 ## ================= Setting up the graph =================
@@ -242,6 +395,7 @@ def router(state: AgentState):
 graph_builder = StateGraph(AgentState)
 entry_point = "agent_node"
 graph_builder.add_node(entry_point, agent_node)
+graph_builder.add_node("tool_executor", tool_executor)
 graph_builder.add_node("crud_client_tool", run_tool)
 graph_builder.add_node("book_job_tool", run_tool)
 graph_builder.add_node("book_inquiry_tool", run_tool)
@@ -255,22 +409,27 @@ graph_builder.add_conditional_edges(
     path=router,  # function to determine which node is called
 )
 
-# create edges from each tool back to the agent
+# create edges from the tool executor and each tool back to the agent
+graph_builder.add_edge("tool_executor", entry_point)
 for tool_obj in tools:
     graph_builder.add_edge(tool_obj.name, entry_point)
 
-memory = MemorySaver()
-receptionist_agent = graph_builder.compile(name="receptionist_agent", checkpointer=memory)
-
-## ================= Visualizing the graph =================
 
-with open("agents/receptionist_agent/receptionist_graph_visualization.jpg", "wb") as f:
-    f.write(receptionist_agent.get_graph().draw_mermaid_png())
+@lru_cache(maxsize=None)
+def get_receptionist_agent():
+    """The compiled receptionist graph, compiled on first use."""
+    return graph_builder.compile(name="receptionist_agent", store=get_store(), checkpointer=get_checkpointer())
 
 ## ================= Running/Invoking the graph =================
 
 async def process_input(user_input: str, account_id: str, is_interrupted: bool = False) -> tuple[str, bool]:
-    config["configurable"]["thread_id"] = account_id
+    async with thread_locks.hold(account_id):
+        return await _process_input(user_input, account_id, is_interrupted)
+
+
+async def _process_input(user_input: str, account_id: str, is_interrupted: bool) -> tuple[str, bool]:
+    config = make_config(account_id)
+    response = None
 
     inputs = {
         "user_input": user_input,
@@ -279,19 +438,21 @@ async def process_input(user_input: str, account_id: str, is_interrupted: bool =
         "intermediate_steps": [],
         "last_tool_call": None,
         "responses": [],
+        "tool_results": [],
         "final_response": "",
         "is_interrupted": is_interrupted,
-        "interrupt_queue": []
+        "interrupt_queue": [],
+        "awaiting_human": False
     }
     if is_interrupted:
         inputs = Command(resume=user_input)
 
     print(f"Inputs: {inputs}")
-    events = receptionist_agent.stream(
+    events = get_receptionist_agent().astream(
         inputs,
         config
     )
-    for event in events:
+    async for event in events:
         print(f"\n\n\nEvent: {event}\n\n\n")
         try:
             if event.get("__interrupt__", None):
@@ -316,6 +477,7 @@ async def process_input(user_input: str, account_id: str, is_interrupted: bool =
 
 
 if __name__ == "__main__":
+    configure_logging()
     is_interrupted = False
     async def runloop():
         while True:
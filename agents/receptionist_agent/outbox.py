@@ -0,0 +1,320 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from agents.persistence import SqliteConnectionPool, get_connection_pool
+
+
+main_logger = logging.getLogger('main')
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_BACKOFF_SECONDS", "2"))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", "600"))
+## A claimed item whose worker died is picked up again after its lease expires
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+## Deliver to an in-process fake of the Gmail and Calendar APIs instead, for tests
+GOOGLE_API_FAKE = os.getenv("GOOGLE_API_FAKE") == "1"
+GOOGLE_API_FAKE_FAILURE_RATE = float(os.getenv("GOOGLE_API_FAKE_FAILURE_RATE", "0"))
+GOOGLE_API_FAKE_LATENCY = float(os.getenv("GOOGLE_API_FAKE_LATENCY", "0.05"))
+
+EMAIL = "email"
+CALENDAR_EVENT = "calendar_event"
+KINDS = (EMAIL, CALENDAR_EVENT)
+
+PENDING, IN_FLIGHT, DELIVERED, FAILED = "pending", "in_flight", "delivered", "failed"
+
+
+@dataclass
+class OutboxItem:
+    id: int
+    account_id: str
+    kind: str
+    payload: dict
+    attempts: int
+
+
+@dataclass
+class DeliveryResult:
+    ok: bool
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    retryable: bool = True
+
+
+## ================= Outbox =================
+
+class Outbox:
+    """ Emails and calendar events waiting to be delivered, in the shared SQLite database.
+
+        Items are committed locally so a turn never waits on Google, then claimed in batches by the workers
+        with a lease, which makes the claim safe between the worker threads and processes of a host.
+    """
+
+    def __init__(self, pool: SqliteConnectionPool):
+        self.pool = pool
+        with self.pool.transaction() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    account_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    lease_until REAL,
+                    last_error TEXT,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (kind, status, next_attempt_at)")
+            connection.execute("CREATE INDEX IF NOT EXISTS outbox_account ON outbox (account_id, id)")
+
+    def enqueue(self, kind: str, account_id: str, payload: dict) -> int:
+        now = time.time()
+        with self.pool.transaction() as connection:
+            cursor = connection.execute(
+                "INSERT INTO outbox (account_id, kind, payload, status, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (account_id, kind, json.dumps(payload), PENDING, now, now, now))
+            return cursor.lastrowid
+
+    async def aenqueue(self, kind: str, account_id: str, payload: dict) -> int:
+        return await asyncio.to_thread(self.enqueue, kind, account_id, payload)
+
+    def claim(self, kind: str, limit: int, lease_seconds: float = OUTBOX_LEASE_SECONDS) -> list[OutboxItem]:
+        """The due items of a kind, leased to the caller."""
+        now = time.time()
+        with self.pool.transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, account_id, kind, payload, attempts FROM outbox "
+                "WHERE kind = ? AND ((status = ? AND next_attempt_at <= ?) OR (status = ? AND lease_until <= ?)) "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (kind, PENDING, now, IN_FLIGHT, now, limit)).fetchall()
+            connection.executemany(
+                "UPDATE outbox SET status = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                [(IN_FLIGHT, now + lease_seconds, now, row[0]) for row in rows])
+        return [OutboxItem(id=row[0], account_id=row[1], kind=row[2], payload=json.loads(row[3]), attempts=row[4] + 1)
+                for row in rows]
+
+    def complete(self, items: list[OutboxItem], results: list[DeliveryResult],
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS) -> None:
+        now = time.time()
+        updates = []
+        for item, result in zip(items, results):
+            if result.ok:
+                updates.append((DELIVERED, now, None, json.dumps(result.result), now, item.id))
+            elif result.retryable and item.attempts < max_attempts:
+                backoff = min(OUTBOX_BACKOFF_SECONDS * 2 ** (item.attempts - 1), OUTBOX_MAX_BACKOFF_SECONDS)
+                ## Jitter keeps the retries of a failed batch from hitting the API all at once
+                next_attempt_at = now + backoff * random.uniform(0.5, 1.0)
+                updates.append((PENDING, next_attempt_at, result.error, None, now, item.id))
+            else:
+                updates.append((FAILED, now, result.error, None, now, item.id))
+        with self.pool.transaction() as connection:
+            connection.executemany(
+                "UPDATE outbox SET status = ?, next_attempt_at = ?, lease_until = NULL, last_error = ?, result = ?, "
+                "updated_at = ? WHERE id = ?", updates)
+
+    def _status(self, row) -> dict:
+        return {"id": row[0], "account_id": row[1], "kind": row[2], "status": row[3], "attempts": row[4],
+                "last_error": row[5], "result": json.loads(row[6]) if row[6] else None,
+                "created_at": row[7], "updated_at": row[8]}
+
+    def status(self, item_id: int) -> Optional[dict]:
+        with self.pool.connection() as connection:
+            row = connection.execute(
+                "SELECT id, account_id, kind, status, attempts, last_error, result, created_at, updated_at "
+                "FROM outbox WHERE id = ?", (item_id,)).fetchone()
+        return self._status(row) if row else None
+
+    def list_for_account(self, account_id: str, status: Optional[str] = None, limit: int = 50) -> list[dict]:
+        """The latest items of an account, newest first."""
+        query = ("SELECT id, account_id, kind, status, attempts, last_error, result, created_at, updated_at "
+                 "FROM outbox WHERE account_id = ?")
+        params = [account_id]
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        with self.pool.connection() as connection:
+            rows = connection.execute(query, params).fetchall()
+        return [self._status(row) for row in rows]
+
+
+## ================= Delivery =================
+
+def is_retryable(exception: Exception) -> bool:
+    from googleapiclient.errors import HttpError
+    if isinstance(exception, HttpError):
+        return exception.resp.status == 429 or exception.resp.status >= 500
+    ## Network errors and the like
+    return True
+
+
+class GoogleDeliverer:
+    """Sends a batch of emails, or of calendar events, in one Google batch request."""
+
+    def deliver(self, kind: str, payloads: list[dict]) -> list[DeliveryResult]:
+        from .google_clients import GOOGLE_CALENDAR_ID, get_google_clients
+
+        service = get_google_clients().gmail() if kind == EMAIL else get_google_clients().calendar()
+        results: list[Optional[DeliveryResult]] = [None] * len(payloads)
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[int(request_id)] = DeliveryResult(ok=True, result={"id": response.get("id"),
+                                                                           "link": response.get("htmlLink")})
+            else:
+                results[int(request_id)] = DeliveryResult(ok=False, error=str(exception),
+                                                          retryable=is_retryable(exception))
+
+        batch = service.new_batch_http_request(callback=callback)
+        for i, payload in enumerate(payloads):
+            if kind == EMAIL:
+                request = service.users().messages().send(userId="me", body=payload)
+            else:
+                request = service.events().insert(calendarId=GOOGLE_CALENDAR_ID, sendNotifications=True, body=payload)
+            batch.add(request, request_id=str(i))
+        try:
+            batch.execute()
+        except Exception as e:
+            main_logger.error(f"Batch of {len(payloads)} {kind} deliveries failed: {e}")
+            return [DeliveryResult(ok=False, error=str(e), retryable=is_retryable(e)) for _ in payloads]
+        return [result or DeliveryResult(ok=False, error="No response in the batch") for result in results]
+
+
+class FakeGoogleDeliverer:
+    """ Stands in for the Gmail and Calendar APIs: one round trip of `latency` per batch,
+        and every request fails with a retryable error with probability `failure_rate`.
+    """
+
+    def __init__(self, failure_rate: float = GOOGLE_API_FAKE_FAILURE_RATE, latency: float = GOOGLE_API_FAKE_LATENCY):
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.delivered: list[tuple[str, dict]] = []
+        self.batches = 0
+
+    def deliver(self, kind: str, payloads: list[dict]) -> list[DeliveryResult]:
+        time.sleep(self.latency)
+        results = []
+        with self._lock:
+            self.batches += 1
+            for payload in payloads:
+                if random.random() < self.failure_rate:
+                    results.append(DeliveryResult(ok=False, error="503 Service Unavailable (fake)", retryable=True))
+                else:
+                    self.delivered.append((kind, payload))
+                    results.append(DeliveryResult(ok=True, result={"id": f"fake-{kind}-{len(self.delivered)}", "link": None}))
+        return results
+
+
+class OutboxWorkers:
+    """A pool of threads delivering the due outbox items, the Google clients are blocking."""
+
+    def __init__(self, outbox: Outbox, deliverer, workers: int = OUTBOX_WORKERS, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.outbox = outbox
+        self.deliverer = deliverer
+        self.workers = workers
+        self.batch_size = batch_size
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.metrics = {"batches": 0, "delivered": 0, "retried": 0, "failed": 0}
+
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"outbox-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+
+    def run_once(self) -> int:
+        """Deliver one batch of every kind that has due items, returns the number of items handled."""
+        handled = 0
+        for kind in KINDS:
+            items = self.outbox.claim(kind, self.batch_size)
+            if not items:
+                continue
+            try:
+                results = self.deliverer.deliver(kind, [item.payload for item in items])
+            except Exception as e:
+                main_logger.error(f"Failed to deliver {len(items)} {kind} items: {e}")
+                results = [DeliveryResult(ok=False, error=str(e)) for _ in items]
+            self.outbox.complete(items, results)
+            self.metrics["batches"] += 1
+            for item, result in zip(items, results):
+                if result.ok:
+                    self.metrics["delivered"] += 1
+                elif result.retryable and item.attempts < OUTBOX_MAX_ATTEMPTS:
+                    self.metrics["retried"] += 1
+                else:
+                    self.metrics["failed"] += 1
+                    main_logger.error(f"Gave up delivering {kind} {item.id} of {item.account_id}: {result.error}")
+            handled += len(items)
+        return handled
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                handled = self.run_once()
+            except Exception as e:
+                main_logger.error(f"Outbox worker error: {e}")
+                handled = 0
+            if not handled:
+                self._wake.wait(OUTBOX_POLL_SECONDS)
+                self._wake.clear()
+
+
+@lru_cache(maxsize=None)
+def get_outbox() -> Outbox:
+    return Outbox(get_connection_pool())
+
+
+def get_deliverer():
+    return FakeGoogleDeliverer() if GOOGLE_API_FAKE else GoogleDeliverer()
+
+
+@lru_cache(maxsize=None)
+def get_outbox_workers() -> OutboxWorkers:
+    return OutboxWorkers(get_outbox(), get_deliverer())
+
+
+def start_outbox_workers() -> OutboxWorkers:
+    """Start the workers of the process, so the items left by a previous run are delivered without a new turn."""
+    workers = get_outbox_workers()
+    workers.start()
+    workers.notify()
+    return workers
+
+
+async def submit(kind: str, account_id: str, payload: dict) -> int:
+    """Commit a delivery to the outbox and wake the workers, returns its id for the status API."""
+    item_id = await get_outbox().aenqueue(kind, account_id, payload)
+    start_outbox_workers()
+    return item_id
@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+from functools import lru_cache
+from typing import Optional
+
+
+main_logger = logging.getLogger('main')
+
+## `auto` renders the turns the templates cover and leaves the rest to the synthesizer model, `off` always uses the model
+RESPONSE_TEMPLATES_MODE = os.getenv("RESPONSE_TEMPLATES_MODE", "auto")
+## JSON file of {tool name: {status: template}}, merged over the default templates
+RESPONSE_TEMPLATES_FILE = os.getenv("RESPONSE_TEMPLATES_FILE")
+## Turns with more tool results than this are left to the synthesizer model
+RESPONSE_TEMPLATES_MAX_RESULTS = int(os.getenv("RESPONSE_TEMPLATES_MAX_RESULTS", "4"))
+
+## Formatted with the tool arguments and the tool output, a status without a template goes to the synthesizer model
+DEFAULT_TEMPLATES = {
+    "crud_client_tool": {
+        "created": "I've added {client_email} as a new client.",
+        "exists": "{client_email} is already one of your clients.",
+        "found": "Here are the client's details: {client[name]}, {client[email]}, {client[phone]}.",
+        "not_found": "I couldn't find a client matching those details.",
+        "updated": "I've updated the details of {client_email}.",
+        "email_taken": "{new_client_email} is already the email of another of your clients, so I left {client_email} as it was.",
+        "deleted": "I've removed {client_email} from your clients.",
+    },
+    "check_slot_availability_tool": {
+        "listed": "Available slots for {booking_type}: {slots_text}.",
+        "none": "There are no available slots for {booking_type} at that time.",
+        "invalid_time": "I couldn't read the time {time}, please give it as YYYY-MM-DD or YYYY-MM-DD HH:MM.",
+    },
+    "book_inquiry_tool": {
+        "booked": "Your inquiry \"{title}\" with {client_email} is booked for {start_time}, the calendar invite is on its way.",
+        "already_booked": "{client_email} already has \"{title}\" booked for {start_time}.",
+        "calendar_not_ready": "I can't check the calendar right now, please ask me to book {start_time} again in a moment.",
+    },
+    "book_job_tool": {
+        "booked": "The job \"{title}\" for {client_email} is booked for {start_time}, the calendar invite is on its way.",
+        "already_booked": "{client_email} already has \"{title}\" booked for {start_time}.",
+        "calendar_not_ready": "I can't check the calendar right now, please ask me to book {start_time} again in a moment.",
+    },
+    "send_email_tool": {
+        "queued": "Your email to {client_email} is on its way.",
+    },
+}
+
+
+@lru_cache(maxsize=None)
+def get_templates() -> dict:
+    templates = {tool_name: dict(statuses) for tool_name, statuses in DEFAULT_TEMPLATES.items()}
+    if RESPONSE_TEMPLATES_FILE:
+        with open(RESPONSE_TEMPLATES_FILE, 'r') as templates_file:
+            for tool_name, statuses in json.load(templates_file).items():
+                templates.setdefault(tool_name, {}).update(statuses)
+    return templates
+
+
+## LLM calls saved by the templates, and the turns that still needed the synthesizer model
+metrics = {"rendered": 0, "synthesized": 0}
+
+
+def render_one(tool_result: dict, templates: dict) -> Optional[str]:
+    output = tool_result["output"]
+    template = templates.get(tool_result["tool"], {}).get(output.get("status"))
+    if template is None:
+        return None
+    fields = {**tool_result["tool_input"], **output}
+    if isinstance(fields.get("slots"), list):
+        fields["slots_text"] = ", ".join(fields["slots"])
+    try:
+        return template.format_map(fields)
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def render_responses(tool_results: list[dict], responses: list) -> Optional[str]:
+    """ The final response of a turn rendered from the templates, or None when the synthesizer model is needed:
+        templates disabled, a result without a template, too many results, or responses not coming from a tool.
+    """
+    rendered = None
+    if RESPONSE_TEMPLATES_MODE != "off" \
+            and 0 < len(tool_results) <= RESPONSE_TEMPLATES_MAX_RESULTS \
+            and len(tool_results) == len(responses):
+        templates = get_templates()
+        sentences = [render_one(tool_result, templates) for tool_result in tool_results]
+        if all(sentences):
+            rendered = " ".join(sentences)
+
+    if rendered is None:
+        metrics["synthesized"] += 1
+    else:
+        metrics["rendered"] += 1
+    main_logger.info(f"Response {'rendered from templates' if rendered else 'left to the synthesizer model'}, "
+                     f"{metrics['rendered']} synthesizer calls avoided so far, {metrics['synthesized']} made")
+    return rendered
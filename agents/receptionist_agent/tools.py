@@ -3,47 +3,25 @@ from typing import Optional, Annotated
 from langchain_core.tools import tool
 import os
 from datetime import datetime, timedelta
-from google.auth.transport.requests import Request as GoogleRequest
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from dotenv import load_dotenv
 from email.message import EmailMessage
 import base64
-from pymongo.mongo_client import MongoClient
-import certifi
 import logging
+from . import db, outbox
+from .availability_cache import get_availability_cache
+from .availability_rules import InvalidTime, get_rule_availability, parse_time
+from .calendar_mirror import BOOKING_ACCOUNT_PROPERTY, CalendarNotReady, synced_calendar_mirror
 
 
 load_dotenv()
 
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
-MONGODB_URI = os.environ['MONGODB_URI']
 
 main_logger = logging.getLogger('main')
 
 
-def connect_to_db(uri: str) -> MongoClient:
-    # Create a new client and connect to the server
-    client = MongoClient(uri,
-                         ssl_ca_certs=certifi.where())
-
-    # Send a ping to confirm a successful connection
-    try:
-        client.admin.command('ping')
-        main_logger.info("Pinged your deployment. You successfully connected to MongoDB!")
-        return client
-    except Exception as e:
-        main_logger.info(f"Failed to connect to MongoDB. Check your connection.{e}")
-        raise e
-    
-database_client = connect_to_db(MONGODB_URI)
-database = database_client['ai_receptionist']
-accounts = database['accounts']
-
-
 @tool
-def crud_client_tool(
+async def crud_client_tool(
                     account_id: Annotated[str, "Account ID"],
                     operation: Annotated[str, "Operation type: create, read, update, or delete"],
                     client_email: Annotated[str, "Current email address of the client"],
@@ -54,177 +32,205 @@ def crud_client_tool(
     main_logger.debug(f"Attempting to {operation} client {client_email}")
     assert operation in ["create", "read", "update", "delete"], "Invalid operation, please use create, read, update or delete"
     if operation == "create":
-        existing_client = accounts.find_one({"account_id": account_id, "clients.email": client_email})
-        if existing_client:
-            return {"response": f"Client {client_email} already exists"}
-        
-        accounts.update_one(
-            {"account_id": account_id},
-            {"$push": {"clients": {"name": client_name, "email": client_email, "phone": client_phone}}}
-        )
-        return {"response": f"Client {client_email} created successfully",}
+        if not await db.add_client(account_id, client_name, client_email, client_phone):
+            return {"response": f"Client {client_email} already exists", "status": "exists"}
+        return {"response": f"Client {client_email} created successfully", "status": "created"}
     elif operation == "read":
-        or_conditions = []
-        if client_email:
-            or_conditions.append({"email": client_email})
-        if client_phone:
-            or_conditions.append({"phone": client_phone})
-        if not or_conditions:
-            return {"response": "Please provide either client email or phone number to search for the client"}
+        if not client_email and not client_phone:
+            return {"response": "Please provide either client email or phone number to search for the client", "status": "missing_lookup"}
         
-        client = list(accounts.find(
-            {"account_id": account_id, 
-             "clients": {"$elemMatch": {"$or": or_conditions}}},
-             {"_id": 0, "clients.$": 1}
-            ))
-        client = client[0] if client else None
-        if client and client.get("clients", None):
-            client = client['clients'][0]
+        client = await db.find_client(account_id, email=client_email, phone=client_phone)
+        if client:
             return {"response": f"Client found: name: {client['name']}, email: {client['email']}, phone: {client['phone']}", 
-                    "client": client}
-        return {"response": "Client not found", "client": None}
+                    "client": client, "status": "found"}
+        return {"response": "Client not found", "client": None, "status": "not_found"}
     elif operation == "update":
         fields_to_update = {}
         if client_name:
-            fields_to_update["clients.$.name"] = client_name
+            fields_to_update["name"] = client_name
         if client_phone:
-            fields_to_update["clients.$.phone"] = client_phone
+            fields_to_update["phone"] = client_phone
         if new_client_email:
-            fields_to_update["clients.$.email"] = new_client_email
+            fields_to_update["email"] = new_client_email
         if not fields_to_update:
-            return {"response": "No fields to update provided"}
+            return {"response": "No fields to update provided", "status": "nothing_to_update"}
 
         ## First try to update name and phone using email
-        result = accounts.update_one(
-                    {"account_id": account_id, "clients.email": client_email},
-                    {"$set": fields_to_update}
-                )
-        if result.modified_count == 0:
-            return {"response": f"Client {client_email} not found"}
-        return {"response": f"Client {new_client_email if new_client_email else client_email} updated successfully"}
+        updated = await db.update_client(account_id, client_email, fields_to_update)
+        if updated is None:
+            return {"response": f"Another client already has the email {new_client_email}", "status": "email_taken"}
+        if not updated:
+            return {"response": f"Client {client_email} not found", "status": "not_found"}
+        return {"response": f"Client {new_client_email if new_client_email else client_email} updated successfully", "status": "updated"}
     elif operation == "delete":
-        result = accounts.update_one(
-            {"account_id": account_id},
-            {"$pull": {"clients": {"email": client_email}}}
-        )
-        if result.modified_count == 0:
-            return {"response": f"Client {client_email} not found"}
-        return {"response": f"Client {client_email} deleted successfully"}
+        if not await db.delete_client(account_id, client_email):
+            return {"response": f"Client {client_email} not found", "status": "not_found"}
+        return {"response": f"Client {client_email} deleted successfully", "status": "deleted"}
+
+
+async def free_slots_page(account_id: str, booking_type: str, **filters) -> list[str]:
+    """A page of free slots, computed from the rules of the account, or read from its materialized slots."""
+    availability = await get_rule_availability().entry(account_id, booking_type)
+    if availability.rules is not None:
+        return await get_rule_availability().page(account_id, booking_type, **filters)
+    page = await get_availability_cache().page(account_id, booking_type, **filters)
+    ## Listed without the calendar if it is not synced in time, the booking checks the slot against it again
+    calendar = await synced_calendar_mirror(required=False)
+    if calendar is None:
+        return page
+    ## Leave out the slots taken by meetings added straight in the calendar, and fill the page from the next ones
+    free = calendar.free_times(page, availability.timezone, availability.duration, db.SLOT_TIME_FORMAT)
+    while len(free) < db.SLOTS_PAGE_SIZE and len(page) == db.SLOTS_PAGE_SIZE:
+        page = await get_availability_cache().page(account_id, booking_type, **{**filters, "after": page[-1]})
+        free += calendar.free_times(page, availability.timezone, availability.duration, db.SLOT_TIME_FORMAT)
+    return free[:db.SLOTS_PAGE_SIZE]
+
+
+def invalid_time_response(*times: Optional[str]) -> Optional[dict]:
+    """The answer to the first of the given times that can't be read, None when they all can."""
+    for value in times:
+        if value:
+            try:
+                parse_time(value)
+            except InvalidTime as e:
+                return {"response": f"Could not read the time: {e}", "status": "invalid_time", "time": value}
+    return None
+
+
+def slots_page_response(label: str, slots: list[str]) -> str:
+    response = f"{label}: {slots}"
+    if len(slots) == db.SLOTS_PAGE_SIZE:
+        response += f". There are more, ask for the slots after {slots[-1]} to see them"
+    return response
 
 
 @tool
-def check_slot_availability_tool(account_id: str, booking_type: Annotated[str, "Type of booking: inquiries or jobs"]) -> dict:
+async def check_slot_availability_tool(
+                    account_id: str,
+                    booking_type: Annotated[str, "Type of booking: inquiries or jobs"],
+                    from_time: Annotated[Optional[str], "Only slots from this date (YYYY-MM-DD) or date and time (YYYY-MM-DD HH:MM)"] = None,
+                    to_time: Annotated[Optional[str], "Only slots before this date (YYYY-MM-DD) or date and time (YYYY-MM-DD HH:MM)"] = None,
+                    after: Annotated[Optional[str], "Start time of the last slot already shown, to see the next slots"] = None) -> dict:
     """Check the availability of a meeting slot"""
-    pipeline = [
-        {"$match": {"account_id": account_id}},
-        {
-            "$project": {
-                "_id": 0,
-                booking_type: {
-                    "$filter": {
-                        "input": f"${booking_type}",
-                        "as": "slot",
-                        "cond": {"$eq": ["$$slot.is_booked", False]}
-                    }
-                }
-            }
-        }
-    ]
-    available_slots = list(accounts.aggregate(pipeline))
-    if available_slots:
-        available_slots = [slot["start_time"] for slot in available_slots[0][booking_type]]
-    return {"response": f"Available slots: {available_slots}"}
+    invalid = invalid_time_response(from_time, to_time, after)
+    if invalid is not None:
+        return invalid
+    available_slots = await free_slots_page(account_id, booking_type, from_time=from_time, to_time=to_time, after=after)
+    return {"response": slots_page_response("Available slots", available_slots),
+            "status": "listed" if available_slots else "none", "slots": available_slots}
 
 
 @tool
-def check_booked_slots_tool(account_id: str, booking_type: Annotated[str, "Type of booking: inquiries or jobs"]) -> dict:
+async def check_booked_slots_tool(
+                    account_id: str,
+                    booking_type: Annotated[str, "Type of booking: inquiries or jobs"],
+                    from_time: Annotated[Optional[str], "Only slots from this date (YYYY-MM-DD) or date and time (YYYY-MM-DD HH:MM)"] = None,
+                    to_time: Annotated[Optional[str], "Only slots before this date (YYYY-MM-DD) or date and time (YYYY-MM-DD HH:MM)"] = None,
+                    after: Annotated[Optional[str], "Start time of the last slot already shown, to see the next slots"] = None) -> dict:
     """Check the booked slots"""
-    pipeline = [
-        {"$match": {"account_id": account_id}},
-        {
-            "$project": {
-                "_id": 0,
-                booking_type: {
-                    "$filter": {
-                        "input": f"${booking_type}",
-                        "as": "slot",
-                        "cond": {"$eq": ["$$slot.is_booked", True]}
-                    }
-                }
-            }
-        }
-    ]
-    booked_slots = list(accounts.aggregate(pipeline))
-    if booked_slots:
-        booked_slots = [slot["start_time"] for slot in booked_slots[0][booking_type]]
-    return {"response": f"Booked slots: {booked_slots}"}
-
-
-def booking_helper(
+    invalid = invalid_time_response(from_time, to_time, after)
+    if invalid is not None:
+        return invalid
+    booked_slots = await db.find_slot_times(account_id, booking_type, is_booked=True,
+                                            from_time=from_time, to_time=to_time, after=after)
+    return {"response": slots_page_response("Booked slots", booked_slots),
+            "status": "listed" if booked_slots else "none", "slots": booked_slots}
+
+
+async def booking_helper(
                     account_id: str,
                     title: Annotated[str, "Title of the meeting"],
                     client_email: Annotated[str, "Email of the client"],
-                    start_time: Annotated[datetime, "Start date and time of the meeting in format YYYY-MM-DD HH:MM"],
+                    start_time: Annotated[str, "Start date and time of the meeting in format YYYY-MM-DD HH:MM"],
                     booking_type: Annotated[str, "Type of booking: jobs or inquiries"],
                     location: Annotated[str, "Location of the meeting"] = 'Virtual') -> dict:
     """Helper function to assist with different types of bookings"""
     assert title and client_email and start_time and location, "Please provide a valid title, client name, start time and location"
+    try:
+        start_time = parse_time(start_time)
+    except InvalidTime as e:
+        message = f"Could not read the start time of the meeting: {e}, which date and time is it?"
+        return {"is_interrupted": True, "response": message, "status": "invalid_time"}
 
-    fetched_client = crud_client_tool.invoke({"account_id":account_id, "operation":"read", "client_email":client_email})["client"]
+    fetched_client = await db.find_client(account_id, email=client_email)
     main_logger.debug(f"Client fetched: {fetched_client}")
     if fetched_client is None:
         message = f"Client {client_email} not found, please create a client first"
-        return {"is_interrupted": True, "response": message}
-
-    update_one_result = accounts.update_one(
-        {"account_id": account_id, booking_type: {"$elemMatch": {"start_time": start_time.strftime('%Y-%m-%d %H:%M'), "is_booked": False}}},
-        {"$set": {f"{booking_type}.$.is_booked": True, f"{booking_type}.$.client_email": client_email, f"{booking_type}.$.title": title, f"{booking_type}.$.location": location}}
-    )
-    if update_one_result.modified_count == 1:
-        message = f"Booked a slot for {booking_type}:\nTitle: {title}\nClient Name: {client_email}\nStart Time: {start_time.strftime('%Y-%m-%d %H:%M')}\nLocation: {location}"
+        return {"is_interrupted": True, "response": message, "status": "client_not_found"}
+
+    slot_start_time = start_time.strftime(db.SLOT_TIME_FORMAT)
+    availability = await get_rule_availability().entry(account_id, booking_type)
+    try:
+        calendar = await synced_calendar_mirror()
+    except CalendarNotReady as e:
+        main_logger.warning(f"Not booking {slot_start_time} for {account_id}: {e}")
+        message = "The business calendar is not available yet, so the slot can not be checked, please try again in a moment"
+        return {"is_interrupted": False, "response": message, "status": "calendar_not_ready"}
+    if availability.rules is not None:
+        outcome = await get_rule_availability().reserve(account_id, booking_type, slot_start_time, client_email, title,
+                                                        location, calendar=calendar)
+    elif calendar and calendar.is_busy(start_time, start_time + availability.duration, availability.timezone):
+        ## Taken by a meeting added straight in the calendar
+        alternatives = await free_slots_page(account_id, booking_type, from_time=start_time.strftime('%Y-%m-%d'))
+        outcome = {"reserved": False, "slot": None, "alternatives": alternatives[:db.SLOT_SUGGESTIONS]}
+    else:
+        outcome = await db.reserve_or_suggest(account_id, booking_type, slot_start_time, client_email, title, location,
+                                              now=availability.now())
+        ## Either way the slot is not free anymore, or never was
+        get_availability_cache().mark_booked(account_id, booking_type, slot_start_time)
+        if calendar is not None:
+            outcome["alternatives"] = calendar.free_times(outcome["alternatives"], availability.timezone,
+                                                          availability.duration, db.SLOT_TIME_FORMAT)
+    if outcome["reserved"]:
+        message = f"Booked a slot for {booking_type}:\nTitle: {title}\nClient Name: {client_email}\nStart Time: {slot_start_time}\nLocation: {location}"
         main_logger.info(message)
-        create_gcal_event(title, fetched_client["name"], client_email, start_time)
-        return {"response": message, "is_interrupted": False}
-    
-    booked_slot = accounts.find_one({"account_id": account_id, booking_type: {"$elemMatch": {"start_time": start_time.strftime('%Y-%m-%d %H:%M')}}}, {"_id":0, f"{booking_type}.$":1})
-    if booked_slot and booked_slot[booking_type][0]["client_email"] == client_email:
-        booked_slot = booked_slot[booking_type][0]
+        ## Delivered by the outbox workers, the turn doesn't wait on Google Calendar
+        delivery_id = await outbox.submit(outbox.CALENDAR_EVENT, account_id,
+                                          gcal_event_payload(account_id, title, fetched_client["name"], client_email,
+                                                             start_time, availability.duration, availability.timezone.key))
+        message += f"\nCalendar invite queued for delivery (delivery id {delivery_id})"
+        return {"response": message, "is_interrupted": False, "status": "booked",
+                "start_time": slot_start_time, "client_name": fetched_client["name"], "delivery_id": delivery_id}
+
+    booked_slot = outcome["slot"]
+    if booked_slot and booked_slot["client_email"] == client_email:
         message = f"You have already booked a slot for {booked_slot['title']} on {booked_slot['start_time']}"
-        return {"response": message, "is_interrupted": False}
+        return {"response": message, "is_interrupted": False, "status": "already_booked",
+                "start_time": booked_slot['start_time'], "title": booked_slot['title']}
     else:
-        available_slots = check_slot_availability_tool.invoke({"account_id":account_id, "booking_type":booking_type})["response"]
-        available_slots = available_slots[available_slots.find("["):available_slots.find("]")+1]
+        ## The free slots nearest to the desired one, or the first ones when there are none around it
+        available_slots = outcome["alternatives"] or await free_slots_page(account_id, booking_type)
         message = f"Sorry, your desired slot is not available, please try a different slot. Please choose from the following available slots: {available_slots}"
-        return {"is_interrupted": True, "response": message}
+        return {"is_interrupted": True, "response": message, "status": "unavailable", "slots": available_slots}
 
 
 @tool
-def book_job_tool(
+async def book_job_tool(
                 account_id: str,
                 title: Annotated[str, "Title of the job"],
                 client_email: Annotated[str, "Email of the client"],
-                start_time: Annotated[datetime, "Start date and time of the meeting in format YYYY-MM-DD HH:MM"],
+                start_time: Annotated[str, "Start date and time of the meeting in format YYYY-MM-DD HH:MM"],
                 location: Annotated[str, "Location of the job"] = 'Virtual') -> dict:
     """ Book a job with a client. A job is a the actual work that needs to be done on site, and needs someone to visit the site.
     """
-    return booking_helper(account_id, title, client_email, start_time, "jobs", location)
+    return await booking_helper(account_id, title, client_email, start_time, "jobs", location)
 
 
 @tool
-def book_inquiry_tool(
+async def book_inquiry_tool(
                 account_id: str,
                 title: Annotated[str, "Title of the inquiry"],
                 client_email: Annotated[str, "Email of the client"],
-                start_time: Annotated[datetime, "Start date and time of the meeting in format YYYY-MM-DD HH:MM"],
+                start_time: Annotated[str, "Start date and time of the meeting in format YYYY-MM-DD HH:MM"],
                 location: Annotated[str, "Location of the inquiry"] = 'Virtual') -> dict:
     """ Book an inquiry with a client. An inquiry is like a first meeting with a client to discuss the details of the job. 
         It is like a discovery call from the client's perspective, where the client will discuss their requirements.
     """
-    return booking_helper(account_id, title, client_email, start_time, "inquiries", location)
+    return await booking_helper(account_id, title, client_email, start_time, "inquiries", location)
 
 
 @tool
-def send_email_tool(
+async def send_email_tool(
                     account_id: str,
                     client_email: Annotated[str, "Email address of the recipient"],
                     subject: Annotated[str, "Subject line of the email"],
@@ -232,8 +238,14 @@ def send_email_tool(
     """Send an email to a client"""
     assert client_email and subject and body, "Please provide a valid client email, subject and body"
     main_logger.debug(f"Sending email: From: {SENDER_EMAIL} To: {client_email}\nSubject: {subject}\nBody: {body}")
-    credentials = get_google_credentials()
-    service = build('gmail', 'v1', credentials=credentials)
+    ## Delivered by the outbox workers, the turn doesn't wait on Gmail
+    delivery_id = await outbox.submit(outbox.EMAIL, account_id, email_payload(client_email, subject, body))
+    return {"response": f"Email to {client_email} queued for delivery (delivery id {delivery_id})",
+            "status": "queued", "delivery_id": delivery_id}
+
+
+def email_payload(client_email: str, subject: str, body: str) -> dict:
+    """Body of the Gmail `messages.send` request."""
     message = EmailMessage()
     message['To'] = client_email
     message['From'] = SENDER_EMAIL
@@ -241,59 +253,27 @@ def send_email_tool(
     message.set_content(body)
 
     encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    create_message = {"raw": encoded_message}
-    send_message = (
-        service.users()
-        .messages()
-        .send(userId="me", body=create_message)
-        .execute()
-    )
-    return {"response": f"Email sent to {client_email} successfully"}
+    return {"raw": encoded_message}
 
 
-SCOPES = ['https://www.googleapis.com/auth/calendar','https://www.googleapis.com/auth/gmail.compose']
-
-
-def get_google_credentials():
-    # Load credentials or initiate OAuth flow
-    credentials = None
-    token_file = 'agents/receptionist_agent/token.json'
-    if os.path.exists(token_file):
-        credentials = Credentials.from_authorized_user_file(token_file, SCOPES)
-
-    if not credentials or not credentials.valid:
-        if credentials and credentials.expired and credentials.refresh_token:
-            try:
-                credentials.refresh(GoogleRequest())
-            except Exception as e:
-                credentials = None
-        if not credentials:
-            flow = InstalledAppFlow.from_client_secrets_file("agents/receptionist_agent/credentials.json", SCOPES)
-            credentials = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open(token_file, 'w') as token:
-            token.write(credentials.to_json())
-
-    return credentials
-
-
-def create_gcal_event(title: str, client_name: str, client_email: str, start_time: datetime):
-    credentials = get_google_credentials()
-    service = build('calendar', 'v3', credentials=credentials)
+def gcal_event_payload(account_id: str, title: str, client_name: str, client_email: str, start_time: datetime,
+                       duration: timedelta, timezone: str) -> dict:
+    """ Body of the Calendar `events.insert` request, the times are wall times of the timezone of the account.
+        Tagged with the account, so the calendar mirror tells it from the meetings of the business.
+    """
     attendees = [{"email": client_email}]
-    end_time = start_time + timedelta(hours=1)
-    event = {
+    end_time = start_time + duration
+    return {
         'summary': title,
         'description': f"Appointment with {client_name}",
         'attendees': attendees,
         'start': {
             'dateTime': f"{start_time.strftime('%Y-%m-%dT%H:%M:%S')}",
-            'timeZone': 'America/New_York'
+            'timeZone': timezone
         },
         'end': {
             'dateTime': f"{end_time.strftime('%Y-%m-%dT%H:%M:%S')}",
-            'timeZone': 'America/New_York'
-        }
+            'timeZone': timezone
+        },
+        'extendedProperties': {'private': {BOOKING_ACCOUNT_PROPERTY: account_id}}
     }
-    event_result = service.events().insert(calendarId='primary', sendNotifications=True, body=event).execute()
-    return event_result.get('htmlLink', None)
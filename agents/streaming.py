@@ -0,0 +1,46 @@
+from typing import AsyncIterator, Iterable
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph.state import CompiledStateGraph
+
+
+## Runnables tagged with this tag produce the answer of the turn, their token deltas are forwarded as they arrive.
+## Tool-calling models are never tagged, their text and tool call chunks come before the answer.
+STREAMING_TAG = "stream_to_user"
+
+
+async def astream_tokens(graph: CompiledStateGraph,
+                         inputs,
+                         config: RunnableConfig,
+                         final_nodes: Iterable[str]) -> AsyncIterator[dict]:
+    """ Run the graph and yield the token deltas of the user facing models as they are generated.
+
+    Args:
+        graph (CompiledStateGraph): Graph to run
+        inputs: Graph inputs, or a `Command` to resume an interrupted run
+        config (RunnableConfig): Per-invocation config holding the thread_id
+        final_nodes (Iterable[str]): Nodes whose `final_response` is the answer of the turn
+
+    Yields:
+        dict: `{"type": "token", "content": ...}` for every token delta of the tagged runnables, and a single
+              `{"type": "done", "response": ..., "is_interrupted": ...}` once the run is over.
+    """
+    final_nodes = set(final_nodes)
+    response = None
+    async for event in graph.astream_events(inputs, config, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream" and STREAMING_TAG in event.get("tags", []):
+            content = event["data"]["chunk"].content
+            if isinstance(content, str) and content:
+                yield {"type": "token", "content": content.replace("```", "")}
+        elif kind == "on_chain_end" and event["name"] in final_nodes:
+            output = event["data"].get("output")
+            if isinstance(output, dict) and output.get("final_response"):
+                response = output["final_response"]
+
+    snapshot = await graph.aget_state(config)
+    interrupts = [pending for task in snapshot.tasks for pending in task.interrupts]
+    if interrupts:
+        yield {"type": "done", "response": interrupts[0].value, "is_interrupted": True}
+    else:
+        yield {"type": "done", "response": response, "is_interrupted": False}
@@ -1,32 +1,28 @@
+import asyncio
 import os
 import time
-import yaml
-from dotenv import load_dotenv
 import logging
-
-from agents.receptionist_agent.graph import receptionist_agent, entry_point as receptionist_entry_point, receptionist_agent_prompt
-from agents.RAG_agent.graph import rag_agent, entry_point as rag_entry_point, rag_agent_prompt
+from functools import lru_cache
+
+from agents.receptionist_agent.graph import get_receptionist_agent, entry_point as receptionist_entry_point, receptionist_agent_prompt, tools as receptionist_tools
+from agents.RAG_agent.graph import get_rag_agent, entry_point as rag_entry_point, rag_agent_prompt, tools as rag_tools
+from agents.intent_router import IntentRouter, Router, ROUTER_CONFIDENCE_THRESHOLD, split_sentences
+from agents.concurrency import make_config, thread_locks
+from agents.streaming import astream_tokens
+from agents.persistence import get_checkpointer, get_store
+from agents.history import HistoryCompactor, summary_state_update, with_history
+from agents.models import get_chat_model
 from langchain_core.agents import AgentAction
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
-from langgraph.store.memory import InMemoryStore
 from langgraph.types import Command
-from langgraph_supervisor import create_supervisor
-from typing import Optional, TypedDict, Annotated, List, Union, Any, Literal
+from typing import AsyncIterator, Optional, TypedDict, Annotated, List, Union, Any, Literal
 from pydantic import BaseModel
 
-load_dotenv()
-
-with open("config/logging.yml", "r") as logging_config_file:
-    logging.config.dictConfig(yaml.load(logging_config_file, Loader=yaml.FullLoader))
-
 main_logger = logging.getLogger('main')
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
 ## ================= Declaring the state =================
 
 class AgentState(TypedDict):
@@ -47,11 +43,7 @@ class AgentState(TypedDict):
     is_interrupted: bool
     interrupt_queue: list[dict]
     next_agent: str
-
-config = {"configurable": {"thread_id": ""}}
-gemini_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
-helper_model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp", google_api_key=GEMINI_API_KEY)
-model = gemini_model
+    history_summary: str
 
 
 class NextAgent(BaseModel):
@@ -73,7 +65,49 @@ supervisor_agent_prompt = ChatPromptTemplate.from_messages([
     ("user", "{user_input}"),
 ])
 
-supervisor_llm = (supervisor_agent_prompt | model.with_structured_output(NextAgent))
+history_summary_prompt = ChatPromptTemplate.from_messages([
+    ("system", (
+        "You maintain a running summary of a conversation between a user and an AI receptionist."
+        "Fold the new messages into the current summary."
+        "Keep every fact that could matter later, like names, emails, phone numbers, booked slots and documents discussed."
+        "Respond only with the updated summary."
+    )),
+    ("user", "Current summary: {summary}\n\nNew messages:\n{transcript}"),
+])
+
+
+@lru_cache(maxsize=None)
+def get_supervisor_llm():
+    return (supervisor_agent_prompt | get_chat_model().with_structured_output(NextAgent))
+
+
+@lru_cache(maxsize=None)
+def get_history_compactor() -> HistoryCompactor:
+    return HistoryCompactor(get_store(), history_summary_prompt | get_chat_model())
+
+## ================= Setting up the local fast-path router =================
+
+router_training_texts = {
+    "receptionist_agent": split_sentences(receptionist_agent_prompt.messages[0].prompt.template)
+                          + [tool_obj.description for tool_obj in receptionist_tools],
+    "rag_agent": split_sentences(rag_agent_prompt.messages[0].prompt.template)
+                 + [tool_obj.description for tool_obj in rag_tools],
+}
+intent_router: Optional[Router] = None
+
+
+def get_router() -> Router:
+    """The local router, trained on first use."""
+    global intent_router
+    if intent_router is None:
+        intent_router = IntentRouter(router_training_texts)
+    return intent_router
+
+
+def set_router(new_router: Router):
+    """Swap the local router that runs ahead of the supervisor LLM, e.g. for a different classifier."""
+    global intent_router
+    intent_router = new_router
 
 ## ================= Define the conditional edge logic =================
 
@@ -85,43 +119,59 @@ def router(state: AgentState):
 
 ## ================= Setting up the Nodes =================
 
-def agent_node(state: AgentState):
-    response = supervisor_llm.invoke(state, config)
+async def agent_node(state: AgentState, config: RunnableConfig):
+    ## Every turn enters here, so this is where the history is compacted for the supervisor and the sub-agents
+    compacted = await get_history_compactor().compact(config["configurable"]["thread_id"], state["messages"])
+    history_update = summary_state_update(compacted)
+
+    decision = get_router().classify(state["user_input"])
+    if decision.next_agent and decision.confidence >= ROUTER_CONFIDENCE_THRESHOLD:
+        main_logger.info(f"Routed locally to {decision.next_agent} with confidence {decision.confidence:.2f}")
+        return {"next_agent": decision.next_agent, **history_update}
+
+    prompt_state = with_history({**state, "messages": compacted.messages, "history_summary": compacted.summary})
+    response = await get_supervisor_llm().ainvoke(prompt_state, config)
     print(f"Response: {response}")
     goto = response.next_agent
-    return {"next_agent": goto}
+    main_logger.info(f"Supervisor LLM routed to {goto}, local router confidence was {decision.confidence:.2f}")
+    if goto != "FINISH":
+        ## The router logs the decision to a file, off the event loop
+        await asyncio.to_thread(get_router().record, state["user_input"], goto)
+    return {"next_agent": goto, **history_update}
 
 ## ================= Setting up the graph =================
 
 entry_point = "top_level_supervisor"
-memory = MemorySaver()
-store = InMemoryStore()
-
-workflow = StateGraph(AgentState)
-workflow.add_node(entry_point, agent_node)
-workflow.add_node("receptionist_agent", receptionist_agent)
-workflow.add_node("rag_agent", rag_agent)
+sub_agents_entry_points = ["receptionist_agent", "rag_agent"]
 
-workflow.set_entry_point(entry_point)
-workflow.add_conditional_edges(
-    entry_point,
-    router
-)
 
-top_level_supervisor = workflow.compile(store=store, checkpointer=memory)
-sub_agents_entry_points = ["receptionist_agent", "rag_agent"]
+@lru_cache(maxsize=None)
+def get_top_level_supervisor():
+    """The compiled supervisor graph, compiled with its sub-agent graphs on first use."""
+    workflow = StateGraph(AgentState)
+    workflow.add_node(entry_point, agent_node)
+    workflow.add_node("receptionist_agent", get_receptionist_agent())
+    workflow.add_node("rag_agent", get_rag_agent())
 
-## ================= Visualizing the graph =================
+    workflow.set_entry_point(entry_point)
+    workflow.add_conditional_edges(
+        entry_point,
+        router
+    )
 
-with open("agents/super_visor_graph_visualization.jpg", "wb") as f:
-    f.write(top_level_supervisor.get_graph().draw_mermaid_png())
+    return workflow.compile(store=get_store(), checkpointer=get_checkpointer())
 
 ## ================= Running/Invoking the graph =================
 
 async def process_input(user_input: str, account_id: str, is_interrupted: bool = False) -> tuple[str, bool]:
-    config["configurable"]["thread_id"] = account_id
+    async with thread_locks.hold(account_id):
+        return await _process_input(user_input, account_id, is_interrupted)
+
 
-    inputs = {
+def build_inputs(user_input: str, account_id: str, is_interrupted: bool) -> Union[dict, Command]:
+    if is_interrupted:
+        return Command(resume=user_input)
+    return {
         "user_input": user_input,
         "messages": user_input, # This might look like it's only keeping the user input in the messages, but it's actually keeping the entire conversation history, because it's annotated with `add_messages`.
         "account_id": account_id,
@@ -133,11 +183,15 @@ async def process_input(user_input: str, account_id: str, is_interrupted: bool =
         "interrupt_queue": [],
         "next_agent": ''
     }
-    if is_interrupted:
-        inputs = Command(resume=user_input)
+
+
+async def _process_input(user_input: str, account_id: str, is_interrupted: bool) -> tuple[str, bool]:
+    config = make_config(account_id)
+    response = None
+    inputs = build_inputs(user_input, account_id, is_interrupted)
 
     print(f"Inputs: {inputs}")
-    events = top_level_supervisor.astream(
+    events = get_top_level_supervisor().astream(
         inputs,
         config
     )
@@ -170,3 +224,11 @@ async def process_input(user_input: str, account_id: str, is_interrupted: bool =
 
     return response, is_interrupted
 
+
+async def stream_input(user_input: str, account_id: str, is_interrupted: bool = False) -> AsyncIterator[dict]:
+    """Same as `process_input`, but yields the response token deltas as they are generated, followed by a final `done` event."""
+    async with thread_locks.hold(account_id):
+        config = make_config(account_id)
+        inputs = build_inputs(user_input, account_id, is_interrupted)
+        async for event in astream_tokens(get_top_level_supervisor(), inputs, config, final_nodes=sub_agents_entry_points):
+            yield event
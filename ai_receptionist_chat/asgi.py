@@ -8,6 +8,7 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
+import threading
 
 from django.core.asgi import get_asgi_application
 import django
@@ -15,3 +16,15 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ai_receptionist_chat.settings')
 
 application = get_asgi_application()
+
+
+def start_outbox_workers():
+    from agents.receptionist_agent.outbox import OUTBOX_WORKERS, start_outbox_workers
+    if OUTBOX_WORKERS > 0:
+        start_outbox_workers()
+
+
+## Deliver what the outbox kept from a previous run without waiting for the next booking. With OUTBOX_WORKERS=0
+## the server only queues, and `python manage.py run_outbox` delivers from a process of its own. Started off the
+## startup path, the outbox imports the persistence of the agents.
+threading.Thread(target=start_outbox_workers, name="outbox-startup", daemon=True).start()
@@ -87,6 +87,17 @@ DATABASES = {
 }
 
 
+# The chat views keep the per-account interrupt flag in the cache, it has to be shared by all the worker processes
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(MEDIA_ROOT, 'agent-state', 'cache'),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
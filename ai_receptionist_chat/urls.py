@@ -16,10 +16,16 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from chatbot.views import chat_view, upload_file
+from chatbot.views import (calendar_notification_view, chat_view, chat_stream_view, import_clients_view,
+                           outbox_status_view, upload_file)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('chat/', chat_view, name='chat'),
-    path('upload-file/', upload_file, name='upload-file')
+    path('chat/stream/', chat_stream_view, name='chat-stream'),
+    path('upload-file/', upload_file, name='upload-file'),
+    path('outbox/', outbox_status_view, name='outbox'),
+    path('outbox/<int:delivery_id>/', outbox_status_view, name='outbox-delivery'),
+    path('clients/import/', import_clients_view, name='clients-import'),
+    path('calendar/notifications/', calendar_notification_view, name='calendar-notifications')
 ]
@@ -1,3 +1,5 @@
+import os
+
 from django.apps import AppConfig
 
 
@@ -6,6 +8,12 @@ class ChatbotConfig(AppConfig):
     name = 'chatbot'
 
     def ready(self) -> None:
-        print("Setting up the agents...")
-        from agents.supervisor_agent import top_level_supervisor
-        print("Agents are ready!")
\ No newline at end of file
+        from agents.logging_config import configure_logging
+        configure_logging()
+        ## The agents, models and database clients are set up lazily on the first request,
+        ## set AGENTS_WARMUP=1 to pay that cost at startup instead.
+        if os.getenv("AGENTS_WARMUP") == "1":
+            print("Setting up the agents...")
+            from agents.supervisor_agent import get_top_level_supervisor
+            get_top_level_supervisor()
+            print("Agents are ready!")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Authorize the Google Calendar and Gmail APIs in a browser and write the token (GOOGLE_TOKEN_FILE) "
+            "the workers load, from the client secrets of GOOGLE_CLIENT_SECRETS_FILE. The server never starts "
+            "this flow itself.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=0, help="Port of the local redirect server, any free one by default")
+        parser.add_argument("--no-browser", action="store_true", help="Print the consent url instead of opening it")
+
+    def handle(self, *args, **options):
+        from agents.receptionist_agent.google_clients import GoogleClientManager
+
+        manager = GoogleClientManager()
+        manager.authorize(port=options["port"], open_browser=not options["no_browser"])
+        self.stdout.write(self.style.SUCCESS(f"Saved the Google token to {manager.token_file}"))
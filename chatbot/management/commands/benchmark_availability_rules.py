@@ -0,0 +1,75 @@
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Fill the calendar of one account with bookings, check the free slots computed from its rules against "
+            "a scan of every booking, and report how the next free slot and range queries scale with the bookings.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bookings", type=int, nargs="+", default=[100, 1000, 10000], help="Bookings per run")
+        parser.add_argument("--queries", type=int, default=500, help="Queries per run")
+        parser.add_argument("--timezone", default="America/New_York")
+
+    def handle(self, *args, **options):
+        from agents.receptionist_agent.availability_rules import (BookingIndex, day_slots, free_slots,
+                                                                  rules_from_account)
+
+        tz = ZoneInfo(options["timezone"])
+        rules = rules_from_account({"availability": {
+            "hours": {weekday: [["08:00", "12:00"], ["13:00", "18:00"]] for weekday in ("mon", "tue", "wed", "thu", "fri")},
+            "duration": 45, "buffer": 15, "horizon_days": 3650,
+        }}, "jobs")
+        now = datetime(2030, 1, 1, 0, 0)
+        rng = random.Random(0)
+
+        def brute_force(bookings, from_time, limit):
+            ## Every slot of the rules, checked against every booking
+            slots, day = [], from_time.date()
+            while len(slots) < limit:
+                for slot in day_slots(rules, day, tz):
+                    if slot >= from_time and len(slots) < limit and not any(
+                            start < slot + rules.duration + rules.buffer and slot - rules.buffer < end
+                            for start, end in bookings):
+                        slots.append(slot.strftime('%Y-%m-%d %H:%M'))
+                day += timedelta(days=1)
+            return slots
+
+        self.stdout.write(f"{'bookings':>9}{'next free ms':>14}{'range ms':>10}{'scan ms':>9}")
+        for count in options["bookings"]:
+            ## Book most of the slots of the first weeks, so the queries have to skip over runs of bookings
+            all_slots, day = [], now.date()
+            while len(all_slots) < count * 1.25:
+                all_slots.extend(day_slots(rules, day, tz))
+                day += timedelta(days=1)
+            bookings = [(start, start + rules.duration) for start in sorted(rng.sample(all_slots, count))]
+            index = BookingIndex(bookings)
+            span = (all_slots[-1] - now).total_seconds()
+            query_times = [now + timedelta(seconds=rng.uniform(0, span)) for _ in range(options["queries"])]
+
+            next_free, ranges = [], []
+            for from_time in query_times:
+                start = time.perf_counter()
+                free_slots(rules, index, tz, now, from_time=from_time, limit=1)
+                next_free.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                free_slots(rules, index, tz, now, from_time=from_time, to_time=from_time + timedelta(days=7), limit=20)
+                ranges.append(time.perf_counter() - start)
+
+            scans = []
+            for from_time in query_times[:20]:
+                start = time.perf_counter()
+                expected = brute_force(bookings, from_time, limit=5)
+                scans.append(time.perf_counter() - start)
+                computed = free_slots(rules, index, tz, now, from_time=from_time, limit=5)
+                if computed != expected:
+                    raise CommandError(f"Free slots from {from_time} with {count} bookings: {computed}, expected {expected}")
+
+            self.stdout.write(f"{count:>9}{statistics.median(next_free) * 1000:>14.3f}"
+                              f"{statistics.median(ranges) * 1000:>10.3f}{statistics.median(scans) * 1000:>9.3f}")
+        self.stdout.write(self.style.SUCCESS("Free slots matched a scan of every booking"))
@@ -0,0 +1,97 @@
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Hammer the slots of one account with concurrent simulated clients, most of them after the same few "
+            "popular slots, and report the booking throughput and conflict rate of the reserve-or-suggest engine, "
+            "next to the reserve, re-read and list path it replaced.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--uri", default="mongomock://", help="MongoDB uri, the in-process stand-in by default")
+        parser.add_argument("--slots", type=int, default=200, help="Free slots of the account")
+        parser.add_argument("--clients", type=int, default=150, help="Simulated clients, each books one slot")
+        parser.add_argument("--popular", type=int, default=5, help="Popular slots most clients ask for first")
+        parser.add_argument("--popular-share", type=float, default=0.8, help="Share of the clients after a popular slot")
+        parser.add_argument("--max-attempts", type=int, default=5, help="Attempts of a client before giving up")
+
+    def handle(self, *args, **options):
+        from agents.receptionist_agent import db
+
+        db.MONGODB_URI = options["uri"]
+        db.MONGODB_SEED_FILE = None
+        db.get_client.cache_clear()
+
+        account_id = "booking_benchmark_account"
+        slot_times = [(datetime(2030, 1, 1, 9, 0) + timedelta(hours=i)).strftime(db.SLOT_TIME_FORMAT)
+                      for i in range(options["slots"])]
+
+        async def reserve_or_suggest(start_time, client_email):
+            outcome = await db.reserve_or_suggest(account_id, "jobs", start_time, client_email, "Benchmark", "Virtual")
+            return outcome["reserved"], outcome["alternatives"], 1 if outcome["reserved"] else 3
+
+        async def reserve_then_read(start_time, client_email):
+            ## The path the engine replaced: conditional update, re-read of the slot, then a listing of the free slots
+            if await db.reserve_slot(account_id, "jobs", start_time, client_email, "Benchmark", "Virtual"):
+                return True, [], 1
+            await db.find_slot(account_id, "jobs", start_time)
+            alternatives = await db.find_slot_times(account_id, "jobs", is_booked=False, from_time=start_time[:10],
+                                                    limit=db.SLOT_SUGGESTIONS)
+            return False, alternatives, 3
+
+        async def run(engine):
+            slots = db.get_slots()
+            await db.ensure_indexes()
+            await slots.delete_many({"account_id": account_id})
+            await slots.insert_many([{"account_id": account_id, "booking_type": "jobs", "start_time": start_time,
+                                      "is_booked": False, "client_email": "", "title": "", "location": ""}
+                                     for start_time in slot_times])
+            stats = {"attempts": 0, "conflicts": 0, "round_trips": 0, "booked": {}, "gave_up": 0, "latencies": []}
+            rng = random.Random(0)
+            first_choices = [rng.choice(slot_times[:options["popular"]]) if rng.random() < options["popular_share"]
+                             else rng.choice(slot_times) for _ in range(options["clients"])]
+
+            async def client(i):
+                client_email, start_time = f"client{i}@example.com", first_choices[i]
+                for _ in range(options["max_attempts"]):
+                    began = time.perf_counter()
+                    reserved, alternatives, round_trips = await engine(start_time, client_email)
+                    stats["latencies"].append(time.perf_counter() - began)
+                    stats["attempts"] += 1
+                    stats["round_trips"] += round_trips
+                    if reserved:
+                        stats["booked"][client_email] = start_time
+                        return
+                    stats["conflicts"] += 1
+                    if not alternatives:
+                        break
+                    ## Simulated clients take the suggested slot nearest to the one they wanted
+                    start_time = alternatives[0]
+                stats["gave_up"] += 1
+
+            began = time.perf_counter()
+            await asyncio.gather(*(client(i) for i in range(options["clients"])))
+            stats["elapsed"] = time.perf_counter() - began
+            stored = await slots.count_documents({"account_id": account_id, "is_booked": True})
+            await slots.delete_many({"account_id": account_id})
+            if stored != len(stats["booked"]) or len(set(stats["booked"].values())) != len(stats["booked"]):
+                raise CommandError(f"{engine.__name__}: {len(stats['booked'])} bookings succeeded, {stored} slots booked")
+            return stats
+
+        self.stdout.write(f"{'engine':<22}{'booked':>8}{'gave up':>9}{'attempts':>10}{'conflicts':>11}"
+                          f"{'bookings/s':>12}{'trips/booking':>15}{'p50 ms':>9}{'p95 ms':>9}")
+        for engine in (reserve_or_suggest, reserve_then_read):
+            stats = asyncio.run(run(engine))
+            booked, latencies = len(stats["booked"]), sorted(stats["latencies"])
+            self.stdout.write(f"{engine.__name__:<22}{booked:>8}{stats['gave_up']:>9}{stats['attempts']:>10}"
+                              f"{stats['conflicts'] / stats['attempts']:>11.1%}{booked / stats['elapsed']:>12.0f}"
+                              f"{stats['round_trips'] / max(booked, 1):>15.2f}"
+                              f"{statistics.median(latencies) * 1000:>9.2f}{latencies[int(len(latencies) * 0.95) - 1] * 1000:>9.2f}")
+        if options["uri"].startswith(db.MOCK_URI_SCHEME):
+            self.stdout.write("The stand-in has no network round trips and runs each query inline, "
+                              "point --uri at a deployment to measure the engines under real contention")
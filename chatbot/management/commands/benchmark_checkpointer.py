@@ -0,0 +1,70 @@
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
+
+
+## Checkpoint namespaces written by one turn: the supervisor itself and one of its sub-agent graphs
+GRAPH_NAMESPACES = {
+    "top_level_supervisor": "",
+    "receptionist_agent": "receptionist_agent:1",
+    "rag_agent": "rag_agent:1",
+}
+
+
+class Command(BaseCommand):
+    help = "Measure the checkpoint read/write latency of a graph step on the SQLite checkpointer, per graph."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=50, help="Number of concurrent conversations")
+        parser.add_argument("--steps", type=int, default=20, help="Graph steps per conversation and graph")
+        parser.add_argument("--messages", type=int, default=20, help="Messages in the checkpointed history")
+        parser.add_argument("--db", default=None, help="Database file, a temporary one by default")
+
+    def handle(self, *args, **options):
+        from agents.persistence import SqliteCheckpointSaver, SqliteConnectionPool
+
+        db_path = options["db"] or os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+        saver = SqliteCheckpointSaver(SqliteConnectionPool(db_path))
+        history = [message
+                   for i in range(options["messages"] // 2)
+                   for message in (HumanMessage(content=f"question {i} " * 20), AIMessage(content=f"answer {i} " * 40))]
+        latencies = defaultdict(list)
+
+        async def run_thread(thread_id: str):
+            for graph_name, checkpoint_ns in GRAPH_NAMESPACES.items():
+                config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}}
+                for step in range(options["steps"]):
+                    start = time.perf_counter()
+                    await saver.aget_tuple(config)
+                    latencies[(graph_name, "read")].append(time.perf_counter() - start)
+
+                    checkpoint = empty_checkpoint()
+                    checkpoint["channel_values"] = {"messages": history, "final_response": f"step {step}"}
+                    start = time.perf_counter()
+                    config = await saver.aput(config, checkpoint, {"source": "loop", "step": step}, {})
+                    await saver.aput_writes(config, [("final_response", f"step {step}")], task_id=f"task-{step}")
+                    latencies[(graph_name, "write")].append(time.perf_counter() - start)
+
+        async def run_all():
+            await asyncio.gather(*(run_thread(f"benchmark_thread_{i}") for i in range(options["threads"])))
+
+        start = time.perf_counter()
+        asyncio.run(run_all())
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(f"Database: {db_path}")
+        self.stdout.write(f"{'graph':<22}{'op':<7}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+        for (graph_name, op), samples in sorted(latencies.items()):
+            samples = sorted(samples)
+            p95 = samples[int(len(samples) * 0.95) - 1]
+            self.stdout.write(f"{graph_name:<22}{op:<7}{len(samples):>7}"
+                              f"{statistics.median(samples) * 1000:>9.2f}{p95 * 1000:>9.2f}{samples[-1] * 1000:>9.2f}")
+        total_steps = options["threads"] * options["steps"] * len(GRAPH_NAMESPACES)
+        self.stdout.write(f"{total_steps} graph steps in {elapsed:.2f}s ({total_steps / elapsed:.0f} steps/s)")
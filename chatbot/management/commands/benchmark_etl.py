@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Transform a generated document against stub title and embedding models with network-like latency, "
+            "check the chunks come back in order with their own title and embedding, and report the throughput "
+            "in chunks per second next to the one chunk at a time path it replaced.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunks", type=int, default=200, help="Chunks of the document")
+        parser.add_argument("--title-latency", type=float, default=0.4, help="Seconds of a title and summary call")
+        parser.add_argument("--embedding-latency", type=float, default=0.15, help="Seconds of an embedding request")
+        parser.add_argument("--embedding-latency-per-chunk", type=float, default=0.002,
+                            help="Extra seconds of an embedding request per chunk in it")
+        parser.add_argument("--title-rate", type=float, default=None,
+                            help="Title calls started per second, ETL_TITLE_RATE_PER_SECOND by default")
+        parser.add_argument("--sequential-chunks", type=int, default=20,
+                            help="Chunks transformed by the sequential path, its throughput does not depend on the size")
+
+    def handle(self, *args, **options):
+        from langchain_core.messages import AIMessage
+        from agents.RAG_agent import etl
+
+        if options["title_rate"] is not None:
+            etl.ETL_TITLE_RATE_PER_SECOND = options["title_rate"]
+        stats = {"title_calls": 0, "title_in_flight": 0, "title_peak": 0, "title_starts": [], "embedding_requests": 0}
+
+        def stub_embedding(content):
+            digest = hashlib.sha256(content.encode()).digest()
+            return [byte / 255 for byte in digest] * 24
+
+        class StubHelper:
+            async def ainvoke(self, inputs, config=None):
+                stats["title_calls"] += 1
+                stats["title_in_flight"] += 1
+                stats["title_peak"] = max(stats["title_peak"], stats["title_in_flight"])
+                stats["title_starts"].append(time.perf_counter())
+                await asyncio.sleep(options["title_latency"])
+                stats["title_in_flight"] -= 1
+                title = inputs["user_input"].split("\n", 1)[0].strip("# ")
+                return AIMessage(content=f"```json\n{json.dumps({'title': title, 'summary': f'About {title}'})}\n```")
+
+        async def stub_embed_contents(contents, task_type):
+            stats["embedding_requests"] += 1
+            await asyncio.sleep(options["embedding_latency"] + options["embedding_latency_per_chunk"] * len(contents))
+            return [stub_embedding(content) for content in contents]
+
+        etl.get_helper_agent = lambda: StubHelper()
+        etl.embed_contents = stub_embed_contents
+        ## Every chunk goes to the stub model, none come from the embedding cache
+        etl.get_embedding_cache = lambda: None
+
+        def document(chunks):
+            ## Sections just under the chunk size, so each one is a chunk
+            return "\n\n".join(f"# Section {i}\n" + f"Line {i} of the section.\n" * 210 for i in range(chunks))
+
+        async def sequential(text):
+            ## The path it replaced: the title, then the embedding, of one chunk at a time
+            transformed = []
+            for i, chunk in enumerate(etl.chunk_text(text=text, chunk_size=5000)):
+                title = etl.parse_title_summary((await StubHelper().ainvoke({"user_input": chunk})).content, "doc")
+                transformed.append((i, title, await etl.get_embeddings(chunk)))
+            return transformed
+
+        text = document(options["chunks"])
+        expected = [chunk for chunk in etl.chunk_text(text=text, chunk_size=5000) if chunk]
+        started = time.perf_counter()
+        chunks = asyncio.run(etl.transform_text_doc(url=None, source_name="benchmark_document", text=text))
+        elapsed = time.perf_counter() - started
+
+        errors = []
+        if [chunk.content for chunk in chunks] != expected:
+            errors.append(f"{len(chunks)} chunks transformed out of order, or missing, for {len(expected)} chunks")
+        for chunk in chunks:
+            title = chunk.content.split("\n", 1)[0].strip("# ")
+            if chunk.title != title or chunk.summary != f"About {title}":
+                errors.append(f"Chunk {chunk.chunk_number} got the title of another chunk: {chunk.title}")
+            if not np.allclose(chunk.embedding, stub_embedding(chunk.content)):
+                errors.append(f"Chunk {chunk.chunk_number} got the embedding of another chunk")
+        starts = stats["title_starts"]
+        title_rate = (len(starts) - 1) / (starts[-1] - starts[0]) if len(starts) > 1 else 0.0
+        if stats["title_peak"] > etl.ETL_TITLE_CONCURRENCY or title_rate > etl.ETL_TITLE_RATE_PER_SECOND * 1.05:
+            errors.append(f"Title calls went over their limits: {stats['title_peak']} in flight, {title_rate:.1f}/s")
+
+        self.stdout.write(f"Pipelined: {len(chunks)} chunks in {elapsed:.2f}s, {len(chunks) / elapsed:.1f} chunks/s, "
+                          f"{stats['embedding_requests']} embedding requests, {stats['title_calls']} title calls, "
+                          f"at most {stats['title_peak']} in flight, {title_rate:.1f} started/s")
+
+        sequential_text = document(options["sequential_chunks"])
+        started = time.perf_counter()
+        sequential_chunks = asyncio.run(sequential(sequential_text))
+        sequential_elapsed = time.perf_counter() - started
+        self.stdout.write(f"Sequential: {len(sequential_chunks)} chunks in {sequential_elapsed:.2f}s, "
+                          f"{len(sequential_chunks) / sequential_elapsed:.1f} chunks/s")
+
+        if errors:
+            for error in errors[:20]:
+                self.stderr.write(error)
+            raise CommandError(f"{len(errors)} errors")
+        self.stdout.write(self.style.SUCCESS(f"Chunks came back in order, "
+                                             f"{(len(chunks) / elapsed) / (len(sequential_chunks) / sequential_elapsed):.1f}x "
+                                             f"the sequential throughput"))
@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Run concurrent query_database calls on one event loop against stub source-selection, embedding and "
+            "Supabase calls with network-like latency, check that the loop is never blocked, that the embedding "
+            "is awaited and overlaps the source selection, and report the stage timings next to the blocking "
+            "path it replaced.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queries", type=int, default=50, help="Queries run on the event loop")
+        parser.add_argument("--select-latency", type=float, default=0.4, help="Seconds of the source selection call")
+        parser.add_argument("--embedding-latency", type=float, default=0.15, help="Seconds of a query embedding")
+        parser.add_argument("--match-latency", type=float, default=0.1, help="Seconds of the match_agentic_rag RPC")
+        parser.add_argument("--arrival-interval", type=float, default=0.01,
+                            help="Seconds between the arrivals of the queries, as chats send them")
+        parser.add_argument("--max-lag", type=float, default=0.05, help="Longest the event loop may be blocked, in seconds")
+
+    def handle(self, *args, **options):
+        from langchain_core.messages import AIMessage
+        from agents.RAG_agent import attachment_processor, etl
+        from agents.RAG_agent.source_catalog import SourceCatalog
+
+        stats = {"clients": 0, "rpc_calls": 0, "bad_embeddings": 0}
+        errors = []
+
+        class StubModel:
+            async def ainvoke(self, prompt, config=None):
+                await asyncio.sleep(options["select_latency"])
+                return AIMessage(content='["source_1"]' if '"source_1": 6 chunks from 2 pages' in prompt else "None")
+
+        async def stub_embed_contents(contents, task_type):
+            await asyncio.sleep(options["embedding_latency"])
+            return [[0.1] * 768 for _ in contents]
+
+        class StubRpc:
+            def __init__(self, params):
+                self.params = params
+
+            async def execute(self):
+                stats["rpc_calls"] += 1
+                embedding = self.params["query_embedding"]
+                if not isinstance(embedding, list) or not all(isinstance(value, float) for value in embedding):
+                    stats["bad_embeddings"] += 1
+                await asyncio.sleep(options["match_latency"])
+                return type("Response", (), {"data": [{"title": url, "content": f"Content of {url}"}
+                                                      for url in self.params["urls"]]})
+
+        class StubAsyncClient:
+            def rpc(self, name, params):
+                return StubRpc(params)
+
+        async def stub_create_async_client(url, key):
+            stats["clients"] += 1
+            await asyncio.sleep(0.01)
+            return StubAsyncClient()
+
+        catalog = SourceCatalog()
+        catalog._fetch_rows = lambda: [{"source_name": f"source_{s}", "url": f"https://source_{s}.example/{u}",
+                                        "chunk_count": 3} for s in range(5) for u in range(2)]
+        attachment_processor.get_chat_model = lambda: StubModel()
+        attachment_processor.get_source_catalog = lambda: catalog
+        etl.embed_contents = stub_embed_contents
+        etl.get_embedding_cache = lambda: None
+        etl.create_async_client = stub_create_async_client
+
+        async def heartbeat(lags, stop):
+            while not stop.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lags.append(time.perf_counter() - started - 0.005)
+
+        async def run_concurrent():
+            lags, stop = [], asyncio.Event()
+            beat = asyncio.create_task(heartbeat(lags, stop))
+            started = time.perf_counter()
+
+            async def arrive(i):
+                await asyncio.sleep(i * options["arrival_interval"])
+                return await attachment_processor.query_database.ainvoke({"prompt": f"Question {i}"})
+
+            answers = await asyncio.gather(*(arrive(i) for i in range(options["queries"])))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await beat
+            return answers, elapsed, max(lags)
+
+        def blocking_query():
+            ## The path it replaced: a synchronous tool, its calls one after another, blocking the loop
+            time.sleep(options["select_latency"])
+            time.sleep(options["embedding_latency"])
+            time.sleep(options["match_latency"])
+
+        async def run_blocking(queries):
+            lags, stop = [], asyncio.Event()
+            beat = asyncio.create_task(heartbeat(lags, stop))
+            await asyncio.sleep(0)
+            started = time.perf_counter()
+            for _ in range(queries):
+                blocking_query()
+                await asyncio.sleep(0)
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await beat
+            return elapsed, max(lags)
+
+        metrics = attachment_processor.query_database_metrics
+        for key in metrics:
+            metrics[key] = 0 if key == "queries" else 0.0
+        answers, elapsed, lag = asyncio.run(run_concurrent())
+
+        expected = "".join(f"#https://source_1.example/{u}\nContent of https://source_1.example/{u}\n\n" for u in range(2))
+        wrong = sum(answer != expected for answer in answers)
+        if wrong:
+            errors.append(f"{wrong} of {len(answers)} queries got the wrong content: {answers[0]!r}")
+        if stats["bad_embeddings"]:
+            errors.append(f"{stats['bad_embeddings']} RPC calls got something else than the query embedding")
+        if stats["clients"] != 1:
+            errors.append(f"{stats['clients']} Supabase clients created on one event loop, expected 1")
+        if lag > options["max_lag"]:
+            errors.append(f"The event loop was blocked for {lag * 1000:.0f}ms")
+
+        queries = metrics["queries"]
+        mean = {stage: metrics[stage] / queries * 1000 for stage in ("catalog", "select_sources", "embed", "match", "total")}
+        ## The embedding runs under the source selection, a query takes about the longest of the two plus the match
+        overlapped = max(options["select_latency"], options["embedding_latency"]) + options["match_latency"]
+        if mean["total"] > (overlapped + 0.05) * 1000:
+            errors.append(f"Queries took {mean['total']:.0f}ms, the embedding did not overlap the source selection")
+        self.stdout.write("Stages, mean ms: " + ", ".join(f"{stage} {ms:.1f}" for stage, ms in mean.items())
+                          + f", slowest {metrics['total_max'] * 1000:.0f}ms")
+        self.stdout.write(f"Async: {options['queries']} queries in {elapsed:.2f}s, "
+                          f"{options['queries'] / elapsed:.1f} queries/s, event loop blocked at most {lag * 1000:.1f}ms")
+
+        ## Another event loop gets its own client
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(etl.get_async_supabase())
+        loop.close()
+        if stats["clients"] != 2:
+            errors.append("A new event loop reused the Supabase client of another loop")
+
+        blocking_queries = min(options["queries"], 5)
+        blocking_elapsed, blocking_lag = asyncio.run(run_blocking(blocking_queries))
+        self.stdout.write(f"Blocking: {blocking_queries} queries in {blocking_elapsed:.2f}s, "
+                          f"{blocking_queries / blocking_elapsed:.1f} queries/s, "
+                          f"event loop blocked at most {blocking_lag * 1000:.0f}ms")
+
+        if errors:
+            for error in errors:
+                self.stderr.write(error)
+            raise CommandError(f"{len(errors)} errors")
+        blocking_latency = (options["select_latency"] + options["embedding_latency"] + options["match_latency"]) * 1000
+        self.stdout.write(self.style.SUCCESS(
+            f"{(options['queries'] / elapsed) / (blocking_queries / blocking_elapsed):.0f}x the blocking throughput, "
+            f"{mean['total']:.0f}ms per query instead of {blocking_latency:.0f}ms"))
@@ -0,0 +1,98 @@
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Run the receptionist tools of many chats concurrently against MongoDB, or the in-process stand-in, "
+            "and report their latency and how long the event loop was stalled.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--uri", default="mongomock://", help="MongoDB uri, the in-process stand-in by default")
+        parser.add_argument("--chats", type=int, default=200, help="Number of concurrent chats")
+        parser.add_argument("--slots", type=int, default=20, help="Free job slots per account")
+
+    def handle(self, *args, **options):
+        from agents.receptionist_agent import db, outbox, tools
+
+        db.MONGODB_URI = options["uri"]
+        db.MONGODB_SEED_FILE = None
+        db.get_client.cache_clear()
+
+        ## Keep the benchmark about the database
+        async def skip_delivery(*args, **kwargs):
+            return 0
+
+        outbox.submit = skip_delivery
+
+        account_ids = [f"benchmark_account_{i}" for i in range(options["chats"])]
+        first_slot = datetime(2030, 1, 1, 9, 0)
+        slot_times = [first_slot + timedelta(hours=i) for i in range(options["slots"])]
+        latencies = {"crud_client_tool": [], "check_slot_availability_tool": [], "book_job_tool": []}
+        loop_lags = []
+
+        def make_client(account_id):
+            return {"account_id": account_id, "name": "Benchmark Client", "email": "client@example.com", "phone": "0000000000"}
+
+        def make_slots(account_id):
+            return [{"account_id": account_id, "booking_type": "jobs", "start_time": slot_time.strftime('%Y-%m-%d %H:%M'),
+                     "is_booked": False, "client_email": "", "title": "", "location": ""} for slot_time in slot_times]
+
+        async def timed(tool, tool_input):
+            start = time.perf_counter()
+            out = await tool.ainvoke(tool_input)
+            latencies[tool.name].append(time.perf_counter() - start)
+            return out
+
+        async def run_chat(account_id):
+            await timed(tools.crud_client_tool, {"account_id": account_id, "operation": "read",
+                                                 "client_email": "client@example.com"})
+            await timed(tools.check_slot_availability_tool, {"account_id": account_id, "booking_type": "jobs"})
+            await timed(tools.book_job_tool, {"account_id": account_id, "title": "Benchmark job",
+                                              "client_email": "client@example.com",
+                                              "start_time": slot_times[0].strftime('%Y-%m-%d %H:%M')})
+
+        async def heartbeat(stop: asyncio.Event, interval: float = 0.005):
+            while not stop.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(interval)
+                loop_lags.append(time.perf_counter() - start - interval)
+
+        async def run_all():
+            accounts, clients, slots = db.get_accounts(), db.get_clients(), db.get_slots()
+            await db.ensure_indexes()
+            for collection in (accounts, clients, slots):
+                await collection.delete_many({"account_id": {"$in": account_ids}})
+            await accounts.insert_many([{"account_id": account_id} for account_id in account_ids])
+            await clients.insert_many([make_client(account_id) for account_id in account_ids])
+            await slots.insert_many([slot for account_id in account_ids for slot in make_slots(account_id)])
+            stop = asyncio.Event()
+            heartbeat_task = asyncio.create_task(heartbeat(stop))
+            start = time.perf_counter()
+            await asyncio.gather(*(run_chat(account_id) for account_id in account_ids))
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await heartbeat_task
+            for collection in (accounts, clients, slots):
+                await collection.delete_many({"account_id": {"$in": account_ids}})
+            return elapsed
+
+        elapsed = asyncio.run(run_all())
+
+        self.stdout.write(f"{'tool':<32}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+        for tool_name, samples in latencies.items():
+            samples = sorted(samples)
+            p95 = samples[int(len(samples) * 0.95) - 1]
+            self.stdout.write(f"{tool_name:<32}{len(samples):>7}{statistics.median(samples) * 1000:>9.2f}"
+                              f"{p95 * 1000:>9.2f}{samples[-1] * 1000:>9.2f}")
+        calls = sum(len(samples) for samples in latencies.values())
+        self.stdout.write(f"{calls} tool calls from {options['chats']} chats in {elapsed:.2f}s ({calls / elapsed:.0f} calls/s)")
+        if loop_lags:
+            self.stdout.write(f"Event loop stalled at most {max(loop_lags) * 1000:.2f}ms "
+                              f"(p50 {statistics.median(loop_lags) * 1000:.2f}ms)")
+        if options["uri"].startswith(db.MOCK_URI_SCHEME):
+            self.stdout.write("The stand-in runs its queries inline on the event loop, "
+                              "point --uri at a deployment to measure the stalls of the real driver")
@@ -0,0 +1,63 @@
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+## Prints the time a fresh worker takes to be ready to serve, then the time the first chat request takes to
+## import the agent modules and compile the graphs, which AGENTS_WARMUP=1 moves to startup
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import ai_receptionist_chat.asgi
+import ai_receptionist_chat.urls
+ready = time.perf_counter()
+from agents.supervisor_agent import get_top_level_supervisor
+get_top_level_supervisor()
+print(ready - start, time.perf_counter() - ready)
+"""
+
+
+class Command(BaseCommand):
+    help = ("Measure the cold start time of a worker, and the time until it can serve its first chat, each sample in "
+            "a fresh interpreter, and check both against their budgets.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to time")
+        parser.add_argument("--budget", type=float, default=1.0, help="Maximum median startup time, in seconds")
+        parser.add_argument("--first-request-budget", type=float, default=3.0,
+                            help="Maximum median time from start until the agents can serve the first chat, in seconds")
+
+    def handle(self, *args, **options):
+        samples, first_request_samples = [], []
+        with tempfile.TemporaryDirectory() as directory:
+            ## The graphs open the state database when they are compiled, a throwaway one here
+            env = {**os.environ, "AGENT_STATE_DB": os.path.join(directory, "agent_state.sqlite3")}
+            env.pop("AGENTS_WARMUP", None)
+            for _ in range(options["runs"]):
+                result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], capture_output=True, text=True, env=env)
+                if result.returncode != 0:
+                    raise CommandError(f"Startup failed:\n{result.stderr}")
+                startup, agents_setup = result.stdout.strip().splitlines()[-1].split()
+                samples.append(float(startup))
+                first_request_samples.append(float(startup) + float(agents_setup))
+
+        median = statistics.median(samples)
+        first_request_median = statistics.median(first_request_samples)
+        self.stdout.write(f"Startup over {len(samples)} runs: median {median:.3f}s, "
+                          f"min {min(samples):.3f}s, max {max(samples):.3f}s, budget {options['budget']:.3f}s")
+        self.stdout.write(f"Ready for the first chat, agents imported and graphs compiled: median "
+                          f"{first_request_median:.3f}s, max {max(first_request_samples):.3f}s, "
+                          f"budget {options['first_request_budget']:.3f}s")
+        errors = []
+        if median > options["budget"]:
+            errors.append(f"Startup median {median:.3f}s is over the {options['budget']:.3f}s budget")
+        if first_request_median > options["first_request_budget"]:
+            errors.append(f"First chat median {first_request_median:.3f}s is over the "
+                          f"{options['first_request_budget']:.3f}s budget")
+        if errors:
+            raise CommandError("; ".join(errors))
+        self.stdout.write(self.style.SUCCESS("Startup and first chat are within budget"))
@@ -0,0 +1,104 @@
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Load clustered embedding-like chunks of sources of very different sizes in the local vector engine, "
+            "map it again from disk, and report the recall and latency of searches filtered on sources and urls "
+            "against an exact search, next to an exhaustive search of every chunk.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunks", type=int, default=50000)
+        parser.add_argument("--sources", type=int, default=20)
+        parser.add_argument("--urls-per-source", type=int, default=20)
+        parser.add_argument("--queries", type=int, default=300)
+        parser.add_argument("--ann-index", default="hnsw", choices=["hnsw", "ivf"])
+        parser.add_argument("--ann-min-vectors", type=int, default=10000)
+        parser.add_argument("--dtype", default="float16", choices=["float32", "float16", "int8"])
+        parser.add_argument("--spread", type=float, default=1.0,
+                            help="Noise around the topics, higher spreads the chunks out towards random vectors, "
+                                 "which are the hardest for approximate indexes")
+        parser.add_argument("--min-recall", type=float, default=0.9)
+
+    def handle(self, *args, **options):
+        from agents.RAG_agent.vector_engine import LocalVectorEngine
+        from agents.RAG_agent.vector_store import EMBEDDING_DIMENSIONS, VectorStore
+
+        rng = np.random.default_rng(0)
+        dimensions, count = EMBEDDING_DIMENSIONS, options["chunks"]
+
+        def unit(vectors):
+            return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+        ## A few big sources and many small ones, each about a few topics
+        weights = 1 / np.arange(1, options["sources"] + 1) ** 1.2
+        sources = rng.choice(options["sources"], size=count, p=weights / weights.sum())
+        centers = unit(rng.normal(size=(options["sources"] * 10, dimensions)))
+        vectors = unit(centers[sources * 10 + rng.integers(0, 10, count)]
+                       + rng.normal(scale=options["spread"] / np.sqrt(dimensions), size=(count, dimensions)))
+        urls = rng.integers(0, options["urls_per_source"], count)
+        rows = [{"id": i, "source_name": f"source_{sources[i]}", "url": f"https://source-{sources[i]}.com/{urls[i]}",
+                 "chunk_number": i, "title": f"Chunk {i}", "summary": "", "content": f"Content {i}",
+                 "embedding": vectors[i]} for i in range(count)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = LocalVectorEngine(directory, dimensions, options["dtype"], options["ann_index"],
+                                       options["ann_min_vectors"])
+            started = time.perf_counter()
+            for i in range(0, count, 5000):
+                engine.add(rows[i:i + 5000])
+            self.stdout.write(f"Loaded {count} chunks of {options['sources']} sources in {time.perf_counter() - started:.1f}s, "
+                              f"biggest source {np.bincount(sources).max()} chunks")
+            engine.close()
+
+            started = time.perf_counter()
+            engine = LocalVectorEngine(directory, dimensions, options["dtype"], options["ann_index"],
+                                       options["ann_min_vectors"])
+            self.stdout.write(f"Mapped {len(engine)} chunks from disk in {(time.perf_counter() - started) * 1000:.0f}ms, "
+                              f"{sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory)) / 2 ** 20:.0f}MB "
+                              f"on disk, approximate sources: "
+                              f"{[name for name, p in engine._partitions.items() if not p.is_exhaustive]}")
+
+            exhaustive = VectorStore(dimensions, "float32")
+            exhaustive.add(vectors)
+            ## Queries about a chunk, searched in its source, as query_database routes a query to the sources it is about
+            origins = rng.integers(0, count, options["queries"])
+            queries = unit(vectors[origins]
+                           + rng.normal(scale=options["spread"] * 4 / 3 / np.sqrt(dimensions), size=(options["queries"], dimensions)))
+            results = {"source filter": ([], []), "source and url filter": ([], []), "exhaustive, no filter": ([], [])}
+            for origin, query in zip(origins, queries):
+                source = int(sources[origin])
+                allowed = sources == source
+                query_urls = [f"https://source-{source}.com/{url}" for url in range(options["urls_per_source"] // 4)]
+                url_allowed = allowed & (urls < options["urls_per_source"] // 4)
+                for label, filters, mask in (("source filter", {}, allowed),
+                                             ("source and url filter", {"urls": query_urls}, url_allowed)):
+                    began = time.perf_counter()
+                    found = engine.search(query, source_names=[f"source_{source}"], match_count=10, **filters)
+                    results[label][0].append(time.perf_counter() - began)
+                    candidates = np.flatnonzero(mask)
+                    expected = set(candidates[np.argsort(-(vectors[candidates] @ query))[:10]].tolist())
+                    if any(row["source_name"] != f"source_{source}" or (filters and row["url"] not in query_urls) for row in found):
+                        raise CommandError(f"{label}: a chunk outside the filter was returned")
+                    results[label][1].append(len({row["id"] for row in found} & expected) / max(len(expected), 1))
+                began = time.perf_counter()
+                matches = exhaustive.search(query, 10)
+                results["exhaustive, no filter"][0].append(time.perf_counter() - began)
+                expected = set(np.argsort(-(vectors @ query))[:10].tolist())
+                results["exhaustive, no filter"][1].append(len({i for i, _ in matches} & expected) / 10)
+            engine.close()
+
+        self.stdout.write(f"{'search':<24}{'p50 ms':>9}{'p95 ms':>9}{'recall':>9}")
+        for label, (latencies, recalls) in results.items():
+            latencies.sort()
+            self.stdout.write(f"{label:<24}{statistics.median(latencies) * 1000:>9.3f}"
+                              f"{latencies[int(len(latencies) * 0.95) - 1] * 1000:>9.3f}{statistics.mean(recalls):>9.3f}")
+        recall = min(statistics.mean(results[label][1]) for label in ("source filter", "source and url filter"))
+        if recall < options["min_recall"]:
+            raise CommandError(f"Recall {recall:.3f} under {options['min_recall']}")
+        self.stdout.write(self.style.SUCCESS(f"Filtered searches found {recall:.1%} of the exact matches"))
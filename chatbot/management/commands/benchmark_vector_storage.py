@@ -0,0 +1,68 @@
+import statistics
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Store clustered embedding-like vectors as the zero padded float32 vectors of before, and at their native "
+            "dimensions as float32, float16 and int8, and report the bytes per vector, the search latency and the "
+            "recall of the top matches against an exact search.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--vectors", type=int, default=20000, help="Stored vectors")
+        parser.add_argument("--queries", type=int, default=500)
+        parser.add_argument("--top-k", type=int, default=10)
+        parser.add_argument("--clusters", type=int, default=200, help="Topics the vectors are spread over")
+        parser.add_argument("--min-recall", type=float, default=0.9, help="Lowest recall accepted for int8")
+
+    def handle(self, *args, **options):
+        from agents.RAG_agent.vector_store import EMBEDDING_DIMENSIONS, VECTOR_DTYPES, VectorStore, strip_padding
+
+        rng = np.random.default_rng(0)
+        dimensions, top_k = EMBEDDING_DIMENSIONS, options["top_k"]
+
+        def unit(vectors):
+            return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+        ## Chunks of a few topics, and queries close to some chunks, as embeddings of documents and questions are
+        centers = unit(rng.normal(size=(options["clusters"], dimensions)))
+        vectors = unit(centers[rng.integers(0, options["clusters"], options["vectors"])]
+                       + rng.normal(scale=2.4 / np.sqrt(dimensions), size=(options["vectors"], dimensions)))
+        queries = unit(vectors[rng.integers(0, options["vectors"], options["queries"])]
+                       + rng.normal(scale=3.2 / np.sqrt(dimensions), size=(options["queries"], dimensions)))
+        queries = queries.astype(np.float32)
+        exact = np.argsort(-(queries @ vectors.astype(np.float32).T), axis=1)[:, :top_k]
+
+        padded = np.pad(vectors, ((0, 0), (0, 1536 - dimensions))).astype(np.float32)
+        if not np.allclose(np.array([strip_padding(vector) for vector in padded[:100].tolist()]), vectors[:100], atol=1e-6):
+            raise CommandError("Stripping the padding changed the vectors")
+
+        def measure(label, store, store_queries):
+            latencies, recalls = [], []
+            for query, expected in zip(store_queries, exact):
+                start = time.perf_counter()
+                matches = store.search(query, top_k)
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len({i for i, _ in matches} & set(expected.tolist())) / top_k)
+            recall = statistics.mean(recalls)
+            self.stdout.write(f"{label:<18}{store.nbytes / len(store):>12.0f}{store.nbytes / 2 ** 20:>10.1f}"
+                              f"{statistics.median(latencies) * 1000:>12.3f}{recall:>10.3f}")
+            return recall
+
+        self.stdout.write(f"{'storage':<18}{'bytes/vec':>12}{'total MB':>10}{'search ms':>12}{'recall':>10}")
+        store = VectorStore(dimensions=1536, dtype="float32")
+        store.add(padded)
+        measure("padded float32", store, np.pad(queries, ((0, 0), (0, 1536 - dimensions))))
+        recalls = {}
+        for dtype in VECTOR_DTYPES:
+            store = VectorStore(dimensions=dimensions, dtype=dtype)
+            ## Added in batches, as documents come in, so the int8 ranges are trained on the first document only
+            for i in range(0, len(vectors), 200):
+                store.add(vectors[i:i + 200])
+            recalls[dtype] = measure(f"native {dtype}", store, queries)
+
+        if recalls["float32"] < 0.999 or recalls["float16"] < 0.99 or recalls["int8"] < options["min_recall"]:
+            raise CommandError(f"Recall too low: {recalls}")
+        self.stdout.write(self.style.SUCCESS(f"Recall@{top_k} float16 {recalls['float16']:.3f}, int8 {recalls['int8']:.3f}"))
@@ -0,0 +1,34 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Build the local vector engine (RAG_INDEX_DIR) from the chunks of the agentic_rag table, "
+            "for RAG_VECTOR_BACKEND=local. Rebuilds it from scratch, padded embeddings are stripped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, default=1000, help="Rows read from Supabase per request")
+
+    def handle(self, *args, **options):
+        from agents.RAG_agent.etl import get_supabase
+        from agents.RAG_agent.vector_engine import get_vector_engine
+
+        engine = get_vector_engine()
+        engine.clear()
+        page_size, last_id, total = options["page_size"], 0, 0
+        while True:
+            rows = get_supabase().table("agentic_rag")\
+                .select("id, source_name, url, chunk_number, title, summary, content, embedding")\
+                .gt("id", last_id).order("id").limit(page_size).execute().data
+            if not rows:
+                break
+            for row in rows:
+                ## pgvector columns come back as their text form
+                if isinstance(row["embedding"], str):
+                    row["embedding"] = json.loads(row["embedding"])
+            engine.add([row for row in rows if row["embedding"] is not None])
+            last_id, total = rows[-1]["id"], total + len(rows)
+            self.stdout.write(f"{total} chunks indexed")
+        self.stdout.write(self.style.SUCCESS(f"Indexed {len(engine)} chunks of {len(engine.source_names())} sources "
+                                             f"in {engine.directory}"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Render the supervisor, receptionist and RAG graphs to JPEG files (uses the remote mermaid renderer)."
+
+    def handle(self, *args, **options):
+        from agents.supervisor_agent import get_top_level_supervisor
+        from agents.receptionist_agent.graph import get_receptionist_agent
+        from agents.RAG_agent.graph import get_rag_agent
+
+        graphs = {
+            "agents/super_visor_graph_visualization.jpg": get_top_level_supervisor(),
+            "agents/receptionist_agent/receptionist_graph_visualization.jpg": get_receptionist_agent(),
+            "agents/RAG_agent/rag_graph_visualization.jpg": get_rag_agent(),
+        }
+        for file_path, graph in graphs.items():
+            with open(file_path, "wb") as f:
+                f.write(graph.get_graph().draw_mermaid_png())
+            self.stdout.write(f"Wrote {file_path}")
@@ -0,0 +1,32 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Import the clients of an account from a CSV with `name`, `email` and `phone` columns. "
+            "Clients are upserted on their email, so re-importing a list updates it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_file", help="Path of the CSV, with a header row")
+        parser.add_argument("--account-id", required=True)
+        parser.add_argument("--batch-size", type=int, default=None, help="Clients upserted per bulk write")
+
+    def handle(self, *args, **options):
+        from agents.receptionist_agent import db
+
+        start = time.perf_counter()
+        try:
+            with open(options["csv_file"], 'r', encoding='utf-8-sig', newline='') as csv_file:
+                report = asyncio.run(db.import_clients(options["account_id"], db.clients_from_csv(csv_file),
+                                                       batch_size=options["batch_size"] or db.CLIENTS_IMPORT_BATCH_SIZE))
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        elapsed = time.perf_counter() - start
+
+        for line_num, reason in list(report["rejected"].items())[:20]:
+            self.stderr.write(f"Line {line_num}: {reason}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['rows']} rows in {elapsed:.2f}s ({report['rows'] / elapsed:.0f} rows/s): "
+            f"{report['inserted']} clients inserted, {report['updated']} updated, {len(report['rejected'])} rows rejected"))
@@ -0,0 +1,20 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Move the clients embedded in the `clients` arrays of the account documents "
+            "to their own indexed collection. Safe to re-run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Clients inserted per bulk write")
+        parser.add_argument("--keep-embedded", action="store_true",
+                            help="Leave the arrays in the account documents, e.g. to roll back")
+
+    def handle(self, *args, **options):
+        from agents.receptionist_agent import db
+
+        accounts, clients = asyncio.run(db.migrate_embedded_clients(batch_size=options["batch_size"],
+                                                                    keep_embedded=options["keep_embedded"]))
+        self.stdout.write(self.style.SUCCESS(f"Migrated {clients} clients of {accounts} accounts"))
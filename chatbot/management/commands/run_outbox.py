@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Deliver the outbox from a process of its own, for servers run with OUTBOX_WORKERS=0 or to drain what "
+            "is left while no server runs. Delivers until interrupted, or until nothing is due with --once.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=None, help="Delivery threads, OUTBOX_WORKERS by default")
+        parser.add_argument("--once", action="store_true", help="Stop once no item is due")
+
+    def handle(self, *args, **options):
+        from agents.receptionist_agent import outbox
+
+        workers = outbox.OutboxWorkers(outbox.get_outbox(), outbox.get_deliverer(),
+                                       workers=options["workers"] or outbox.OUTBOX_WORKERS or 1)
+        if options["once"]:
+            handled = 0
+            while handled_now := workers.run_once():
+                handled += handled_now
+            self.stdout.write(self.style.SUCCESS(f"Handled {handled} deliveries, metrics {workers.metrics}"))
+            return
+        workers.start()
+        self.stdout.write(f"Delivering the outbox with {workers.workers} workers, Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            workers.stop()
+        self.stdout.write(self.style.SUCCESS(f"Stopped, metrics {workers.metrics}"))
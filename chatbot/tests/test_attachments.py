@@ -0,0 +1,247 @@
+import asyncio
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from agents.persistence import SqliteConnectionPool, SqliteStore
+from agents.RAG_agent import attachment_processor, etl
+from agents.RAG_agent.answer_cache import AnswerCache
+
+
+class StubEngine:
+    queries = 0
+
+    def __init__(self, retrievers):
+        self.retrievers = retrievers
+
+    async def aquery(self, prompt):
+        StubEngine.queries += 1
+        return SimpleNamespace(response=f"Answer to {prompt} from " + ", ".join(
+            f"{file_name}: {content}" for file_name, content in self.retrievers))
+
+
+class AttachmentsTestCase(SimpleTestCase):
+    """ Attachment processors over a temporary raw-files directory, with llama-index stubbed out: a processor
+        "parses" its file by reading it, and the query engine holds what its retrievers read.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.parsed = []
+
+        def process(processor):
+            with open(os.path.join(self.directory, processor.file_name)) as raw_file:
+                content = raw_file.read()
+            self.parsed.append(processor.file_name)
+            processor.index = SimpleNamespace(as_retriever=lambda: (processor.file_name, content))
+
+        for target, value in [("RAW_FILES_DIR", self.directory),
+                              ("get_llm", lambda: None),
+                              ("LLMRerank", lambda **kwargs: None),
+                              ("QueryFusionRetriever", lambda retrievers, **kwargs: retrievers),
+                              ("RetrieverQueryEngine", SimpleNamespace(
+                                  from_args=lambda retriever, node_postprocessors: StubEngine(retriever))),
+                              ("loaded_attachment_processors", {})]:
+            patcher = mock.patch.object(attachment_processor, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(attachment_processor.AttachmentProcessor, "process", process)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.pool = SqliteConnectionPool(os.path.join(self.directory, "state.sqlite3"), size=4)
+        self.addCleanup(self.pool.close)
+        self.store = SqliteStore(self.pool)
+
+    def upload(self, account_id, file_name, content):
+        """What the upload view and file_upload_handler do: save the file, process it and register it."""
+        with open(os.path.join(self.directory, file_name), "w") as raw_file:
+            raw_file.write(content)
+        attachment = attachment_processor.AttachmentProcessor(file_name)
+        attachment.process()
+        attachment_processor.register_attachment(self.store, account_id, attachment)
+
+    def contents(self, account_id):
+        processors = attachment_processor.load_attachment_processors(self.store, account_id)
+        return dict(processors.query_engine.retrievers) if processors else {}
+
+    def as_worker(self, loaded):
+        """Act as another worker process, which has its own loaded processors."""
+        return mock.patch.object(attachment_processor, "loaded_attachment_processors", loaded)
+
+
+class AttachmentManifestTests(AttachmentsTestCase):
+    def test_other_workers_see_replaced_content(self):
+        self.upload("account", "resume.txt", "first version")
+        other_worker = {}
+        with self.as_worker(other_worker):
+            self.assertEqual(self.contents("account"), {"resume.txt": "first version"})
+
+        ## Re-uploaded under the same name, the file names alone are unchanged
+        self.upload("account", "resume.txt", "second version")
+        with self.as_worker(other_worker):
+            self.assertEqual(self.contents("account"), {"resume.txt": "second version"})
+
+    def test_unchanged_files_keep_their_processor(self):
+        self.upload("account", "resume.txt", "resume")
+        self.upload("account", "letter.txt", "letter")
+        other_worker = {}
+        with self.as_worker(other_worker):
+            self.contents("account")
+        self.upload("account", "letter.txt", "new letter")
+        self.parsed.clear()
+        with self.as_worker(other_worker):
+            self.assertEqual(self.contents("account"), {"resume.txt": "resume", "letter.txt": "new letter"})
+        self.assertEqual(self.parsed, ["letter.txt"])
+
+    def test_same_content_keeps_the_version(self):
+        self.upload("account", "resume.txt", "resume")
+        version = attachment_processor.load_attachment_processors(self.store, "account").manifest_version
+        self.upload("account", "resume.txt", "resume")
+        self.assertEqual(attachment_processor.load_attachment_processors(self.store, "account").manifest_version,
+                         version)
+
+    def test_unregister_removes_the_file_everywhere(self):
+        self.upload("account", "resume.txt", "resume")
+        self.upload("account", "letter.txt", "letter")
+        attachment_processor.unregister_attachment(self.store, "account", "letter.txt")
+        with self.as_worker({}):
+            self.assertEqual(self.contents("account"), {"resume.txt": "resume"})
+        attachment_processor.unregister_attachment(self.store, "account", "resume.txt")
+        self.assertIsNone(attachment_processor.load_attachment_processors(self.store, "account"))
+
+    def test_concurrent_uploads_keep_every_file(self):
+        file_names = [f"file_{i}.txt" for i in range(40)]
+        for file_name in file_names:
+            with open(os.path.join(self.directory, file_name), "w") as raw_file:
+                raw_file.write(file_name)
+
+        def register(names):
+            for file_name in names:
+                attachment_processor.register_attachment(self.store, "account",
+                                                         attachment_processor.AttachmentProcessor(file_name))
+
+        threads = [threading.Thread(target=register, args=(file_names[i::4],)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        manifest = attachment_processor.read_manifest(self.store.get(("account",), "attachment_processors").value)
+        self.assertEqual(sorted(manifest["files"]), sorted(file_names))
+        self.assertEqual(manifest["version"], len(file_names))
+
+    def test_file_name_lists_of_before_are_read(self):
+        self.store.put(("account",), "attachment_processors", {"file_names": ["resume.txt"]})
+        with open(os.path.join(self.directory, "resume.txt"), "w") as raw_file:
+            raw_file.write("resume")
+        self.assertEqual(self.contents("account"), {"resume.txt": "resume"})
+
+
+
+class AnswerCacheTests(AttachmentsTestCase):
+    questions = {
+        "resume": ["What's in my resume?", "Summarize my resume", "what is in my resume"],
+        "invoice": ["How much is my last invoice?"],
+    }
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.embeddings = {}
+        for questions in self.questions.values():
+            center = rng.normal(size=768)
+            for question in questions:
+                ## Rephrasings of a question land close to each other, as the query embeddings do
+                self.embeddings[question] = center + rng.normal(scale=0.2, size=768)
+
+        async def embed_contents(contents, task_type):
+            return [self.embeddings.setdefault(content, rng.normal(size=768)).tolist() for content in contents]
+
+        self.cache = AnswerCache()
+        for target, name, value in [(etl, "embed_contents", embed_contents),
+                                    (etl, "get_embedding_cache", lambda: None),
+                                    (attachment_processor, "get_answer_cache", lambda: self.cache)]:
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        StubEngine.queries = 0
+
+    def ask(self, account_id, prompt):
+        """The answer, and whether the query engine was asked for it."""
+        queries = StubEngine.queries
+        answer = asyncio.run(attachment_processor.query_attachments.ainvoke(
+            {"store": self.store, "account_id": account_id, "prompt": prompt}))
+        return answer, StubEngine.queries > queries
+
+    def test_rephrased_questions_are_answered_from_the_cache(self):
+        self.upload("account", "resume.pdf", "resume")
+        first, queried = self.ask("account", self.questions["resume"][0])
+        self.assertTrue(queried)
+        for question in self.questions["resume"][1:]:
+            self.assertEqual(self.ask("account", question), (first, False))
+        self.assertTrue(self.ask("account", self.questions["invoice"][0])[1])
+        self.assertEqual(self.cache.metrics["hits"], 2)
+
+    def test_accounts_do_not_share_answers(self):
+        self.upload("account_a", "resume.pdf", "resume")
+        self.upload("account_b", "resume.pdf", "resume")
+        self.ask("account_a", self.questions["resume"][0])
+        self.assertTrue(self.ask("account_b", self.questions["resume"][1])[1])
+
+    def test_changed_attachments_drop_the_answers(self):
+        self.upload("account", "resume.pdf", "resume")
+        self.ask("account", self.questions["resume"][0])
+        self.upload("account", "cover_letter.pdf", "letter")
+        answer, queried = self.ask("account", self.questions["resume"][1])
+        self.assertTrue(queried)
+        self.assertIn("cover_letter.pdf", answer)
+        attachment_processor.unregister_attachment(self.store, "account", "cover_letter.pdf")
+        answer, queried = self.ask("account", self.questions["resume"][2])
+        self.assertTrue(queried)
+        self.assertNotIn("cover_letter.pdf", answer)
+
+    def test_other_workers_drop_the_answers_about_replaced_content(self):
+        self.upload("account", "resume.pdf", "first version")
+        other_worker = {}
+        with self.as_worker(other_worker):
+            answer, _ = self.ask("account", self.questions["resume"][0])
+        self.assertIn("first version", answer)
+        ## Replaced through another worker, which only the manifest in the store tells
+        self.upload("account", "resume.pdf", "second version")
+        with self.as_worker(other_worker):
+            answer, queried = self.ask("account", self.questions["resume"][1])
+        self.assertTrue(queried)
+        self.assertIn("second version", answer)
+
+    def test_attachments_changed_by_other_workers_are_rebuilt_off_the_event_loop(self):
+        self.upload("account", "resume.pdf", "resume")
+        process = attachment_processor.AttachmentProcessor.process
+        loops = []
+
+        def watched_process(processor):
+            loops.append(asyncio._get_running_loop())
+            process(processor)
+
+        with self.as_worker({}), \
+                mock.patch.object(attachment_processor.AttachmentProcessor, "process", watched_process):
+            answer, _ = self.ask("account", self.questions["resume"][0])
+        self.assertIn("resume", answer)
+        self.assertEqual(loops, [None])
+
+    def test_lru_bounds(self):
+        rng = np.random.default_rng(1)
+        cache = AnswerCache(max_entries=8, max_accounts=3)
+        for account in range(5):
+            for question in range(20):
+                cache.put(f"account_{account}", 1, f"Question {question}", rng.normal(size=768), f"Answer {question}")
+        self.assertEqual(len(cache), 3 * 8)
+        self.assertIsNone(cache.get("account_0", 1, "Question 19", rng.normal(size=768)))
+        self.assertEqual(cache.get("account_4", 1, "Question 19", rng.normal(size=768)), "Answer 19")
+        self.assertIsNone(cache.get("account_4", 1, "Question 0", rng.normal(size=768)))
@@ -0,0 +1,132 @@
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from agents.receptionist_agent import availability_cache, db, outbox, tools
+
+
+## Max simulated database latency, in seconds, to widen the race windows between the loads and the bookings
+MAX_DELAY = 0.005
+
+
+class AvailabilityCacheRaceTests(SimpleTestCase):
+    """ Concurrent bookings, made through the receptionist and from outside, raced against cached availability
+        reads on the in-process MongoDB stand-in.
+    """
+
+    accounts = 5
+    slots = 40
+    bookings = 150
+    external_bookings = 50
+    readers = 20
+    reads = 50
+
+    def setUp(self):
+        random.seed(0)
+        self.cache = availability_cache.AvailabilityCache(ttl=60, max_entries=self.accounts * 2)
+
+        async def skip_delivery(*args, **kwargs):
+            return 0
+
+        all_slot_times, reserve_or_suggest = db.all_slot_times, db.reserve_or_suggest
+
+        async def slow_all_slot_times(*args, **kwargs):
+            await asyncio.sleep(random.uniform(0, MAX_DELAY))
+            times = await all_slot_times(*args, **kwargs)
+            await asyncio.sleep(random.uniform(0, MAX_DELAY))
+            return times
+
+        async def slow_reserve_or_suggest(*args, **kwargs):
+            await asyncio.sleep(random.uniform(0, MAX_DELAY))
+            return await reserve_or_suggest(*args, **kwargs)
+
+        ## Changes are fed to the cache by the test, as the change stream would
+        for module, target, value in [(db, "MONGODB_URI", "mongomock://"),
+                                      (db, "MONGODB_SEED_FILE", None),
+                                      (db, "all_slot_times", slow_all_slot_times),
+                                      (db, "reserve_or_suggest", slow_reserve_or_suggest),
+                                      (availability_cache, "AVAILABILITY_CACHE_WATCH", False),
+                                      (tools, "get_availability_cache", lambda: self.cache),
+                                      (outbox, "submit", skip_delivery)]:
+            patcher = mock.patch.object(module, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        db.get_client.cache_clear()
+        self.addCleanup(db.get_client.cache_clear)
+        self.all_slot_times = all_slot_times
+
+    def test_reads_never_see_a_booked_slot_free(self):
+        cache, all_slot_times = self.cache, self.all_slot_times
+        account_ids = [f"cache_test_account_{i}" for i in range(self.accounts)]
+        slot_times = [(datetime(2030, 1, 1, 9, 0) + timedelta(hours=i)).strftime('%Y-%m-%d %H:%M')
+                      for i in range(self.slots)]
+        booked_at = {}      # (account_id, start_time) -> when the booking was done
+        ## Spread the bookings over the time the readers run
+        spread = self.reads * MAX_DELAY
+        errors = []
+
+        async def book_through_receptionist(i):
+            await asyncio.sleep(random.uniform(0, spread))
+            account_id, start_time = random.choice(account_ids), random.choice(slot_times)
+            out = await tools.book_job_tool.ainvoke({"account_id": account_id, "title": f"Job {i}",
+                                                     "client_email": "client@example.com", "start_time": start_time})
+            if out["response"].startswith("Booked"):
+                if (account_id, start_time) in booked_at:
+                    errors.append(f"{account_id} {start_time} booked twice")
+                booked_at[(account_id, start_time)] = time.perf_counter()
+
+        async def book_from_outside(i):
+            await asyncio.sleep(random.uniform(0, spread))
+            account_id, start_time = random.choice(account_ids), random.choice(slot_times)
+            if await db.reserve_slot(account_id, "jobs", start_time, "outside@example.com", f"Outside {i}", "Virtual"):
+                slot = await db.find_slot(account_id, "jobs", start_time)
+                await asyncio.sleep(random.uniform(0, MAX_DELAY))
+                cache.apply_change({"operationType": "update", "fullDocument": slot})
+                booked_at[(account_id, start_time)] = time.perf_counter()
+
+        async def read(reader):
+            for _ in range(self.reads):
+                account_id = random.choice(account_ids)
+                started = time.perf_counter()
+                free_times = set(await cache.free_times(account_id, "jobs"))
+                for start_time in free_times:
+                    if booked_at.get((account_id, start_time), float("inf")) < started:
+                        errors.append(f"Reader {reader} saw {account_id} {start_time} free after it was booked")
+                if random.random() < 0.05:
+                    cache.invalidate(account_id)
+                await asyncio.sleep(random.uniform(0, MAX_DELAY))
+
+        async def run_all():
+            await db.ensure_indexes()
+            await db.get_accounts().insert_many([{"account_id": account_id} for account_id in account_ids])
+            await db.get_clients().insert_many([
+                {"account_id": account_id, "name": "Test Client", "email": "client@example.com", "phone": "0000000000"}
+                for account_id in account_ids])
+            await db.get_slots().insert_many([
+                {"account_id": account_id, "booking_type": "jobs", "start_time": start_time, "is_booked": False,
+                 "client_email": "", "title": "", "location": ""}
+                for account_id in account_ids for start_time in slot_times])
+            try:
+                await asyncio.gather(*(book_through_receptionist(i) for i in range(self.bookings)),
+                                     *(book_from_outside(i) for i in range(self.external_bookings)),
+                                     *(read(reader) for reader in range(self.readers)))
+                cached = {account_id: await cache.free_times(account_id, "jobs") for account_id in account_ids}
+                stored = {account_id: await all_slot_times(account_id, "jobs", is_booked=False)
+                          for account_id in account_ids}
+                booked = await db.get_slots().count_documents({"account_id": {"$in": account_ids}, "is_booked": True})
+                return cached, stored, booked
+            finally:
+                for collection in (db.get_accounts(), db.get_clients(), db.get_slots()):
+                    await collection.delete_many({"account_id": {"$in": account_ids}})
+
+        cached, stored, booked = asyncio.run(run_all())
+
+        self.assertEqual(errors[:20], [])
+        self.assertEqual(cached, stored)
+        self.assertEqual(booked, len(booked_at))
+        self.assertGreater(len(booked_at), 0)
+        self.assertGreater(cache.metrics["hits"], 0)
@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from agents.receptionist_agent import db, tools
+from agents.receptionist_agent.response_templates import get_templates, render_one
+
+
+class ReserveOrSuggestTests(SimpleTestCase):
+    """The booking of a slot, and the free slots suggested when it is taken, on the in-process MongoDB stand-in."""
+
+    account_id = "reserve_test_account"
+
+    def setUp(self):
+        for target, value in [("MONGODB_URI", "mongomock://"), ("MONGODB_SEED_FILE", None)]:
+            patcher = mock.patch.object(db, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        db.get_client.cache_clear()
+        self.addCleanup(db.get_client.cache_clear)
+        ## Every hour of ten days, the ones of the first day booked by someone else
+        self.times = [(datetime(2030, 1, 1, 0, 0) + timedelta(hours=i)).strftime(db.SLOT_TIME_FORMAT)
+                      for i in range(240)]
+        asyncio.run(db.get_slots().insert_many([
+            {"account_id": self.account_id, "booking_type": "jobs", "start_time": start_time, "is_booked": i < 24,
+             "client_email": "other@example.com" if i < 24 else "", "title": "", "location": ""}
+            for i, start_time in enumerate(self.times)]))
+
+    def reserve(self, start_time, client_email="client@example.com", suggestions=db.SLOT_SUGGESTIONS, now=None):
+        return asyncio.run(db.reserve_or_suggest(self.account_id, "jobs", start_time, client_email, "Job", "Virtual",
+                                                 suggestions=suggestions, now=now))
+
+    def test_free_slot_is_booked(self):
+        outcome = self.reserve(self.times[100])
+        self.assertTrue(outcome["reserved"])
+        self.assertEqual(outcome["alternatives"], [])
+        slot = asyncio.run(db.find_slot(self.account_id, "jobs", self.times[100]))
+        self.assertEqual(outcome["slot"], slot)
+
+    def test_taken_slot_suggests_the_nearest_free_slots(self):
+        self.reserve(self.times[50])
+        outcome = self.reserve(self.times[50], client_email="late@example.com", suggestions=4)
+        self.assertFalse(outcome["reserved"])
+        self.assertEqual(outcome["slot"]["client_email"], "client@example.com")
+        self.assertEqual(outcome["alternatives"], [self.times[48], self.times[49], self.times[51], self.times[52]])
+
+    def test_suggestions_skip_the_booked_slots(self):
+        outcome = self.reserve(self.times[20], suggestions=3)
+        self.assertFalse(outcome["reserved"])
+        self.assertEqual(outcome["alternatives"], self.times[24:27])
+
+    def test_own_booking_needs_no_suggestions(self):
+        self.reserve(self.times[50])
+        outcome = self.reserve(self.times[50])
+        self.assertFalse(outcome["reserved"])
+        self.assertEqual(outcome["slot"]["client_email"], "client@example.com")
+        self.assertEqual(outcome["alternatives"], [])
+
+    def test_missing_slot_suggests_the_free_slots_around_it(self):
+        outcome = self.reserve("2030-01-03 10:30", suggestions=2)
+        self.assertFalse(outcome["reserved"])
+        self.assertIsNone(outcome["slot"])
+        self.assertEqual(outcome["alternatives"], ["2030-01-03 10:00", "2030-01-03 11:00"])
+
+    def test_slots_that_already_started_are_not_suggested(self):
+        self.reserve(self.times[50])
+        now = datetime.strptime(self.times[49], db.SLOT_TIME_FORMAT) - timedelta(minutes=30)
+        outcome = self.reserve(self.times[50], client_email="late@example.com", suggestions=4, now=now)
+        self.assertEqual(outcome["alternatives"], [self.times[49], self.times[51], self.times[52], self.times[53]])
+        ## Nothing before now, even when the slot asked for is itself in the past
+        outcome = self.reserve(self.times[20], client_email="late@example.com", suggestions=2, now=now)
+        self.assertFalse(outcome["reserved"])
+        self.assertEqual(outcome["alternatives"], [self.times[49], self.times[51]])
+
+
+class InvalidTimeTests(SimpleTestCase):
+    """Times the model wrote in another format than the tools take are answered, not raised out of the turn."""
+
+    def test_listing_with_an_unreadable_time(self):
+        tool_input = {"account_id": "account_id_1", "booking_type": "jobs", "from_time": "next friday"}
+        out = asyncio.run(tools.check_slot_availability_tool.ainvoke(tool_input))
+        self.assertEqual((out["status"], out["time"]), ("invalid_time", "next friday"))
+        sentence = render_one({"tool": "check_slot_availability_tool", "tool_input": tool_input, "output": out},
+                              get_templates())
+        self.assertIn("next friday", sentence)
+
+    def test_booking_with_an_unreadable_time_asks_for_it(self):
+        out = asyncio.run(tools.book_job_tool.ainvoke({"account_id": "account_id_1", "title": "Job", "location": "Site",
+                                                       "client_email": "client@example.com",
+                                                       "start_time": "tomorrow at 3pm"}))
+        self.assertEqual(out["status"], "invalid_time")
+        self.assertTrue(out["is_interrupted"])
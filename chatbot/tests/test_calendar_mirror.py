@@ -0,0 +1,244 @@
+import asyncio
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+from django.test import SimpleTestCase
+
+from agents.receptionist_agent import availability_cache, calendar_mirror, db, outbox, tools
+from agents.receptionist_agent.availability_rules import (BookingIndex, RuleBasedAvailability, free_slots,
+                                                          rules_from_account)
+from agents.receptionist_agent.calendar_mirror import CalendarMirror, FakeCalendarSource, event_interval
+
+
+class CalendarMirrorSyncTests(SimpleTestCase):
+    """A fake calendar mirrored through rounds of random changes and an expired sync token."""
+
+    events = 2000
+    rounds = 10
+    changes = 25
+    probes = 300
+    timezone = "America/New_York"
+
+    def setUp(self):
+        self.tz = ZoneInfo(self.timezone)
+        self.source = FakeCalendarSource(calendar_timezone=self.timezone)
+        self.mirror = CalendarMirror(self.source)
+        self.rng = random.Random(0)
+        self.first_day = (datetime.now(self.tz) + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.span_minutes = 60 * 24 * 90
+        self.calendar = {}
+
+    def random_event(self, event_id):
+        rng = self.rng
+        start = self.first_day + timedelta(minutes=rng.randrange(0, self.span_minutes, 15))
+        event = {"id": event_id, "status": "confirmed"}
+        if rng.random() < 0.05:
+            event["start"], event["end"] = {"date": start.date().isoformat()}, {"date": (start + timedelta(days=1)).date().isoformat()}
+        else:
+            ## Half with an offset, half as wall times of the calendar
+            end = start + timedelta(minutes=rng.choice([15, 30, 60, 90]))
+            if rng.random() < 0.5:
+                event["start"], event["end"] = {"dateTime": start.isoformat()}, {"dateTime": end.isoformat()}
+            else:
+                event["start"] = {"dateTime": start.replace(tzinfo=None).isoformat(), "timeZone": self.timezone}
+                event["end"] = {"dateTime": end.replace(tzinfo=None).isoformat(), "timeZone": self.timezone}
+        if rng.random() < 0.05:
+            event["transparency"] = "transparent"
+        return event
+
+    def put(self, event):
+        self.calendar[event["id"]] = event
+        self.source.put_event(event)
+
+    def assertMirrorsCalendar(self, label):
+        expected = [interval for interval in (event_interval(event, self.tz) for event in self.calendar.values()) if interval]
+        for _ in range(self.probes):
+            start = (self.first_day + timedelta(minutes=self.rng.randrange(0, self.span_minutes, 15))).replace(tzinfo=None)
+            end = start + timedelta(minutes=60)
+            utc_start, utc_end = (moment.replace(tzinfo=self.tz).astimezone(timezone.utc) for moment in (start, end))
+            busy = any(event_start < utc_end and utc_start < event_end for event_start, event_end in expected)
+            self.assertEqual(self.mirror.is_busy(start, end, self.tz), busy, f"{label}: {start}")
+
+    def test_syncs_follow_the_changes(self):
+        for i in range(self.events):
+            self.put(self.random_event(f"event-{i}"))
+        self.assertFalse(self.mirror.ready)
+        self.mirror.sync_once()
+        self.assertTrue(self.mirror.ready)
+        self.assertEqual(self.source.items_served, self.events)
+        self.assertMirrorsCalendar("full sync")
+
+        next_id = self.events
+        for round_number in range(self.rounds):
+            changed = set()
+            for _ in range(self.changes):
+                action = self.rng.random()
+                if action < 0.4 or not self.calendar:
+                    event_id, next_id = f"event-{next_id}", next_id + 1
+                    self.put(self.random_event(event_id))
+                else:
+                    event_id = self.rng.choice(list(self.calendar))
+                    if action < 0.7:
+                        self.put(self.random_event(event_id))
+                    else:
+                        del self.calendar[event_id]
+                        self.source.cancel_event(event_id)
+                changed.add(event_id)
+            expired = round_number == self.rounds // 2
+            if expired:
+                self.source.expire_tokens()
+            served = self.source.items_served
+            self.mirror.sync_once()
+            if not expired:
+                ## Only the events that changed are fetched
+                self.assertEqual(self.source.items_served - served, len(changed), f"round {round_number}")
+            self.assertMirrorsCalendar(f"round {round_number}")
+        self.assertEqual(self.mirror.metrics["expired_tokens"], 1)
+        self.assertEqual(self.mirror.metrics["full_syncs"], 2)
+
+    def test_rule_slots_skip_the_meetings(self):
+        rules = rules_from_account({"availability": {"hours": {day: [["09:00", "17:00"]] for day in
+                                                               ("mon", "tue", "wed", "thu", "fri", "sat", "sun")}}}, "jobs")
+        day = (self.first_day + timedelta(days=30)).replace(tzinfo=None)
+        self.put({"id": "owner-meeting", "start": {"dateTime": (day + timedelta(hours=10)).isoformat(), "timeZone": self.timezone},
+                  "end": {"dateTime": (day + timedelta(hours=12)).isoformat(), "timeZone": self.timezone}})
+        self.mirror.sync_once()
+        now = datetime.now(self.tz).replace(tzinfo=None)
+        slots = free_slots(rules, BookingIndex(), self.tz, now, from_time=day, to_time=day + timedelta(days=1),
+                           calendar=self.mirror)
+        self.assertIn(f"{day.date()} 09:00", slots)
+        self.assertNotIn(f"{day.date()} 10:00", slots)
+        self.assertNotIn(f"{day.date()} 11:00", slots)
+
+
+class GatedCalendarSource(FakeCalendarSource):
+    """A fake calendar whose answers wait until the test lets them through, as a slow first sync would."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+
+    def changes(self, sync_token):
+        self.gate.wait()
+        return super().changes(sync_token)
+
+
+class CalendarMirrorReadinessTests(SimpleTestCase):
+    """Bookings made while the first sync of the mirror is still pending, on the in-process MongoDB stand-in."""
+
+    account_id = "calendar_test_account"
+    other_account_id = "calendar_test_other_account"
+    rules_account_id = "calendar_test_rules_account"
+
+    def setUp(self):
+        self.day = (datetime.now(timezone.utc) + timedelta(days=30)).strftime("%Y-%m-%d")
+        self.source = GatedCalendarSource()
+        ## The owner's meeting keeps 10:00 to 11:00 busy
+        self.source.put_event({"id": "owner-meeting", "start": {"dateTime": f"{self.day}T10:00:00+00:00"},
+                               "end": {"dateTime": f"{self.day}T11:00:00+00:00"}})
+        self.mirror = CalendarMirror(self.source, poll_seconds=60)
+        self.addCleanup(self.mirror.stop)
+        self.addCleanup(self.source.gate.set)
+
+        async def deliver_to_the_calendar(kind, account_id, payload):
+            ## Every account books into the same calendar, as GoogleDeliverer does
+            event_id = f"booking-{len(self.delivered)}"
+            self.delivered.append(event_id)
+            self.source.put_event({"id": event_id, **payload})
+            return event_id
+
+        self.delivered = []
+
+        cache = availability_cache.AvailabilityCache(ttl=60)
+        rule_availability = RuleBasedAvailability()
+        for module, target, value in [(db, "MONGODB_URI", "mongomock://"),
+                                      (db, "MONGODB_SEED_FILE", None),
+                                      (availability_cache, "AVAILABILITY_CACHE_WATCH", False),
+                                      (tools, "get_availability_cache", lambda: cache),
+                                      (tools, "get_rule_availability", lambda: rule_availability),
+                                      (outbox, "submit", deliver_to_the_calendar),
+                                      (calendar_mirror, "active_calendar_mirror", self.start_mirror),
+                                      (calendar_mirror, "CALENDAR_MIRROR_READY_TIMEOUT", 2)]:
+            patcher = mock.patch.object(module, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        db.get_client.cache_clear()
+        self.addCleanup(db.get_client.cache_clear)
+        asyncio.run(self.seed())
+
+    def start_mirror(self):
+        self.mirror.start()
+        return self.mirror
+
+    async def seed(self):
+        every_day = {day: [["09:00", "17:00"]] for day in ("mon", "tue", "wed", "thu", "fri", "sat", "sun")}
+        await db.get_accounts().insert_many([
+            {"account_id": self.account_id, "timezone": "UTC"},
+            {"account_id": self.other_account_id, "timezone": "UTC"},
+            {"account_id": self.rules_account_id, "timezone": "UTC", "availability": {"hours": every_day}}])
+        await db.get_clients().insert_many([
+            {"account_id": account_id, "name": "Test Client", "email": "client@example.com", "phone": "0000000000"}
+            for account_id in (self.account_id, self.other_account_id, self.rules_account_id)])
+        await db.get_slots().insert_many([
+            {"account_id": account_id, "booking_type": "jobs", "start_time": f"{self.day} {hour:02d}:00",
+             "is_booked": False, "client_email": "", "title": "", "location": ""}
+            for account_id in (self.account_id, self.other_account_id) for hour in range(9, 17)])
+
+    def book(self, account_id, start_time):
+        return tools.book_job_tool.ainvoke({"account_id": account_id, "title": "Job", "client_email": "client@example.com",
+                                            "start_time": start_time})
+
+    async def book_while_the_first_sync_is_pending(self, account_id):
+        booking = asyncio.create_task(self.book(account_id, f"{self.day} 10:00"))
+        await asyncio.sleep(0.2)
+        self.assertFalse(booking.done(), "The booking did not wait for the first sync of the calendar")
+        self.source.gate.set()
+        return await booking
+
+    def test_booking_waits_for_the_first_sync(self):
+        out = asyncio.run(self.book_while_the_first_sync_is_pending(self.account_id))
+        self.assertEqual(out["status"], "unavailable")
+        self.assertNotIn(f"{self.day} 10:00", out["slots"])
+        slot = asyncio.run(db.find_slot(self.account_id, "jobs", f"{self.day} 10:00"))
+        self.assertFalse(slot["is_booked"])
+
+    def test_rule_booking_waits_for_the_first_sync(self):
+        out = asyncio.run(self.book_while_the_first_sync_is_pending(self.rules_account_id))
+        self.assertEqual(out["status"], "unavailable")
+        self.assertEqual(asyncio.run(db.booked_intervals(self.rules_account_id, "jobs")), [])
+
+    def test_booking_is_refused_when_the_first_sync_does_not_end(self):
+        with mock.patch.object(calendar_mirror, "CALENDAR_MIRROR_READY_TIMEOUT", 0.2):
+            out = asyncio.run(self.book(self.account_id, f"{self.day} 10:00"))
+        self.assertEqual(out["status"], "calendar_not_ready")
+        slot = asyncio.run(db.find_slot(self.account_id, "jobs", f"{self.day} 10:00"))
+        self.assertFalse(slot["is_booked"])
+
+    def test_listing_goes_on_without_the_calendar(self):
+        with mock.patch.object(calendar_mirror, "CALENDAR_MIRROR_READY_TIMEOUT", 0.2):
+            slots = asyncio.run(tools.free_slots_page(self.account_id, "jobs", from_time=self.day))
+        self.assertIn(f"{self.day} 10:00", slots)
+        self.source.gate.set()
+        self.assertTrue(asyncio.run(self.mirror.wait_ready(5)))
+        slots = asyncio.run(tools.free_slots_page(self.account_id, "jobs", from_time=self.day))
+        self.assertNotIn(f"{self.day} 10:00", slots)
+        self.assertIn(f"{self.day} 11:00", slots)
+
+    def test_bookings_of_an_account_do_not_block_the_others(self):
+        self.source.gate.set()
+        for account_id in (self.account_id, self.rules_account_id):
+            out = asyncio.run(self.book(account_id, f"{self.day} 12:00"))
+            self.assertEqual(out["status"], "booked")
+        self.mirror.sync_once()
+        self.assertEqual(self.mirror.metrics["changes"], 3)
+        out = asyncio.run(self.book(self.other_account_id, f"{self.day} 12:00"))
+        self.assertEqual(out["status"], "booked")
+        slots = asyncio.run(tools.free_slots_page(self.rules_account_id, "jobs", from_time=self.day))
+        self.assertNotIn(f"{self.day} 12:00", slots)
+        self.assertIn(f"{self.day} 13:00", slots)
+        ## Rebooking their own slot is recognized as such, not refused for the event of the booking
+        out = asyncio.run(self.book(self.account_id, f"{self.day} 12:00"))
+        self.assertEqual(out["status"], "already_booked")
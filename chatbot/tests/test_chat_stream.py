@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+import re
+import tempfile
+from unittest import mock
+
+from django.test import AsyncClient, SimpleTestCase, override_settings
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.runnables import RunnableLambda
+
+from agents import persistence, supervisor_agent
+from agents.history import HistoryCompactor
+from agents.intent_router import RouteDecision
+from agents.receptionist_agent import db, response_templates, tools
+from agents.receptionist_agent import graph as receptionist_graph
+
+
+class FakeToolCallingModel(GenericFakeChatModel):
+    """Streams the text of each message word by word, then its tool calls as tool call chunks."""
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = next(self.messages)
+        for token in re.split(r"(\s)", message.content):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        for index, tool_call in enumerate(message.tool_calls):
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                {"name": tool_call["name"], "args": json.dumps(tool_call["args"]), "id": tool_call["id"],
+                 "index": index}]))
+
+
+class RouteToReceptionist:
+    def classify(self, text):
+        return RouteDecision(next_agent="receptionist_agent", confidence=1.0)
+
+    def record(self, text, next_agent):
+        pass
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ChatStreamViewTests(SimpleTestCase):
+    """ The Server-Sent Events of a receptionist turn that calls a tool, with a fake model, the in-process MongoDB
+        stand-in and a throwaway state database.
+    """
+
+    account_id = "stream_test_account"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        pool = persistence.SqliteConnectionPool(os.path.join(directory.name, "agent_state.sqlite3"))
+        self.addCleanup(pool.close)
+        cached = (persistence.get_checkpointer, persistence.get_store, supervisor_agent.get_top_level_supervisor,
+                  receptionist_graph.get_receptionist_agent, receptionist_graph.get_receptionist_llm,
+                  receptionist_graph.get_response_synthesizer_llm, db.get_client)
+        for function in cached:
+            self.addCleanup(function.cache_clear)
+            function.cache_clear()
+        self.addCleanup(supervisor_agent.set_router, supervisor_agent.intent_router)
+        supervisor_agent.set_router(RouteToReceptionist())
+
+        self.model = FakeToolCallingModel(messages=iter([
+            AIMessage(content="Let me look that client up.", tool_calls=[
+                {"name": "crud_client_tool", "args": {"operation": "read", "client_email": "ann@example.com"},
+                 "id": "call_1"}]),
+            AIMessage(content="Ann is one of your clients."),
+        ]))
+        history_compactor = HistoryCompactor(persistence.SqliteStore(pool),
+                                             RunnableLambda(lambda inputs: AIMessage(content="summary")))
+        for module, target, value in [
+                (persistence, "get_connection_pool", lambda path=None: pool),
+                (supervisor_agent, "get_history_compactor", lambda: history_compactor),
+                (receptionist_graph, "get_chat_model", lambda: self.model),
+                ## The synthesizer model answers, rather than a template
+                (response_templates, "RESPONSE_TEMPLATES_MODE", "off"),
+                (db, "MONGODB_URI", "mongomock://"),
+                (db, "MONGODB_SEED_FILE", None)]:
+            patcher = mock.patch.object(module, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        asyncio.run(tools.crud_client_tool.ainvoke({"account_id": self.account_id, "operation": "create",
+                                                    "client_email": "ann@example.com", "client_name": "Ann"}))
+
+    async def stream_events(self, message):
+        response = await AsyncClient().post("/chat/stream/", {"message": message, "account_id": self.account_id},
+                                            content_type="application/json")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = "".join([chunk.decode() async for chunk in response.streaming_content])
+        events = []
+        for block in body.strip().split("\n\n"):
+            kind, data = block.split("\n")
+            events.append((kind.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+        return events
+
+    def test_only_the_answer_of_the_turn_is_streamed(self):
+        events = asyncio.run(self.stream_events("Is ann@example.com one of my clients?"))
+        *tokens, (kind, done) = events
+        self.assertEqual(kind, "done")
+        self.assertEqual(done, {"response": "Ann is one of your clients.", "is_interrupted": False})
+        self.assertEqual({kind for kind, _ in tokens}, {"token"})
+        ## The text and the tool call chunks of the tool-calling model never reach the stream
+        self.assertEqual("".join(data["content"] for _, data in tokens), "Ann is one of your clients.")
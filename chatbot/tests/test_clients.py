@@ -0,0 +1,42 @@
+import asyncio
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from agents.receptionist_agent import db, tools
+
+
+class CrudClientTests(SimpleTestCase):
+    """The client operations of the receptionist, on the in-process MongoDB stand-in with its unique indexes."""
+
+    account_id = "clients_test_account"
+
+    def setUp(self):
+        for target, value in [("MONGODB_URI", "mongomock://"), ("MONGODB_SEED_FILE", None)]:
+            patcher = mock.patch.object(db, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        db.get_client.cache_clear()
+        self.addCleanup(db.get_client.cache_clear)
+        asyncio.run(db.ensure_indexes())
+        for email in ("ann@example.com", "bob@example.com"):
+            self.crud("create", email, client_name=email.split("@")[0])
+
+    def crud(self, operation, client_email, **fields):
+        return asyncio.run(tools.crud_client_tool.ainvoke({"account_id": self.account_id, "operation": operation,
+                                                           "client_email": client_email, **fields}))
+
+    def test_email_change_to_the_email_of_another_client_is_refused(self):
+        out = self.crud("update", "ann@example.com", new_client_email="bob@example.com")
+        self.assertEqual(out["status"], "email_taken")
+        client = asyncio.run(db.find_client(self.account_id, email="ann@example.com"))
+        self.assertEqual(client["name"], "ann")
+
+    def test_email_change_to_a_free_email(self):
+        out = self.crud("update", "ann@example.com", new_client_email="ann@work.example.com")
+        self.assertEqual(out["status"], "updated")
+        self.assertEqual(self.crud("read", "ann@work.example.com")["client"]["name"], "ann")
+        self.assertEqual(self.crud("update", "ann@example.com", client_name="Ann")["status"], "not_found")
+
+    def test_existing_client_is_not_created_again(self):
+        self.assertEqual(self.crud("create", "bob@example.com")["status"], "exists")
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from agents.persistence import SqliteConnectionPool
+from agents.RAG_agent import attachment_processor, etl
+from agents.RAG_agent.embedding_cache import EmbeddingCache
+
+
+## Dimensions of the stub embeddings
+DIMENSIONS = 768
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    """The embeddings of the ETL and the queries, through the cache, against a stub model."""
+
+    texts = [f"Chunk {i} of a crawled page" for i in range(500)]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.embedded = []
+
+        async def stub_embed_contents(contents, task_type):
+            self.embedded.extend(contents)
+            return [[(hash((task_type, content)) % 1000 + d) / 1000 for d in range(DIMENSIONS)] for content in contents]
+
+        patcher = mock.patch.object(etl, "embed_contents", stub_embed_contents)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = self.open_cache("embedding_cache.sqlite3", max_bytes=DIMENSIONS * 4 * len(self.texts) * 2)
+
+    def open_cache(self, file_name, max_bytes):
+        pool = SqliteConnectionPool(os.path.join(self.directory, file_name), size=2)
+        self.addCleanup(pool.close)
+        return EmbeddingCache(pool, max_bytes=max_bytes)
+
+    def embed(self, chunks, is_document=True, cache=None):
+        """The embeddings of the chunks, and the texts the model was called with."""
+        self.embedded.clear()
+        with mock.patch.object(etl, "get_embedding_cache", lambda: cache or self.cache):
+            embeddings = asyncio.run(etl.get_embeddings_batch(chunks, is_document))
+        return embeddings, list(self.embedded)
+
+    def test_recrawl_only_embeds_the_new_chunks(self):
+        texts = self.texts
+        first, calls = self.embed(texts + texts[:10])
+        ## A repeated chunk is embedded once
+        self.assertEqual(len(calls), len(texts))
+        second, calls = self.embed(texts[:len(texts) // 2] + ["A new chunk"])
+        self.assertEqual(calls, ["A new chunk"])
+        ## The cache keeps float32 vectors
+        self.assertTrue(np.allclose(second[:-1], first[:len(texts) // 2], atol=1e-6))
+
+    def test_queries_are_cached_apart_from_the_documents(self):
+        document, _ = self.embed(self.texts[:1])
+        query, calls = self.embed(self.texts[:1], is_document=False)
+        ## Their task type gives other vectors
+        self.assertEqual(calls, self.texts[:1])
+        self.assertNotEqual(query[0], document[0])
+        _, calls = self.embed(self.texts[:1], is_document=False)
+        self.assertEqual(calls, [])
+
+    def test_restarted_process_finds_the_embeddings_on_disk(self):
+        self.embed(self.texts[:100])
+        restarted = self.open_cache("embedding_cache.sqlite3", max_bytes=self.cache.max_bytes)
+        _, calls = self.embed(self.texts[:100], cache=restarted)
+        self.assertEqual(calls, [])
+
+    def test_least_recently_used_embeddings_go_past_the_size_cap(self):
+        small = self.open_cache("small.sqlite3", max_bytes=DIMENSIONS * 4 * 100)
+        self.embed(self.texts[:80], cache=small)
+        with small.pool.connection() as connection:
+            connection.execute("UPDATE embeddings SET last_used = last_used - 3600")
+        small.get_many(etl.EMBEDDING_MODEL, "RETRIEVAL_DOCUMENT", self.texts[:10])
+        self.embed(self.texts[80:120], cache=small)
+        with small.pool.connection() as connection:
+            stored = connection.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        self.assertLessEqual(stored, small.max_bytes)
+        _, calls = self.embed(self.texts[:10], cache=small)
+        self.assertEqual(calls, [], "Recently used embeddings were evicted")
+
+    def test_uploaded_again_attachment_is_embedded_from_the_cache(self):
+        model = attachment_processor.CachedEmbedding(model_name=etl.EMBEDDING_MODEL)
+        with mock.patch.object(etl, "get_embedding_cache", lambda: self.cache):
+            first = model.get_text_embedding_batch(self.texts[:20])
+            self.assertEqual(len(self.embedded), 20)
+            self.embedded.clear()
+            again = model.get_text_embedding_batch(self.texts[:20])
+            model.get_query_embedding("What does the attachment say?")
+            model.get_query_embedding("What does the attachment say?")
+        self.assertEqual(self.embedded, ["What does the attachment say?"])
+        self.assertTrue(np.allclose(again, first, atol=1e-6))
@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from agents.receptionist_agent import google_clients
+from agents.receptionist_agent.google_clients import GoogleAuthorizationError, GoogleClientManager
+
+
+def token(expiry: datetime, refresh_token="refresh") -> str:
+    return json.dumps({"token": "access", "refresh_token": refresh_token, "client_id": "id", "client_secret": "secret",
+                       "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ")})
+
+
+class GoogleAuthorizationTests(SimpleTestCase):
+    """The browser flow only runs from `authorize`, the other paths raise instead of blocking on it."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.token_file = os.path.join(directory.name, "token.json")
+        self.manager = GoogleClientManager(token_file=self.token_file, client_secrets_file="missing.json")
+        self.addCleanup(self.manager.stop)
+        patcher = mock.patch.object(google_clients, "InstalledAppFlow")
+        self.flow = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_token(self, content):
+        with open(self.token_file, "w") as token_file:
+            token_file.write(content)
+
+    def test_missing_token_raises_without_the_browser_flow(self):
+        with self.assertRaisesRegex(GoogleAuthorizationError, "authorize_google"):
+            self.manager.credentials()
+        self.flow.from_client_secrets_file.assert_not_called()
+
+    def test_expired_token_without_refresh_token_raises(self):
+        self.write_token(token(datetime.utcnow() - timedelta(hours=1), refresh_token=None))
+        with self.assertRaises(GoogleAuthorizationError):
+            self.manager.credentials()
+        self.flow.from_client_secrets_file.assert_not_called()
+
+    def test_failed_refresh_of_an_expired_token_raises(self):
+        self.write_token(token(datetime.utcnow() - timedelta(hours=1)))
+        with mock.patch.object(google_clients.Credentials, "refresh", side_effect=Exception("invalid_grant")):
+            with self.assertRaisesRegex(GoogleAuthorizationError, "invalid_grant"):
+                self.manager.credentials()
+        self.assertEqual(self.manager.metrics["failed_refreshes"], 1)
+        self.flow.from_client_secrets_file.assert_not_called()
+
+    def test_refresher_survives_a_revoked_token(self):
+        self.write_token(token(datetime.utcnow() + timedelta(hours=1)))
+        self.manager.credentials()
+        refreshed = threading.Event()
+
+        def revoked(request):
+            refreshed.set()
+            raise Exception("invalid_grant")
+
+        with mock.patch.object(google_clients.Credentials, "refresh", side_effect=revoked):
+            ## The token now expires within the margin, and stops being valid
+            self.manager._credentials.expiry = datetime.utcnow() - timedelta(seconds=1)
+            self.manager._wake.set()
+            self.assertTrue(refreshed.wait(5))
+            ## Taken once the refresher is back to waiting
+            with self.manager._lock:
+                self.assertTrue(self.manager._last_refresh_failed)
+        self.assertTrue(self.manager._refresher.is_alive())
+        self.flow.from_client_secrets_file.assert_not_called()
+
+    def test_authorize_saves_the_token_of_the_flow(self):
+        credentials = google_clients.Credentials.from_authorized_user_info(
+            json.loads(token(datetime.utcnow() + timedelta(hours=1))))
+        self.flow.from_client_secrets_file.return_value.run_local_server.return_value = credentials
+        self.manager.authorize()
+        with open(self.token_file) as token_file:
+            self.assertEqual(json.loads(token_file.read())["token"], "access")
+        self.assertIs(self.manager.credentials(), credentials)
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import random
+import tempfile
+from collections import defaultdict
+from unittest import mock
+
+from django.test import SimpleTestCase
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from agents import persistence, supervisor_agent
+from agents.concurrency import thread_locks
+from agents.history import HistoryCompactor
+from agents.intent_router import RouteDecision
+from agents.receptionist_agent import graph as receptionist_graph
+
+
+## Max simulated model latency, in seconds
+MAX_DELAY = 0.01
+
+
+class StubRouter:
+    def classify(self, text):
+        return RouteDecision(next_agent=None, confidence=0.0)
+
+    def record(self, text, next_agent):
+        pass
+
+
+class GraphConcurrencyTests(SimpleTestCase):
+    """ Interleaved turns of many accounts through the supervisor graph, with stub models and a throwaway state
+        database: no turn sees another account's thread, and the turns of an account never overlap.
+    """
+
+    accounts = 100
+    turns = 3
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        pool = persistence.SqliteConnectionPool(os.path.join(directory.name, "agent_state.sqlite3"))
+        self.addCleanup(pool.close)
+        ## The graphs compiled with the throwaway database are dropped once the patches are undone
+        cached = (persistence.get_checkpointer, persistence.get_store, supervisor_agent.get_top_level_supervisor,
+                  receptionist_graph.get_receptionist_agent)
+        for function in cached:
+            self.addCleanup(function.cache_clear)
+            function.cache_clear()
+        self.addCleanup(supervisor_agent.set_router, supervisor_agent.intent_router)
+        supervisor_agent.set_router(StubRouter())
+
+        self.errors = []
+        self.active_turns = defaultdict(int)
+        history_compactor = HistoryCompactor(persistence.SqliteStore(pool),
+                                             RunnableLambda(lambda inputs: AIMessage(content="summary")))
+        for module, target, value in [
+                (persistence, "get_connection_pool", lambda path=None: pool),
+                (supervisor_agent, "get_supervisor_llm", lambda: RunnableLambda(self.stub_supervisor)),
+                (supervisor_agent, "get_history_compactor", lambda: history_compactor),
+                (receptionist_graph, "get_receptionist_llm", lambda: RunnableLambda(self.stub_receptionist))]:
+            patcher = mock.patch.object(module, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def check_thread(self, state, config, stage):
+        thread_id = config["configurable"]["thread_id"]
+        if state["account_id"] != thread_id:
+            self.errors.append(f"{stage}: state of {state['account_id']} ran on thread {thread_id}")
+        return thread_id
+
+    async def stub_supervisor(self, state, config):
+        self.check_thread(state, config, "supervisor")
+        self.active_turns[state["account_id"]] += 1
+        if self.active_turns[state["account_id"]] > 1:
+            self.errors.append(f"Overlapping turns for {state['account_id']}")
+        await asyncio.sleep(random.uniform(0, MAX_DELAY))
+        self.active_turns[state["account_id"]] -= 1
+        return supervisor_agent.NextAgent(next_agent="receptionist_agent")
+
+    async def stub_receptionist(self, state, config):
+        thread_id = self.check_thread(state, config, "receptionist")
+        await asyncio.sleep(random.uniform(0, MAX_DELAY))
+        return AIMessage(content=f"{thread_id}:{state['user_input']}")
+
+    def test_interleaved_turns_stay_on_their_thread(self):
+        async def run_account(account_id):
+            for turn in range(self.turns):
+                user_input = f"turn {turn}"
+                response, _ = await supervisor_agent.process_input(user_input, account_id)
+                if response != f"{account_id}:{user_input}":
+                    self.errors.append(f"{account_id} got response {response!r} for {user_input!r}")
+
+        async def run_all():
+            await asyncio.gather(*(run_account(f"stress_account_{i}") for i in range(self.accounts)))
+
+        locks = len(thread_locks)
+        asyncio.run(run_all())
+        self.assertEqual(self.errors, [])
+        ## The lock of a thread is dropped once no turn waits on it
+        self.assertEqual(len(thread_locks), locks)
@@ -0,0 +1,107 @@
+import asyncio
+from unittest import mock
+
+from django.test import SimpleTestCase
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
+from langgraph.store.memory import InMemoryStore
+
+from agents.history import HISTORY_SUMMARY_NAMESPACE, HistoryCompactor, summary_state_update, with_history
+
+
+def conversation(turns, start=0):
+    messages = []
+    for turn in range(start, start + turns):
+        messages.append(HumanMessage(content=f"question {turn} " * 10, id=f"human_{turn}"))
+        messages.append(AIMessage(content=f"answer {turn} " * 10, id=f"ai_{turn}"))
+    return messages
+
+
+class HistoryCompactorTests(SimpleTestCase):
+    """ Folding of the older turns of a thread into its running summary, by the background task of a turn. """
+
+    thread_id = "history_test_thread"
+
+    def setUp(self):
+        self.store = InMemoryStore()
+        self.summarizer_inputs = []
+
+    def summarize(self, inputs):
+        self.summarizer_inputs.append(inputs)
+        return AIMessage(content=f"summary {len(self.summarizer_inputs)}")
+
+    def compactor(self, summarize=None):
+        return HistoryCompactor(self.store, RunnableLambda(summarize or self.summarize), keep_messages=2,
+                                token_budget=10)
+
+    def test_older_turns_are_folded_into_the_summary(self):
+        compactor = self.compactor()
+        messages = conversation(3)
+
+        async def turns():
+            ## The turn over the budget keeps its messages, the fold runs in the background
+            first = await compactor.compact(self.thread_id, messages)
+            await compactor.drain()
+            second = await compactor.compact(self.thread_id, messages)
+            return first, second
+
+        first, second = asyncio.run(turns())
+        self.assertEqual(first.messages, messages)
+        self.assertEqual((first.removals, first.summary), ([], ""))
+        self.assertEqual([message.id for message in second.messages], ["human_2", "ai_2"])
+        self.assertEqual([removal.id for removal in second.removals], ["human_0", "ai_0", "human_1", "ai_1"])
+        self.assertEqual(second.summary, "summary 1")
+        self.assertGreater(second.tokens_saved, 0)
+        self.assertEqual(self.summarizer_inputs[0]["summary"], "None")
+        self.assertIn("human: question 1", self.summarizer_inputs[0]["transcript"])
+        self.assertEqual(compactor.metrics["summaries"], 1)
+
+        update = summary_state_update(second)
+        self.assertEqual(update["history_summary"], "summary 1")
+        prompt_messages = with_history({"messages": second.messages, **update})["messages"]
+        self.assertIsInstance(prompt_messages[0], SystemMessage)
+        self.assertIn("summary 1", prompt_messages[0].content)
+
+    def test_summary_is_carried_over_to_the_next_fold(self):
+        compactor = self.compactor()
+        messages = conversation(3)
+
+        async def turns():
+            await compactor.compact(self.thread_id, messages)
+            await compactor.drain()
+            ## The folded messages are still in the state when the thread grows past the budget again
+            await compactor.compact(self.thread_id, messages + conversation(2, start=3))
+            await compactor.drain()
+            return await compactor.compact(self.thread_id, messages + conversation(2, start=3))
+
+        compacted = asyncio.run(turns())
+        self.assertEqual(self.summarizer_inputs[1]["summary"], "summary 1")
+        self.assertNotIn("question 0", self.summarizer_inputs[1]["transcript"])
+        self.assertEqual(compacted.summary, "summary 2")
+        self.assertEqual([message.id for message in compacted.messages], ["human_4", "ai_4"])
+        record = self.store.get(HISTORY_SUMMARY_NAMESPACE, self.thread_id).value
+        self.assertEqual(record["folded_ids"], [f"{kind}_{turn}" for turn in range(4) for kind in ("human", "ai")])
+
+    def test_failed_folds_are_counted_and_logged(self):
+        def fail(inputs):
+            raise RuntimeError("model unavailable")
+
+        async def turn(compactor):
+            await compactor.compact(self.thread_id, conversation(3))
+            await compactor.drain()
+            return compactor
+
+        with self.assertLogs("main", level="ERROR") as logs:
+            compactor = asyncio.run(turn(self.compactor(fail)))
+        self.assertEqual(compactor.metrics["failed_summaries"], 1)
+        self.assertIn("model unavailable", logs.output[0])
+
+        ## Failures outside of the summarizer are retrieved and logged by the done callback
+        compactor = self.compactor()
+        with mock.patch.object(InMemoryStore, "aput", side_effect=RuntimeError("store unavailable")), \
+                self.assertLogs("main", level="ERROR") as logs:
+            asyncio.run(turn(compactor))
+        self.assertEqual(compactor.metrics["failed_summaries"], 1)
+        self.assertIn("store unavailable", logs.output[0])
+        self.assertEqual(compactor._in_flight, {})
+        self.assertIsNone(self.store.get(HISTORY_SUMMARY_NAMESPACE, self.thread_id))
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from agents import supervisor_agent
+from agents.history import CompactedHistory
+from agents.intent_router import ROUTER_CONFIDENCE_THRESHOLD, IntentRouter, RouteDecision
+
+
+class IntentRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = IntentRouter(supervisor_agent.router_training_texts, decision_log_path=None)
+
+    def test_keywords_route_confidently(self):
+        for text, agent in [("Book a meeting with John tomorrow at 3pm", "receptionist_agent"),
+                            ("Reschedule my appointment to Friday", "receptionist_agent"),
+                            ("Summarize my uploaded resume pdf", "rag_agent"),
+                            ("What does the document say about pricing?", "rag_agent")]:
+            decision = self.router.classify(text)
+            self.assertEqual(decision.next_agent, agent, text)
+            self.assertGreaterEqual(decision.confidence, ROUTER_CONFIDENCE_THRESHOLD, text)
+
+    def test_question_words_are_no_evidence(self):
+        ## "what" opens the questions of both agents, alone it must leave the turn to the supervisor LLM
+        for text in ["What can you do?", "what", "What now?"]:
+            self.assertLess(self.router.classify(text).confidence, ROUTER_CONFIDENCE_THRESHOLD, text)
+        decision = self.router.classify("What slots are available on Friday?")
+        self.assertEqual(decision.next_agent, "receptionist_agent")
+        self.assertGreaterEqual(decision.confidence, ROUTER_CONFIDENCE_THRESHOLD)
+
+    def test_empty_turn_is_not_routed(self):
+        self.assertEqual(self.router.classify("?!"), RouteDecision(next_agent=None, confidence=0.0))
+
+
+class DecisionLogTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "log", "router_decisions.jsonl")
+
+    def test_decisions_train_the_next_router(self):
+        router = IntentRouter(supervisor_agent.router_training_texts, decision_log_path=self.path)
+        for _ in range(20):
+            router.record("Quarterly numbers of the northwind account", "rag_agent")
+        reloaded = IntentRouter(supervisor_agent.router_training_texts, decision_log_path=self.path)
+        self.assertEqual(reloaded.classify("Quarterly numbers of the northwind account").next_agent, "rag_agent")
+
+    def test_log_is_compacted_to_the_newest_decisions(self):
+        router = IntentRouter(supervisor_agent.router_training_texts, decision_log_path=self.path,
+                              decision_log_max_bytes=4096)
+        for i in range(500):
+            router.record(f"Decision number {i}", "receptionist_agent")
+        self.assertLessEqual(os.path.getsize(self.path), 4096)
+        with open(self.path) as decision_log:
+            decisions = [json.loads(line) for line in decision_log]
+        self.assertEqual(decisions[-1]["text"], "Decision number 499")
+        self.assertGreater(len(decisions), 10)
+
+    def test_logged_turns_are_redacted_and_bounded(self):
+        router = IntentRouter(supervisor_agent.router_training_texts, decision_log_path=self.path)
+        router.record("Book jane.doe@example.com, call her on +1 (555) 123-4567 " + "please " * 100, "receptionist_agent")
+        with open(self.path) as decision_log:
+            text = json.loads(decision_log.readline())["text"]
+        self.assertTrue(text.startswith("Book <email>, call her on <number> please"), text)
+        self.assertEqual(len(text), 200)
+
+    def test_compactions_keep_the_decisions_of_the_other_workers(self):
+        ## Two routers on one log stand in for two worker processes
+        routers = [IntentRouter(supervisor_agent.router_training_texts, decision_log_path=self.path,
+                                decision_log_max_bytes=4096) for _ in range(2)]
+
+        def record(worker):
+            for i in range(300):
+                routers[worker].record(f"Decision {i} of worker {worker}", "receptionist_agent")
+
+        threads = [threading.Thread(target=record, args=(worker,)) for worker in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(self.path) as decision_log:
+            texts = [json.loads(line)["text"] for line in decision_log]
+        self.assertIn("Decision 299 of worker 0", texts)
+        self.assertIn("Decision 299 of worker 1", texts)
+
+    def test_unknown_agents_are_not_logged(self):
+        router = IntentRouter(supervisor_agent.router_training_texts, decision_log_path=self.path)
+        router.record("Anything", "FINISH")
+        self.assertFalse(os.path.exists(self.path))
+
+
+class SupervisorFallbackTests(SimpleTestCase):
+    def run_turn(self, decision, llm_agent="rag_agent"):
+        router = mock.Mock()
+        router.classify.return_value = decision
+        compactor = mock.Mock()
+        compactor.compact = mock.AsyncMock(return_value=CompactedHistory(messages=[], removals=[], summary="",
+                                                                         tokens_saved=0))
+        llm = mock.Mock()
+        llm.ainvoke = mock.AsyncMock(return_value=SimpleNamespace(next_agent=llm_agent))
+        state = {"user_input": "Hello", "messages": [], "account_id": "1", "history_summary": ""}
+        with mock.patch.object(supervisor_agent, "get_router", return_value=router), \
+                mock.patch.object(supervisor_agent, "get_history_compactor", return_value=compactor), \
+                mock.patch.object(supervisor_agent, "get_supervisor_llm", return_value=llm):
+            update = asyncio.run(supervisor_agent.agent_node(state, {"configurable": {"thread_id": "1"}}))
+        return update, router, llm
+
+    def test_confident_turns_skip_the_llm(self):
+        update, router, llm = self.run_turn(RouteDecision("receptionist_agent", ROUTER_CONFIDENCE_THRESHOLD))
+        self.assertEqual(update["next_agent"], "receptionist_agent")
+        llm.ainvoke.assert_not_called()
+        router.record.assert_not_called()
+
+    def test_unconfident_turns_fall_back_to_the_llm_and_are_learned(self):
+        update, router, llm = self.run_turn(RouteDecision("receptionist_agent", ROUTER_CONFIDENCE_THRESHOLD - 0.01))
+        self.assertEqual(update["next_agent"], "rag_agent")
+        llm.ainvoke.assert_awaited_once()
+        router.record.assert_called_once_with("Hello", "rag_agent")
+
+    def test_finish_is_not_learned(self):
+        update, router, _ = self.run_turn(RouteDecision(None, 0.0), llm_agent="FINISH")
+        self.assertEqual(update["next_agent"], "FINISH")
+        router.record.assert_not_called()
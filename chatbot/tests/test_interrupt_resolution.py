@@ -0,0 +1,118 @@
+import asyncio
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+from langchain.agents.output_parsers.tools import ToolAgentAction
+from langchain_core.messages import AIMessage
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.graph import END, StateGraph
+from langgraph.types import Command as Resume
+
+from agents.receptionist_agent import graph
+
+
+## Seconds of a helper call before it times out
+HELPER_TIMEOUT = 0.05
+
+
+class StubTool:
+    def __init__(self, name, run):
+        self.name, self.run, self.calls = name, run, []
+
+    async def ainvoke(self, input):
+        self.calls.append(input)
+        return self.run(input)
+
+
+class StubHelper:
+    """Turns every answer into `answer`, a (tool name, arguments) call, or into prose when it is None."""
+
+    def __init__(self, answer=None, delay=0.0):
+        self.answer, self.delay, self.calls = answer, delay, 0
+
+    async def ainvoke(self, inputs, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.answer is None:
+            return AIMessage(content="Sure, I can help with that once you confirm the details.")
+        name, args = self.answer
+        return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": f"helper-{self.calls}"}])
+
+
+def interrupted(question):
+    return lambda input: {"response": question, "is_interrupted": True}
+
+
+def succeeded(input):
+    return {"response": f"Done with {input}", "is_interrupted": False}
+
+
+class InterruptResolutionTests(SimpleTestCase):
+    """ The interrupt resolution of the receptionist, with stub tools and a stub helper model that answers in prose,
+        hangs, or keeps asking: every interrupt ends within its attempt, question and time budgets.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(graph, "INTERRUPT_HELPER_TIMEOUT", HELPER_TIMEOUT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scenario(self, tools, helper, tool_name="book_job_tool"):
+        """Run the tool call, answering every question of it, returns the result, the questions and the seconds taken."""
+        async def run():
+            builder = StateGraph(graph.AgentState)
+            builder.add_node("run_tool", graph.run_tool)
+            builder.set_entry_point("run_tool")
+            builder.add_edge("run_tool", END)
+            agent = builder.compile(checkpointer=InMemorySaver())
+            config = {"configurable": {"thread_id": "interrupt-test"}}
+            action = ToolAgentAction(tool=tool_name, tool_input={"start_time": "2030-01-01 09:00", "account_id": "account_id_1"},
+                                     log="", message_log=[], tool_call_id="call-1")
+            state = {"user_input": "", "messages": [], "account_id": "account_id_1", "intermediate_steps": [action],
+                     "last_tool_call": None, "responses": [], "tool_results": [], "interrupt_queue": []}
+            started, questions = time.perf_counter(), 0
+            result = await agent.ainvoke(state, config)
+            while "__interrupt__" in result:
+                questions += 1
+                self.assertLessEqual(questions, 20, "The tool call kept asking the human")
+                result = await agent.ainvoke(Resume(resume="Yes, use client@example.com"), config)
+            return result, questions, time.perf_counter() - started
+
+        with mock.patch.object(graph, "tools_by_name", {tool.name: tool for tool in tools}), \
+                mock.patch.object(graph, "get_helper_llm", lambda: helper):
+            return asyncio.run(run())
+
+    def test_prose_helper_is_given_up_on_after_the_attempt_budget(self):
+        helper = StubHelper()
+        calls = dict(graph.interrupt_metrics)
+        result, questions, _ = self.scenario([StubTool("book_job_tool", interrupted("Which client is this for?"))], helper)
+        self.assertEqual(questions, 1)
+        self.assertEqual(helper.calls, graph.INTERRUPT_MAX_ATTEMPTS)
+        self.assertEqual(result["tool_results"][-1]["output"].get("status"), "unresolved")
+        self.assertEqual(graph.interrupt_metrics["no_tool_call"] - calls["no_tool_call"], graph.INTERRUPT_MAX_ATTEMPTS)
+
+    def test_hanging_helper_is_bounded_by_the_timeout_of_each_attempt(self):
+        helper = StubHelper(("book_job_tool", {}), delay=60)
+        result, questions, elapsed = self.scenario([StubTool("book_job_tool", interrupted("Which client is this for?"))], helper)
+        self.assertEqual(result["tool_results"][-1]["output"].get("status"), "unresolved")
+        self.assertLess(elapsed, graph.INTERRUPT_MAX_ATTEMPTS * HELPER_TIMEOUT * questions + 1)
+
+    def test_asking_tool_is_given_up_on_after_the_question_budget(self):
+        tool = StubTool("book_job_tool", interrupted("Which time?"))
+        helper = StubHelper(("book_job_tool", {"start_time": "2030-01-01 10:00"}))
+        result, questions, _ = self.scenario([tool], helper)
+        self.assertEqual(questions, graph.INTERRUPT_MAX_QUESTIONS)
+        self.assertEqual(result["tool_results"][-1]["output"].get("status"), "unresolved")
+
+    def test_resolved_call_to_another_tool_retries_the_original_one(self):
+        client = StubTool("crud_client_tool", succeeded)
+        booking = StubTool("book_job_tool", lambda input: succeeded(input) if client.calls
+                           else {"response": "No client with this email, create one?", "is_interrupted": True})
+        helper = StubHelper(("crud_client_tool", {"operation": "create", "email": "client@example.com"}))
+        result, questions, _ = self.scenario([booking, client], helper)
+        ## The node runs again from the top once resumed, so the booking runs before the question, then twice after
+        self.assertEqual((questions, helper.calls, len(booking.calls), len(client.calls)), (1, 1, 3, 1))
+        self.assertEqual(client.calls[0].get("account_id"), "account_id_1")
+        self.assertEqual([tool_result["tool"] for tool_result in result["tool_results"]],
+                         ["crud_client_tool", "book_job_tool"])
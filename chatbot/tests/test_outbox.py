@@ -0,0 +1,133 @@
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import SimpleTestCase
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import HttpMockSequence
+
+from agents.persistence import SqliteConnectionPool
+from agents.receptionist_agent import google_clients, outbox
+from agents.receptionist_agent.google_clients import discovery_document
+
+
+def batch_response(parts: list[tuple[str, int, dict]], boundary="batch_boundary") -> tuple[dict, str]:
+    """A Google batch response of (request id, status, body) parts, in the order given."""
+    reasons = {200: "OK", 400: "Bad Request", 403: "Forbidden", 429: "Too Many Requests", 503: "Service Unavailable"}
+    content = ""
+    for request_id, status, body in parts:
+        payload = json.dumps(body)
+        content += (f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-base + {request_id}>\r\n\r\n"
+                    f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n{payload}\r\n")
+    return {"status": "200", "content-type": f"multipart/mixed; boundary={boundary}"}, content + f"--{boundary}--"
+
+
+def error(status: int, message: str) -> dict:
+    return {"error": {"code": status, "message": message, "errors": [{"message": message}]}}
+
+
+class OutboxTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.pool = SqliteConnectionPool(os.path.join(directory.name, "outbox.sqlite3"))
+        self.addCleanup(self.pool.close)
+        self.outbox = outbox.Outbox(self.pool)
+        ## Retry quickly, the fake endpoints recover right away
+        for target, value in [("OUTBOX_BACKOFF_SECONDS", 0.01), ("OUTBOX_MAX_ATTEMPTS", 50)]:
+            patcher = mock.patch.object(outbox, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class OutboxWorkersTests(OutboxTestCase):
+
+    def test_every_item_is_delivered_exactly_once(self):
+        deliverer = outbox.FakeGoogleDeliverer(failure_rate=0.2, latency=0.01)
+        workers = outbox.OutboxWorkers(self.outbox, deliverer, workers=4, batch_size=20)
+        item_ids = [self.outbox.enqueue(outbox.EMAIL if i % 2 else outbox.CALENDAR_EVENT, f"account_{i % 10}", {"n": i})
+                    for i in range(200)]
+        workers.start()
+        self.addCleanup(workers.stop)
+        deadline = time.perf_counter() + 60
+        while time.perf_counter() < deadline:
+            statuses = Counter(self.outbox.status(item_id)["status"] for item_id in item_ids)
+            if statuses[outbox.DELIVERED] + statuses[outbox.FAILED] == len(item_ids):
+                break
+            time.sleep(0.05)
+        self.assertEqual(statuses[outbox.DELIVERED], len(item_ids))
+        self.assertEqual(sorted(payload["n"] for _, payload in deliverer.delivered), list(range(200)))
+
+    def test_started_workers_deliver_what_a_previous_run_left(self):
+        deliverer = outbox.FakeGoogleDeliverer(failure_rate=0, latency=0)
+        item_id = self.outbox.enqueue(outbox.EMAIL, "account_1", {"n": 1})
+        workers = outbox.OutboxWorkers(self.outbox, deliverer, workers=1)
+        with mock.patch.object(outbox, "get_outbox_workers", lambda: workers):
+            outbox.start_outbox_workers()
+        self.addCleanup(workers.stop)
+        deadline = time.perf_counter() + 10
+        while self.outbox.status(item_id)["status"] != outbox.DELIVERED and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.outbox.status(item_id)["status"], outbox.DELIVERED)
+
+
+class GoogleDelivererTests(OutboxTestCase):
+    """The batch requests of GoogleDeliverer, against Google responses played back by HttpMockSequence."""
+
+    def use_responses(self, *responses):
+        http = HttpMockSequence(list(responses))
+        services = {name: build_from_document(discovery_document(name, version), http=http)
+                    for name, version in (("gmail", "v1"), ("calendar", "v3"))}
+        clients = SimpleNamespace(gmail=lambda: services["gmail"], calendar=lambda: services["calendar"])
+        patcher = mock.patch.object(google_clients, "get_google_clients", lambda: clients)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return http
+
+    def test_results_follow_the_request_ids_not_the_response_order(self):
+        http = self.use_responses(batch_response([("2", 200, {"id": "event-2", "htmlLink": "link-2"}),
+                                                  ("0", 200, {"id": "event-0", "htmlLink": "link-0"}),
+                                                  ("1", 200, {"id": "event-1", "htmlLink": "link-1"})]))
+        results = outbox.GoogleDeliverer().deliver(outbox.CALENDAR_EVENT, [{"summary": f"Job {i}"} for i in range(3)])
+        self.assertEqual([result.result for result in results],
+                         [{"id": f"event-{i}", "link": f"link-{i}"} for i in range(3)])
+        self.assertTrue(all(result.ok for result in results))
+        (uri, method, body, headers), = http.request_sequence
+        self.assertTrue(uri.endswith("/batch/calendar/v3"))
+        self.assertEqual(body.count("sendNotifications=true"), 3)
+        self.assertEqual([body.count(f"+ {i}>") for i in range(3)], [1, 1, 1])
+
+    def test_partial_failures_are_retried_only_when_retryable(self):
+        self.use_responses(batch_response([("0", 200, {"id": "message-0"}),
+                                           ("1", 503, error(503, "Backend Error")),
+                                           ("2", 400, error(400, "Invalid To header")),
+                                           ("3", 429, error(429, "Rate Limit Exceeded"))]))
+        results = outbox.GoogleDeliverer().deliver(outbox.EMAIL, [{"raw": str(i)} for i in range(4)])
+        self.assertEqual([(result.ok, result.retryable) for result in results],
+                         [(True, True), (False, True), (False, False), (False, True)])
+        self.assertEqual(results[0].result, {"id": "message-0", "link": None})
+        self.assertIn("Invalid To header", results[2].error)
+
+    def test_a_failed_batch_request_fails_every_delivery(self):
+        self.use_responses(({"status": "503"}, json.dumps(error(503, "Backend Error"))))
+        results = outbox.GoogleDeliverer().deliver(outbox.EMAIL, [{"raw": str(i)} for i in range(3)])
+        self.assertEqual([(result.ok, result.retryable) for result in results], [(False, True)] * 3)
+
+    def test_outbox_statuses_after_a_partial_failure(self):
+        self.use_responses(batch_response([("0", 200, {"id": "message-0"}),
+                                           ("1", 503, error(503, "Backend Error")),
+                                           ("2", 403, error(403, "Insufficient Permission"))]))
+        item_ids = [self.outbox.enqueue(outbox.EMAIL, "account_1", {"raw": str(i)}) for i in range(3)]
+        workers = outbox.OutboxWorkers(self.outbox, outbox.GoogleDeliverer(), workers=1)
+        self.assertEqual(workers.run_once(), 3)
+        statuses = [self.outbox.status(item_id) for item_id in item_ids]
+        self.assertEqual([status["status"] for status in statuses], [outbox.DELIVERED, outbox.PENDING, outbox.FAILED])
+        self.assertEqual(statuses[0]["result"], {"id": "message-0", "link": None})
+        self.assertIn("Insufficient Permission", statuses[2]["last_error"])
+        self.assertEqual(workers.metrics, {"batches": 1, "delivered": 1, "retried": 1, "failed": 1})
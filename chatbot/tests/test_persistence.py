@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import tempfile
+from typing import TypedDict
+
+from django.test import SimpleTestCase
+from langgraph.graph import END, StateGraph
+
+from agents.persistence import SqliteCheckpointSaver, SqliteConnectionPool, SqliteStore
+
+
+class CounterState(TypedDict):
+    count: int
+
+
+class PersistenceTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "agent_state.sqlite3")
+
+    def open_pool(self):
+        pool = SqliteConnectionPool(self.path, size=2)
+        self.addCleanup(pool.close)
+        return pool
+
+
+class SqliteCheckpointSaverTests(PersistenceTestCase):
+
+    def test_only_the_last_checkpoints_of_a_thread_are_kept(self):
+        pool = self.open_pool()
+        builder = StateGraph(CounterState)
+        builder.add_node("increment", lambda state: {"count": state["count"] + 1})
+        builder.set_entry_point("increment")
+        builder.add_edge("increment", END)
+        graph = builder.compile(checkpointer=SqliteCheckpointSaver(pool, keep=3))
+        for thread_id in ("thread-1", "thread-2"):
+            config = {"configurable": {"thread_id": thread_id}}
+            for _ in range(10):
+                count = graph.get_state(config).values.get("count", 0)
+                graph.invoke({"count": count}, config)
+            self.assertEqual(graph.get_state(config).values["count"], 10)
+        with pool.connection() as connection:
+            counts = dict(connection.execute("SELECT thread_id, COUNT(*) FROM checkpoints GROUP BY thread_id"))
+            orphans = connection.execute("SELECT COUNT(*) FROM writes WHERE checkpoint_id NOT IN "
+                                         "(SELECT checkpoint_id FROM checkpoints)").fetchone()[0]
+        self.assertEqual(counts, {"thread-1": 3, "thread-2": 3})
+        self.assertEqual(orphans, 0)
+
+
+class SqliteStoreTests(PersistenceTestCase):
+
+    def test_namespaces_with_dots_round_trip(self):
+        store = SqliteStore(self.open_pool())
+        ## BaseStore.put refuses dotted labels, the account scoped writes go through update
+        store.update(("account.one", "history"), "summary.v1", lambda value: {"text": "a"})
+        store.update(("account", "one.history"), "summary.v1", lambda value: {"text": "b"})
+        store.put(("account_one",), "summary.v1", {"text": "c"})
+        self.assertEqual(store.get(("account.one", "history"), "summary.v1").value, {"text": "a"})
+        self.assertEqual([item.value for item in store.search(("account.one",))], [{"text": "a"}])
+        self.assertEqual([item.value for item in store.search(("account",))], [{"text": "b"}])
+        self.assertEqual(store.list_namespaces(prefix=("account.one",)), [("account.one", "history")])
+        self.assertEqual(len(store.search(())), 3)
+
+    def test_namespaces_of_the_previous_format_are_migrated(self):
+        with sqlite3.connect(self.path) as connection:
+            connection.execute("CREATE TABLE store (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                               "created_at TEXT NOT NULL, updated_at TEXT NOT NULL, PRIMARY KEY (namespace, key))")
+            connection.execute("INSERT INTO store VALUES ('account_one.history', 'summary', '{\"text\": \"a\"}', "
+                               "'2030-01-01T00:00:00+00:00', '2030-01-01T00:00:00+00:00')")
+        connection.close()
+        store = SqliteStore(self.open_pool())
+        self.assertEqual(store.get(("account_one", "history"), "summary").value, {"text": "a"})
@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from agents.receptionist_agent import response_templates
+from agents.receptionist_agent.response_templates import render_one, render_responses
+
+
+def tool_result(tool, tool_input, output):
+    return {"tool": tool, "tool_input": tool_input, "output": output}
+
+
+CREATED = tool_result("crud_client_tool", {"client_email": "ann@example.com"}, {"status": "created"})
+LISTED = tool_result("check_slot_availability_tool", {"booking_type": "job"},
+                     {"status": "listed", "slots": ["2026-10-19 09:00", "2026-10-19 10:00"]})
+
+
+class RenderResponsesTests(SimpleTestCase):
+    """ Final responses rendered from the tool results of a turn, and the turns left to the synthesizer model. """
+
+    def setUp(self):
+        self.addCleanup(response_templates.get_templates.cache_clear)
+        response_templates.get_templates.cache_clear()
+        patcher = mock.patch.dict(response_templates.metrics, {"rendered": 0, "synthesized": 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results_are_rendered_and_joined(self):
+        self.assertEqual(render_responses([CREATED, LISTED], ["created", "listed"]),
+                         "I've added ann@example.com as a new client. "
+                         "Available slots for job: 2026-10-19 09:00, 2026-10-19 10:00.")
+        self.assertEqual(response_templates.metrics, {"rendered": 1, "synthesized": 0})
+
+    def test_off_mode_leaves_every_turn_to_the_model(self):
+        with mock.patch.object(response_templates, "RESPONSE_TEMPLATES_MODE", "off"):
+            self.assertIsNone(render_responses([CREATED], ["created"]))
+        self.assertEqual(response_templates.metrics, {"rendered": 0, "synthesized": 1})
+
+    def test_statuses_and_fields_without_a_template_fall_back_to_the_model(self):
+        templates = response_templates.get_templates()
+        unknown_status = tool_result("crud_client_tool", {"client_email": "ann@example.com"}, {"status": "odd"})
+        missing_field = tool_result("crud_client_tool", {}, {"status": "created"})
+        unknown_tool = tool_result("unknown_tool", {}, {"status": "created"})
+        for result in (unknown_status, missing_field, unknown_tool):
+            self.assertIsNone(render_one(result, templates))
+        self.assertIsNone(render_responses([CREATED, missing_field], ["created", "created"]))
+        self.assertEqual(response_templates.metrics, {"rendered": 0, "synthesized": 1})
+
+    def test_turns_the_templates_do_not_cover_are_left_to_the_model(self):
+        ## No tool results, more than RESPONSE_TEMPLATES_MAX_RESULTS, or responses not all coming from a tool
+        with mock.patch.object(response_templates, "RESPONSE_TEMPLATES_MAX_RESULTS", 1):
+            self.assertIsNone(render_responses([CREATED, CREATED], ["created", "created"]))
+        self.assertIsNone(render_responses([], []))
+        self.assertIsNone(render_responses([CREATED], ["created", "some text"]))
+        self.assertEqual(response_templates.metrics, {"rendered": 0, "synthesized": 3})
+
+    def test_templates_file_is_merged_over_the_defaults(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "templates.json")
+        with open(path, "w") as templates_file:
+            json.dump({"crud_client_tool": {"created": "Welcome aboard, {client_email}."},
+                       "custom_tool": {"done": "Done."}}, templates_file)
+        with mock.patch.object(response_templates, "RESPONSE_TEMPLATES_FILE", path):
+            response_templates.get_templates.cache_clear()
+            templates = response_templates.get_templates()
+        self.assertEqual(render_one(CREATED, templates), "Welcome aboard, ann@example.com.")
+        self.assertEqual(render_one(tool_result("custom_tool", {}, {"status": "done"}), templates), "Done.")
+        ## The statuses the file leaves out keep their default templates
+        self.assertEqual(templates["crud_client_tool"]["deleted"],
+                         response_templates.DEFAULT_TEMPLATES["crud_client_tool"]["deleted"])
+        self.assertEqual(response_templates.DEFAULT_TEMPLATES["crud_client_tool"]["created"],
+                         "I've added {client_email} as a new client.")
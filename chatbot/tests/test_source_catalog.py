@@ -0,0 +1,116 @@
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from agents.RAG_agent import etl, source_catalog, vector_engine
+from agents.RAG_agent.source_catalog import SourceCatalog
+from agents.RAG_agent.vector_engine import LocalVectorEngine
+
+
+class StubSupabase:
+    """Takes the inserts of load_text_doc, and gives the rows their ids."""
+
+    def __init__(self):
+        self.next_id = iter(range(1, 10 ** 9))
+
+    def table(self, name):
+        return self
+
+    def insert(self, rows):
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=[{**row, "id": next(self.next_id)} for row in rows]))
+
+
+class SourceCatalogTests(SimpleTestCase):
+    """ Chunks of a few sources loaded into a local vector engine through load_text_doc, with a stub Supabase
+        client, and routed through the source catalog.
+    """
+
+    sources = 5
+    urls = 4
+    chunks = 3
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.rng = np.random.default_rng(0)
+        self.engine = LocalVectorEngine(os.path.join(directory.name, "index"))
+        self.addCleanup(self.engine.close)
+        self.catalog = SourceCatalog(ttl=60)
+        self.registered = []
+        supabase = StubSupabase()
+
+        def stub_register_chunks(source_name, url):
+            self.registered.append((source_name, url))
+            self.catalog.invalidate()
+
+        for module, target, value in [(vector_engine, "RAG_VECTOR_BACKEND", "local"),
+                                      (vector_engine, "get_vector_engine", lambda: self.engine),
+                                      (etl, "RAG_VECTOR_BACKEND", "local"),
+                                      (etl, "get_vector_engine", lambda: self.engine),
+                                      (etl, "get_supabase", lambda: supabase),
+                                      (etl, "register_chunks", stub_register_chunks),
+                                      (etl, "get_source_catalog", lambda: self.catalog),
+                                      (source_catalog, "get_source_catalog", lambda: self.catalog)]:
+            patcher = mock.patch.object(module, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.expected = {}
+        for s in range(self.sources):
+            source_name = f"source_{s}"
+            for u in range(self.urls):
+                url = f"https://{source_name}.example/page/{u}"
+                etl.load_text_doc(self.transformed_chunks(source_name, url, self.chunks))
+                self.expected.setdefault(source_name, {})[url] = self.chunks
+
+    def transformed_chunks(self, source_name, url, count):
+        return [etl.TransformedChunk(source_name=source_name, url=url, chunk_number=i, title=f"Title {i}",
+                                     summary=f"Summary {i}", content=f"Chunk {i} of {url}",
+                                     embedding=self.rng.normal(size=768).astype(np.float32))
+                for i in range(count)]
+
+    def test_catalog_routes_from_one_read(self):
+        self.assertEqual(len(self.registered), self.sources * self.urls)
+        sources = self.catalog.sources()
+        self.assertEqual({name: entry.urls for name, entry in sources.items()}, self.expected)
+        for _ in range(100):
+            prompt = self.catalog.routing_prompt()
+            self.catalog.urls(["source_0", "source_1", "unknown"])
+        self.assertEqual(self.catalog.metrics["loads"], 1)
+        self.assertIn(f'- "source_0": {self.urls * self.chunks} chunks from {self.urls} pages', prompt)
+        self.assertEqual(self.catalog.urls(["source_1", "unknown"]), list(self.expected["source_1"]))
+
+    def test_load_shows_up_at_the_next_question(self):
+        self.catalog.sources()
+        etl.load_text_doc(self.transformed_chunks("source_new", "https://new.example/page", 3))
+        self.assertEqual(self.catalog.sources()["source_new"].chunk_count, 3)
+
+    def test_loads_of_other_workers_show_up_once_the_ttl_is_over(self):
+        self.catalog.ttl = 0.05
+        self.catalog.sources()
+        loads = self.catalog.metrics["loads"]
+        self.engine.add([{"source_name": "source_other", "url": "https://other.example", "id": 0, "chunk_number": 0,
+                          "title": "", "summary": "", "content": "", "embedding": self.rng.normal(size=768).tolist()}])
+        time.sleep(0.06)
+        self.assertIn("source_other", self.catalog.sources())
+        self.assertEqual(self.catalog.metrics["loads"], loads + 1)
+
+    def test_catalog_invalidated_while_it_was_read_is_not_kept(self):
+        fetch_rows = self.catalog._fetch_rows
+
+        def racing_fetch_rows():
+            rows = fetch_rows()
+            threading.Thread(target=self.catalog.invalidate).start()
+            time.sleep(0.01)
+            return rows
+
+        self.catalog.invalidate()
+        with mock.patch.object(self.catalog, "_fetch_rows", racing_fetch_rows):
+            self.catalog.sources()
+        self.assertIsNone(self.catalog._sources)
@@ -0,0 +1,131 @@
+import asyncio
+from unittest import mock
+
+from django.test import SimpleTestCase
+from langchain.agents.output_parsers.tools import ToolAgentAction
+from langchain_core.messages import AIMessage
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.graph import END, StateGraph
+from langgraph.types import Command as Resume
+
+from agents.receptionist_agent import graph
+
+
+def action(tool, call_id, **tool_input):
+    return ToolAgentAction(tool=tool, tool_input={"account_id": "account_id_1", **tool_input}, log="", message_log=[],
+                           tool_call_id=call_id)
+
+
+class TimedTool:
+    """A stub tool taking `delay` seconds, which logs when its calls start and end."""
+
+    def __init__(self, name, timeline, delay=0.02, run=None):
+        self.name, self.timeline, self.delay, self.calls = name, timeline, delay, []
+        self.run = run or (lambda input: {"response": f"{name} done", "is_interrupted": False})
+
+    async def ainvoke(self, input):
+        self.calls.append(input)
+        self.timeline.append(("start", self.name, input.get("client_email")))
+        await asyncio.sleep(self.delay)
+        self.timeline.append(("end", self.name, input.get("client_email")))
+        return self.run(input)
+
+
+class ToolDagTests(SimpleTestCase):
+    """The order and the concurrency of the tool calls of a turn, run by the tool executor with stub tools."""
+
+    def setUp(self):
+        self.timeline = []
+        self.tools = {name: TimedTool(name, self.timeline) for name in graph.tools_by_name}
+        patcher = mock.patch.object(graph, "tools_by_name", self.tools)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def execute(self, actions):
+        state = {"intermediate_steps": actions, "responses": [], "tool_results": [], "last_tool_call": None}
+        return asyncio.run(graph.tool_executor(state, {}))
+
+    def assertRunsAfter(self, later, earlier):
+        starts = [i for i, event in enumerate(self.timeline) if event[0] == "start" and event[1] == later]
+        ends = [i for i, event in enumerate(self.timeline) if event[0] == "end" and event[1] == earlier]
+        self.assertGreater(min(starts), max(ends), f"{later} started before {earlier} ended")
+
+    def test_dependencies(self):
+        actions = [action("crud_client_tool", "1", client_email="a@example.com"),
+                   action("crud_client_tool", "2", client_email="b@example.com"),
+                   action("check_slot_availability_tool", "3"),
+                   action("book_job_tool", "4", client_email="a@example.com"),
+                   action("book_job_tool", "5", client_email="a@example.com"),
+                   action("send_email_tool", "6", client_email="b@example.com")]
+        self.assertEqual(graph.build_tool_dag(actions), [set(), set(), set(), {0, 1, 2}, {0, 1, 2, 3}, {0, 1, 3, 4}])
+
+    def test_independent_calls_run_concurrently(self):
+        update = self.execute([action("crud_client_tool", "1", client_email="a@example.com"),
+                               action("crud_client_tool", "2", client_email="b@example.com"),
+                               action("check_slot_availability_tool", "3")])
+        ## Every call started before the first one ended
+        self.assertEqual([event[0] for event in self.timeline], ["start"] * 3 + ["end"] * 3)
+        self.assertEqual(update["intermediate_steps"], [])
+        self.assertEqual(len(update["tool_results"]), 3)
+
+    def test_booking_waits_for_the_availability_check_and_the_client(self):
+        self.execute([action("check_slot_availability_tool", "1"),
+                      action("crud_client_tool", "2", client_email="a@example.com"),
+                      action("book_job_tool", "3", client_email="a@example.com"),
+                      action("send_email_tool", "4", client_email="a@example.com")])
+        self.assertRunsAfter("book_job_tool", "check_slot_availability_tool")
+        self.assertRunsAfter("book_job_tool", "crud_client_tool")
+        self.assertRunsAfter("send_email_tool", "book_job_tool")
+
+    def test_call_needing_the_human_holds_back_its_dependents(self):
+        self.tools["crud_client_tool"].run = lambda input: {"response": "Which phone number?", "is_interrupted": True}
+        update = self.execute([action("crud_client_tool", "1", client_email="a@example.com"),
+                               action("book_job_tool", "2", client_email="a@example.com"),
+                               action("check_slot_availability_tool", "3")])
+        self.assertEqual([step.tool_call_id for step in update["intermediate_steps"]], ["1", "2"])
+        self.assertTrue(update["awaiting_human"])
+        self.assertEqual(update["interrupt_queue"],
+                         [{"tool_call_id": "1", "output": {"response": "Which phone number?", "is_interrupted": True}}])
+        self.assertEqual(len(self.tools["book_job_tool"].calls), 0)
+
+
+class StubHelper:
+    async def ainvoke(self, inputs, config=None):
+        return AIMessage(content="", tool_calls=[{"name": "crud_client_tool", "id": "helper-1",
+                                                  "args": {"operation": "create", "client_email": "a@example.com"}}])
+
+
+class ExecutorInterruptTests(SimpleTestCase):
+    """A call of the tool executor that needs the human, resolved by `run_tool` without running it again."""
+
+    def test_interrupted_call_is_not_run_again_before_the_question(self):
+        timeline = []
+        client = TimedTool("crud_client_tool", timeline, delay=0)
+        booking = TimedTool("book_job_tool", timeline, delay=0,
+                            run=lambda input: {"response": "Booked", "is_interrupted": False} if client.calls
+                            else {"response": "No client with this email, create one?", "is_interrupted": True})
+
+        async def run():
+            builder = StateGraph(graph.AgentState)
+            builder.add_node("tool_executor", graph.tool_executor)
+            builder.add_node("book_job_tool", graph.run_tool)
+            builder.set_entry_point("tool_executor")
+            builder.add_conditional_edges("tool_executor", graph.router)
+            builder.add_edge("book_job_tool", END)
+            agent = builder.compile(checkpointer=InMemorySaver())
+            config = {"configurable": {"thread_id": "executor-interrupt-test"}}
+            state = {"user_input": "", "messages": [], "account_id": "account_id_1", "last_tool_call": None,
+                     "intermediate_steps": [action("book_job_tool", "1", client_email="a@example.com")],
+                     "responses": [], "tool_results": [], "interrupt_queue": []}
+            result = await agent.ainvoke(state, config)
+            self.assertEqual(result["__interrupt__"][0].value, "No client with this email, create one?")
+            return await agent.ainvoke(Resume(resume="Yes, create them"), config)
+
+        with mock.patch.object(graph, "tools_by_name", {"crud_client_tool": client, "book_job_tool": booking}), \
+                mock.patch.object(graph, "get_helper_llm", lambda: StubHelper()):
+            result = asyncio.run(run())
+        ## Once by the executor, once after the client was created
+        self.assertEqual((len(booking.calls), len(client.calls)), (2, 1))
+        self.assertEqual([tool_result["tool"] for tool_result in result["tool_results"]],
+                         ["crud_client_tool", "book_job_tool"])
+        self.assertEqual(result["interrupt_queue"], [])
@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from agents.RAG_agent.vector_engine import LocalVectorEngine
+from agents.RAG_agent.vector_store import VectorStore
+
+
+## Dimensions of the test embeddings
+DIMENSIONS = 32
+
+
+class LocalVectorEngineTests(SimpleTestCase):
+    """ Engines on the same index directory, standing in for the server and ETL processes, writing and searching
+        at the same time.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.rng = np.random.default_rng(0)
+
+    def open_engine(self, **kwargs):
+        engine = LocalVectorEngine(self.directory, dimensions=DIMENSIONS, dtype="float32",
+                                   **{"refresh_seconds": 0, "delta_min_vectors": 20, **kwargs})
+        self.addCleanup(engine.close)
+        return engine
+
+    def rows(self, source_name, url, count):
+        embeddings = self.rng.normal(size=(count, DIMENSIONS)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return [{"source_name": source_name, "url": url, "id": i, "chunk_number": i, "title": "", "summary": "",
+                 "content": f"{url} {i}", "embedding": embedding.tolist()} for i, embedding in enumerate(embeddings)]
+
+    def assertFindsEveryChunk(self, engine, rows, **kwargs):
+        for row in rows:
+            match, = engine.search(row["embedding"], match_count=1, **kwargs)
+            self.assertEqual(match["content"], row["content"])
+            self.assertAlmostEqual(match["similarity"], 1.0, places=4)
+
+    def test_chunks_written_by_another_process_are_found(self):
+        server, etl = self.open_engine(), self.open_engine()
+        rows = self.rows("docs", "https://docs.example/a", 5)
+        etl.add(rows)
+        self.assertEqual(server.source_names(), ["docs"])
+        self.assertFindsEveryChunk(server, rows)
+        more = self.rows("docs", "https://docs.example/b", 5)
+        etl.add(more)
+        self.assertEqual(len(server), 10)
+        self.assertFindsEveryChunk(server, rows + more)
+
+    def test_writers_of_two_processes_do_not_take_the_same_positions(self):
+        engines = [self.open_engine(), self.open_engine()]
+        batches = [self.rows("docs", f"https://docs.example/{i}", 3) for i in range(30)]
+
+        def write(engine, engine_batches):
+            for batch in engine_batches:
+                engine.add(batch)
+
+        threads = [threading.Thread(target=write, args=(engine, batches[i::2])) for i, engine in enumerate(engines)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        reader = self.open_engine()
+        self.assertEqual(len(reader), 90)
+        self.assertEqual([entry["chunk_count"] for entry in reader.catalog()], [3] * 30)
+        self.assertFindsEveryChunk(reader, [row for batch in batches for row in batch])
+
+    def test_deltas_are_merged_into_the_main_index(self):
+        engine = self.open_engine()
+        rows = []
+        for i in range(10):
+            batch = self.rows("docs", f"https://docs.example/{i}", 7)
+            engine.add(batch)
+            rows.extend(batch)
+        partition = engine._partitions["docs"]
+        ## The delta is merged once it holds delta_min_vectors chunks
+        self.assertLess(len(partition.delta or ()), 20)
+        self.assertEqual(len(partition), 70)
+        self.assertFindsEveryChunk(engine, rows)
+        self.assertFindsEveryChunk(engine, rows[-7:], urls=["https://docs.example/9"])
+        with engine.pool.connection() as connection:
+            files = {file for row in connection.execute("SELECT file, delta_file FROM partitions") for file in row}
+        self.assertEqual(set(os.listdir(self.directory)) - {"chunks.sqlite3", "chunks.sqlite3-wal", "chunks.sqlite3-shm"},
+                         files - {None})
+
+    def test_url_filters_cover_the_main_index_and_the_delta(self):
+        engine = self.open_engine(delta_min_vectors=1000)
+        first, second = self.rows("docs", "https://docs.example/a", 5), self.rows("docs", "https://docs.example/b", 5)
+        engine.add(first)
+        engine.add(second)
+        self.assertEqual(len(engine._partitions["docs"].delta), 5)
+        for row in first + second:
+            match, = engine.search(row["embedding"], urls=[row["url"]], match_count=1)
+            self.assertEqual(match["content"], row["content"])
+        self.assertEqual(engine.search(first[0]["embedding"], urls=["https://docs.example/missing"]), [])
+
+    def test_indexes_of_the_previous_schema_are_still_read(self):
+        rows = self.rows("docs", "https://docs.example/a", 5)
+        store = VectorStore(DIMENSIONS, "float32")
+        store.add(np.array([row["embedding"] for row in rows], dtype=np.float32))
+        store.save(os.path.join(self.directory, "docs.faiss"))
+        with sqlite3.connect(os.path.join(self.directory, "chunks.sqlite3")) as connection:
+            connection.execute("CREATE TABLE partitions (source_name TEXT PRIMARY KEY, file TEXT NOT NULL)")
+            connection.execute("INSERT INTO partitions VALUES ('docs', 'docs.faiss')")
+        connection.close()
+        engine = self.open_engine()
+        self.assertEqual(len(engine), 5)
+        more = self.rows("docs", "https://docs.example/b", 2)
+        engine.add(more)
+        self.assertEqual(len(engine), 7)
+        self.assertFindsEveryChunk(engine, more)
@@ -3,25 +3,19 @@ import nest_asyncio
 from ai_receptionist_chat import settings
 nest_asyncio.apply()
 
-from io import BytesIO
-from django.http import JsonResponse
+from io import BytesIO, TextIOWrapper
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 import json
 from django.core.cache import cache
 import logging
-import logging.config
-import yaml
+import os
 import hashlib
+import shutil
 
 from django.core.files.storage import FileSystemStorage
 from django.core.files.base import ContentFile
 
-from agents.RAG_agent.graph import file_upload_handler
-from agents.supervisor_agent import process_input
-
-with open("config/logging.yml", "r") as logging_config_file:
-    logging.config.dictConfig(yaml.load(logging_config_file, Loader=yaml.FullLoader))
-
 main_logger = logging.getLogger('main')
 
 
@@ -48,6 +42,8 @@ async def chat_view(request):
             main_logger.info(f"Received message: {user_message} for account_id: {account_id}")
             is_interrupted = get_interrupted_state(account_id)
             
+            ## The agents are imported on the first request, so the server starts without loading them
+            from agents.supervisor_agent import process_input
             response_text, is_interrupted = await process_input(user_message, account_id, is_interrupted)
             set_interrupted_state(account_id, is_interrupted)
             return JsonResponse({"response": response_text, "is_interrupted": is_interrupted}, status=200)
@@ -57,6 +53,103 @@ async def chat_view(request):
         return JsonResponse({"error": "Invalid request method"}, status=405)
 
 
+@csrf_exempt
+async def chat_stream_view(request):
+    """
+    A view to handle chat input, streaming the response as Server-Sent Events.
+    Every `token` event carries a response delta, the last `done` event carries
+    the final response and the `is_interrupted` flag.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    user_message = data.get('message', '')
+    account_id = data.get('account_id', '')
+    main_logger.info(f"Received message to stream: {user_message} for account_id: {account_id}")
+
+    from agents.supervisor_agent import stream_input
+
+    async def event_stream():
+        is_interrupted = get_interrupted_state(account_id)
+        async for event in stream_input(user_message, account_id, is_interrupted):
+            if event["type"] == "done":
+                set_interrupted_state(account_id, event["is_interrupted"])
+                payload = {"response": event["response"], "is_interrupted": event["is_interrupted"]}
+            else:
+                payload = {"content": event["content"]}
+            yield f"event: {event['type']}\ndata: {json.dumps(payload)}\n\n"
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def outbox_status_view(request, delivery_id=None):
+    """
+    Delivery status of the emails and calendar invites queued by the receptionist.
+    `/outbox/<id>/?account_id=...` for one delivery, `/outbox/?account_id=...&status=...` for the latest ones.
+    """
+    if request.method != 'GET':
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    account_id = request.GET.get('account_id', '')
+    if not account_id:
+        return JsonResponse({"error": "No account_id provided"}, status=400)
+
+    from agents.receptionist_agent.outbox import get_outbox
+    if delivery_id is None:
+        deliveries = await asyncio.to_thread(get_outbox().list_for_account, account_id, request.GET.get('status'))
+        return JsonResponse({"deliveries": deliveries}, status=200)
+    delivery = await asyncio.to_thread(get_outbox().status, delivery_id)
+    if delivery is None or delivery["account_id"] != account_id:
+        return JsonResponse({"error": "Delivery not found"}, status=404)
+    return JsonResponse(delivery, status=200)
+
+
+@csrf_exempt
+async def import_clients_view(request):
+    """
+    Bulk import of the clients of an account from a CSV upload (`file`) with `name`, `email` and `phone` columns.
+    Clients are upserted on their email, the response has the counts and the rejected rows by line number.
+    """
+    if request.method != 'POST' or not request.FILES.get('file', None):
+        return JsonResponse({"error": "No file uploaded"}, status=400)
+    account_id = request.POST.get('account_id', '')
+    if not account_id:
+        return JsonResponse({"error": "No account_id provided"}, status=400)
+
+    from agents.receptionist_agent import db
+    ## Read as it is parsed, large uploads are spooled to disk by Django and never loaded whole
+    csv_file = TextIOWrapper(request.FILES['file'].file, encoding='utf-8-sig', newline='')
+    try:
+        report = await db.import_clients(account_id, db.clients_from_csv(csv_file))
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({"error": f"Invalid CSV: {e}"}, status=400)
+    return JsonResponse(report, status=200)
+
+
+@csrf_exempt
+async def calendar_notification_view(request):
+    """
+    Push notifications of the Google Calendar channel watching the business calendar, they only wake the
+    calendar mirror up to sync the changes. `GOOGLE_CALENDAR_CHANNEL_TOKEN` is the token the channel was created with.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    expected_token = os.getenv("GOOGLE_CALENDAR_CHANNEL_TOKEN")
+    if expected_token and request.headers.get('X-Goog-Channel-Token') != expected_token:
+        return JsonResponse({"error": "Invalid channel token"}, status=403)
+
+    from agents.receptionist_agent.calendar_mirror import active_calendar_mirror
+    mirror = active_calendar_mirror()
+    if mirror is not None:
+        mirror.notify()
+    return JsonResponse({"message": "ok"}, status=200)
+
+
 @csrf_exempt
 def upload_file(request):
     if request.method != 'POST' or not request.FILES.get('file', None):
@@ -74,18 +167,21 @@ def upload_file(request):
         return JsonResponse({'error': f"Invalid file type. Allowed types: {', '.join(allowed_extensions)}"}, status=400)
 
     # Check if the file already exists using checksum
-    new_checksum = hashlib.md5(uploaded_file.read()).hexdigest()
+    content = uploaded_file.read()
+    new_checksum = hashlib.md5(content).hexdigest()
     print(f"media dir: {settings.MEDIA_ROOT + '/uploaded-files/raw-files'}")
     destination = FileSystemStorage(location=settings.MEDIA_ROOT + '/uploaded-files/raw-files')
     
     print(f"File exists: {destination.exists(uploaded_file.name)}")
     if not destination.exists(uploaded_file.name):
-        destination.save(uploaded_file.name, ContentFile(uploaded_file.read()))
+        destination.save(uploaded_file.name, ContentFile(content))
     elif destination.exists(uploaded_file.name) and new_checksum != hashlib.md5(destination.open(uploaded_file.name).read()).hexdigest():
         destination.delete(uploaded_file.name)
-        FileSystemStorage(location=settings.MEDIA_ROOT + f'/uploaded-files/index-storage').delete(f"{uploaded_file.name}/*")
-        destination.save(uploaded_file.name, ContentFile(uploaded_file.read()))
+        ## The index of the old content, the new one is built by the upload handler
+        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, 'uploaded-files', 'index-storage', uploaded_file.name), ignore_errors=True)
+        destination.save(uploaded_file.name, ContentFile(content))
 
+    from agents.RAG_agent.graph import file_upload_handler
     file_upload_handler(file_name=uploaded_file.name, account_id=account_id, key="attachment_processors")
     return JsonResponse({'message': 'File uploaded successfully', 'file_name': uploaded_file.name})
 